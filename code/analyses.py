@@ -1,26 +1,40 @@
 import pickle
 import os
-from nilearn.glm import threshold_stats_img
-from nilearn.plotting import plot_stat_map
-from nilearn.plotting import plot_glass_brain
-from nilearn.plotting import view_img_on_surf
-import matplotlib.pyplot as plt
+from itertools import product
+from pathlib import Path
 import numpy as np
-from sklearn.utils.validation import check_is_fitted, NotFittedError
-from nilearn.plotting import plot_img_on_surf
 
-from viz import plot_design_matrix_to_file, plot_contrast_matrix_to_file
-
-
-from nilearn.glm.first_level import FirstLevelModel
+from viz import plot_design_matrix_to_file
+from viz import compute_threshold_plot_stat_maps_to_file
+from utils import as_list, get_subject_runs
+from rendering import FigureRenderer, save_img_if_changed
+from clusters import ClusterSweep, save_cluster_table
+from glm_cache import GLMCache, compute_glm_key
+from glm_store import StoredGLM, save_glm_store
+from profiling import profiled
 
 
 # Main first-level analysis function for a single subject, multiple runs (concatenated), and contrast
+@profiled("glm_fit")
 def fit_GLM(exp_args, fns_func, dfs_events, dfs_confounds,
-            glm_params, path2root, save_model=True):
+            glm_params, path2root, save_model=True, cache_max_bytes=None,
+            store_format="pickle", memory_budget=None):
     """
     Performs first-level fMRI analysis for a given subject, concatenating specified runs, for a given contrast.
+    Fitted models are cached in output/glm_models, keyed on a hash of the inputs;
+    cache_max_bytes bounds the cache size (least recently used models are evicted).
+    store_format="arrays" saves only what contrasts need as memory-mappable arrays
+    (see glm_store) instead of pickling the whole FirstLevelModel; a cached store
+    is returned as a StoredGLM.
+    With memory_budget (bytes), the model is fitted block of voxels by block within that
+    budget (see chunked_glm) and always saved as such a store, which is its output.
+    store_format="runs" fits and caches every run on its own as sufficient statistics
+    (see run_stats), so a model of any subset of cached runs is assembled without
+    refitting; a run_stats.RunStatsGLM is returned.
     """
+    if store_format not in ("pickle", "arrays", "runs"):
+        raise ValueError(f"store_format must be 'pickle', 'arrays' or 'runs', got '{store_format}'.")
+
     # build file and folder names based on experiment arguments
     subject_id, session, task = exp_args['subject'], exp_args['session'], exp_args['task']
     
@@ -32,15 +46,50 @@ def fit_GLM(exp_args, fns_func, dfs_events, dfs_confounds,
         subject_ids_str = f"{subject_id:02d}"
     fn_base = f"sub-{subject_ids_str}_ses-{session}_task-{task}"
 
+    if store_format == "runs":
+        from run_stats import fit_run_stats_glm
+        return fit_run_stats_glm(fn_base, fns_func, dfs_events, dfs_confounds, glm_params,
+                                 os.path.join(path2root, "output", "glm_runs"),
+                                 memory_budget=memory_budget, cache_max_bytes=cache_max_bytes,
+                                 mask_runs=get_subject_runs(exp_args, path2root))
+
+    # Models are cached under a hash of their inputs, so changing the runs, events,
+    # confounds or GLM parameters never reuses a stale fit
     path2output = os.path.join(path2root, "output", "glm_models")
-    fn_glm = f'glm_{fn_base}.pkl'  # Use the first functional file name for GLM
+    glm_cache = GLMCache(path2output, max_bytes=cache_max_bytes)
+    glm_key = compute_glm_key(fns_func, dfs_events, dfs_confounds, glm_params)
+    if memory_budget is not None:
+        glm_key = f"{glm_key}-chunked"
+        fn_glm = f'glm_{fn_base}_{glm_key[:16]}_chunked'
+    elif store_format == "arrays":
+        glm_key = f"{glm_key}-arrays"
+        fn_glm = f'glm_{fn_base}_{glm_key[:16]}'
+    else:
+        fn_glm = f'glm_{fn_base}_{glm_key[:16]}.pkl'
     
-    fmri_glm_file = os.path.join(path2output, fn_glm)
+    fmri_glm_file = glm_cache.lookup(glm_key)
+    cache_description = {'fn_base': fn_base,
+                         'n_runs': len(fns_func),
+                         'glm_params': {k: str(v) for k, v in glm_params.items()}}
 
     needs_fitting = False
 
-    if os.path.exists(fmri_glm_file):
+    if fmri_glm_file is not None and (store_format == "arrays" or memory_budget is not None):
+        print(f"GLM store already exists at {fmri_glm_file}. Memory-mapping existing results...")
+        return StoredGLM(fmri_glm_file)
+    elif memory_budget is not None:
+        print(f"No cached GLM model matches these inputs. Fitting it in voxel blocks "
+              f"within {memory_budget / 1024**3:.2f} GB...")
+        from chunked_glm import fit_chunked_glm
+        fmri_glm_file = glm_cache.entry_path(fn_glm)
+        fmri_glm = fit_chunked_glm(fns_func, dfs_events, dfs_confounds, glm_params,
+                                   fmri_glm_file, memory_budget)
+        glm_cache.add(glm_key, fn_glm, description=cache_description)
+        print(f"Fitted GLM store saved to {fmri_glm_file}")
+        return fmri_glm
+    elif fmri_glm_file is not None:
         print(f"GLM model already exists at {fmri_glm_file}. Loading existing model...")
+        from sklearn.utils.validation import check_is_fitted, NotFittedError
         with open(fmri_glm_file, 'rb') as f:
             fmri_glm = pickle.load(f)
         
@@ -51,7 +100,8 @@ def fit_GLM(exp_args, fns_func, dfs_events, dfs_confounds,
             print("  WARNING: Loaded model is not fitted. It will be re-fitted.")
             needs_fitting = True
     else:
-        print("No existing GLM model found. Creating and fitting a new one.")
+        print("No cached GLM model matches these inputs. Creating and fitting a new one.")
+        from nilearn.glm.first_level import FirstLevelModel
         fmri_glm = FirstLevelModel(**glm_params)
         needs_fitting = True
 
@@ -61,22 +111,38 @@ def fit_GLM(exp_args, fns_func, dfs_events, dfs_confounds,
         fmri_glm.fit(fns_func, dfs_events, dfs_confounds)
         print("  GLM fitting complete.")
         if save_model:
-            # Create output directory if it doesn't exist
-            os.makedirs(path2output, exist_ok=True)
-            # Save the fitted model
-            with open(fmri_glm_file, 'wb') as f:
-                pickle.dump(fmri_glm, f)
+            # Save the fitted model and register it in the cache index
+            fmri_glm_file = glm_cache.entry_path(fn_glm)
+            if store_format == "arrays":
+                save_glm_store(fmri_glm, fmri_glm_file)
+            else:
+                with open(fmri_glm_file, 'wb') as f:
+                    pickle.dump(fmri_glm, f)
+            glm_cache.add(glm_key, fn_glm, description=cache_description)
             print(f"Fitted GLM model saved to {fmri_glm_file}")
 
     return fmri_glm
    
+@profiled("plot_contrast")
 def plot_contrast(exp_args, fmri_glm, contrast_name, contrast_vector,
                    mean_func_img, path2root,
                     threshold_z=3.1,
                     cluster_threshold=10,
-                    save_plots=True):
+                    save_plots=True,
+                    z_map=None,
+                    alphas=None,
+                    renderer=None):
     """
     Plots the contrast for the fitted GLM model.
+    If z_map is given (e.g. from multi_contrast.compute_contrasts_batch), it is used
+    instead of computing the contrast again.
+    threshold_z and cluster_threshold may be lists: maps and figures are produced for
+    every combination from a single z-map. If alphas (float or list) is given,
+    FDR-corrected maps are also produced for every alpha / cluster size combination.
+    Figures are handed to renderer (a rendering.FigureRenderer, rendering inline if None),
+    which can run them in parallel, restrict the figure kinds and skip up-to-date figures.
+    Clusters are labelled once for all thresholds (clusters.ClusterSweep), and a cluster
+    table is saved as TSV next to the figures of every threshold.
     """
     # build file and folder names based on experiment arguments
     subject_id, session, task = exp_args['subject'], exp_args['session'], exp_args['task']
@@ -95,26 +161,34 @@ def plot_contrast(exp_args, fmri_glm, contrast_name, contrast_vector,
                                       f"sub-{subject_id:02d}_ses-{session}",
                                       "contrasts")
     
+    # Stat maps are saved next to the GLM outputs; figures are rendered from these files
+    folder_maps = os.path.join(path2root, "output", "stat_maps", os.path.basename(os.path.dirname(folder_figures)))
+    
     print("Plotting images...") 
     os.makedirs(folder_figures, exist_ok=True)
     print(f"  Saving Contrast images to {folder_figures}...")
 
-    # Plot design matrix
-    print(f"Plotting contrast: {contrast_name}...")
-    contrast_vector = np.array(contrast_vector)  # Ensure it's a numpy array
+    own_renderer = renderer is None
+    if own_renderer:
+        renderer = FigureRenderer(n_jobs=1)
 
-    fn_contrast_matrix = f"contrast_matrix_{fn_base}.png"
-    cm_plot_path = os.path.join(folder_figures,  fn_contrast_matrix)
-    plot_contrast_matrix_to_file(contrast_vector, fmri_glm.design_matrices_[0], cm_plot_path)
-    
+    contrast_vector = np.array(contrast_vector)  # Ensure it's a numpy array
     
     # Compute and plot statistical maps
     print("Computing and plotting statistical maps...")
     # Compute z-map
-    z_map = fmri_glm.compute_contrast(contrast_vector, output_type="z_score")
-    print(f"  Z-map computed for contrast: {contrast_name}")
+    if z_map is None:
+        z_map = fmri_glm.compute_contrast(contrast_vector, output_type="z_score")
+        print(f"  Z-map computed for contrast: {contrast_name}")
+    z_map_file = save_img_if_changed(z_map, os.path.join(folder_maps, f"z_map_{fn_base}.nii.gz"))
+
+    # Plot contrast matrix (redrawn whenever the z-map, and so the weights, change)
+    print(f"Plotting contrast: {contrast_name}...")
+    fn_contrast_matrix = f"contrast_matrix_{fn_base}.png"
+    cm_plot_path = os.path.join(folder_figures,  fn_contrast_matrix)
+    renderer.submit("contrast_matrix", z_map_file, cm_plot_path,
+                    contrast_vector=contrast_vector, design_matrix=fmri_glm.design_matrices_[0])
 
-    #fdr_corrected_map, threshold = threshold_stats_img(...alpha..)
     # Plot stat map
     stat_map_plotting_config = {"bg_img": mean_func_img, 
                                 "display_mode": "z", 
@@ -123,16 +197,6 @@ def plot_contrast(exp_args, fmri_glm, contrast_name, contrast_vector,
                                 "symmetric_cbar": True,
                                 "cmap": "cold_hot"}
     
-    title_stat_map = (f"{contrast_name} (thresh: {threshold_z:.3f}; clusters > {cluster_threshold} voxels)")
-    
-    stat_map_filepath = os.path.join(folder_figures, f"stat_map_threshold_z_{threshold_z}_{fn_base}.png")
-    plot_stat_map(z_map, threshold=threshold_z, 
-                  title=title_stat_map,
-                  figure=plt.figure(figsize=(10, 4)), 
-                  output_file=stat_map_filepath,
-                  **stat_map_plotting_config)
-    print(f"  Statistical map saved to {stat_map_filepath}")
-
     # Plot glass brain
     glass_brain_plotting_config = {"display_mode": "lyrz", 
                                    "plot_abs": False,
@@ -142,38 +206,62 @@ def plot_contrast(exp_args, fmri_glm, contrast_name, contrast_vector,
                                    "annotate": True, 
                                    "draw_cross": False, 
                                    "black_bg": False}
-    
-    fn_glass_brain = f"glass_brain_threshold_z_{threshold_z}_{fn_base}.png"
-    glass_brain_filepath = os.path.join(folder_figures, fn_glass_brain)
-    plot_glass_brain(z_map, threshold=threshold_z, 
-                     title=title_stat_map,
-                     output_file=glass_brain_filepath,
-                     **glass_brain_plotting_config)
-    print(f"  Glass brain plot saved to {glass_brain_filepath}")
 
+    surf_plotting_config = {"views": ["lateral", "medial"],
+                            "hemispheres": ["left", "right"],
+                            "bg_on_data": True,
+                            "colorbar": True,
+                            "cmap": 'cold_hot',
+                            "inflate": True}
+    # Surface figures share one volume-to-surface projection per mesh, built once and stored here
+    projection_dir = os.path.join(path2root, "output", "surface_projections")
 
-    fn_surf_brain = f"surf_brain_threshold_z_{threshold_z}_{fn_base}.png"
-    
-    plot_img_on_surf(
-    stat_map=z_map,
-    views=["lateral", "medial"],
-    hemispheres=["left", "right"],
-    bg_on_data=True,
-    threshold=threshold_z,
-    colorbar=True,
-    cmap='cold_hot',
-    inflate=True,
-    output_file=os.path.join(folder_figures, f"{fn_surf_brain}.png"))
-    
-    surf_brain_filepath = os.path.join(folder_figures, fn_surf_brain)
-    view=view_img_on_surf(z_map, 
-                     threshold=threshold_z,
-                     surf_mesh='fsaverage')
-    
-    view.save_as_html(f"{surf_brain_filepath}.html")
+    # The z-map is computed once; every threshold / cluster size combination reuses it,
+    # and its clusters at every threshold come from one sweep.
+    # The cluster size only goes into file names when several are being compared.
+    cluster_sweep = ClusterSweep(z_map, as_list(threshold_z))
+    cluster_thresholds = as_list(cluster_threshold)
+    tag_cluster = len(cluster_thresholds) > 1
+    for current_threshold_z, current_cluster_threshold in product(as_list(threshold_z),
+                                                                  cluster_thresholds):
+        fn_threshold = f"threshold_z_{current_threshold_z}_{fn_base}"
+        if tag_cluster:
+            fn_threshold = f"threshold_z_{current_threshold_z}_cluster_{current_cluster_threshold}_{fn_base}"
+        thresholded_map = cluster_sweep.thresholded_img(current_threshold_z, current_cluster_threshold)
+        thresholded_map_file = save_img_if_changed(thresholded_map,
+                                                   os.path.join(folder_maps, f"{fn_threshold}.nii.gz"))
+        save_cluster_table(cluster_sweep.cluster_table(current_threshold_z, current_cluster_threshold),
+                           os.path.join(folder_figures, f"clusters_{fn_threshold}.tsv"))
+        title_stat_map = (f"{contrast_name} (thresh: {current_threshold_z:.3f}; "
+                          f"clusters > {current_cluster_threshold} voxels)")
 
+        renderer.submit("stat_map", thresholded_map_file,
+                        os.path.join(folder_figures, f"stat_map_{fn_threshold}.png"),
+                        threshold=current_threshold_z, title=title_stat_map, figsize=(10, 4),
+                        **stat_map_plotting_config)
+        renderer.submit("glass_brain", thresholded_map_file,
+                        os.path.join(folder_figures, f"glass_brain_{fn_threshold}.png"),
+                        threshold=current_threshold_z, title=title_stat_map,
+                        **glass_brain_plotting_config)
 
-    
-    
-    plt.close('all')
+        surf_brain_filepath = os.path.join(folder_figures, f"surf_brain_{fn_threshold}")
+        renderer.submit("surf_png", thresholded_map_file, f"{surf_brain_filepath}.png",
+                        threshold=current_threshold_z, projection_dir=projection_dir,
+                        **surf_plotting_config)
+        renderer.submit("surf_html", thresholded_map_file, f"{surf_brain_filepath}.html",
+                        threshold=current_threshold_z, surf_mesh='fsaverage',
+                        projection_dir=projection_dir)
+
+    # FDR-corrected maps for every alpha, again from the same z-map
+    if alphas is not None:
+        compute_threshold_plot_stat_maps_to_file(fmri_glm, contrast_vector,
+                                                 contrast_name, contrast_name,
+                                                 mean_func_img,
+                                                 alphas, cluster_threshold,
+                                                 Path(folder_figures) / f"fdr_{fn_base}",
+                                                 z_map=z_map,
+                                                 renderer=renderer,
+                                                 folder_maps=folder_maps)
 
+    if own_renderer:
+        renderer.close()
@@ -0,0 +1,411 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import product
+
+from parser import parse_batch_arguments, get_glm_params
+
+
+def _fn_base(params):
+    return f"sub-{params['subject']:02d}_ses-{params['session']}_task-{params['task']}"
+
+
+def _exp_params(params):
+    return {'subject': params['subject'],
+            'session': params['session'],
+            'task': params['task'],
+            'num_runs': params['num_runs']}
+
+
+def _run_ids(params):
+    return list(range(1, params['num_runs'] + 1)) if params['num_runs'] else []
+
+
+# ==============================================================================
+# Stage functions. Each runs in a worker process, reads its upstream artifacts
+# from disk and returns a small JSON-serializable dict describing its outputs.
+# ==============================================================================
+def stage_events(params, inputs):
+    """Regenerates the event TSV files of one subject whose run CSVs changed."""
+    from create_event_tsv_files import create_all_event_files_for_subject
+
+    n_written, n_up_to_date = create_all_event_files_for_subject(params['subject'])
+    return {'n_written': n_written, 'n_up_to_date': n_up_to_date}
+
+
+def stage_load(params, inputs):
+    """Loads the BIDS data of one subject/task and computes its mean functional image."""
+    from mean_image import subject_mean_img
+    from utils import load_BIDS_data
+
+    dict_BIDS_data = load_BIDS_data(_exp_params(params), _run_ids(params),
+                                    params['path2root'], load_confounds=True)
+
+    path2artifacts = os.path.join(params['work_dir'], "artifacts")
+    os.makedirs(path2artifacts, exist_ok=True)
+    data_file = os.path.join(path2artifacts, f"data_{_fn_base(params)}.pkl")
+    with open(data_file, 'wb') as f:
+        pickle.dump(dict_BIDS_data, f)
+
+    mean_img_file = os.path.join(path2artifacts, f"mean_func_{_fn_base(params)}.nii.gz")
+    subject_mean_img(dict_BIDS_data["fns_func"],
+                     os.path.join(params['path2root'], "output", "mean_images")).to_filename(mean_img_file)
+    return {'data_file': data_file, 'mean_img': mean_img_file}
+
+
+def _load_model(params, data_file):
+    """Loads the fitted model; fit_GLM's content-addressed cache makes repeat calls cheap."""
+    from analyses import fit_GLM
+
+    with open(data_file, 'rb') as f:
+        dict_BIDS_data = pickle.load(f)
+    return fit_GLM(_exp_params(params),
+                   dict_BIDS_data['fns_func'],
+                   dict_BIDS_data['dfs_events'],
+                   dict_BIDS_data['dfs_confounds'],
+                   params['glm_params'],
+                   params['path2root'],
+                   save_model=True,
+                   store_format="arrays")
+
+
+def stage_fit(params, inputs):
+    """Fits (or finds in the cache) the GLM of one subject/task."""
+    _load_model(params, inputs['load']['data_file'])
+    return {}
+
+
+def stage_contrasts(params, inputs):
+    """Computes the z-maps of all contrasts of one subject/task in one batched pass."""
+    from contrasts import ContrastManager
+    from multi_contrast import compute_contrasts_batch
+
+    model_glm = _load_model(params, inputs['load']['data_file'])
+    manager = ContrastManager(params['contrast_file'])
+    contrast_names = params['contrast_names']
+    contrast_matrix = manager.get_matrix(contrast_names, model_glm.design_matrices_[0].columns)
+    z_maps = compute_contrasts_batch(model_glm, contrast_matrix, contrast_names)
+
+    folder_z_maps = os.path.join(params['work_dir'], "z_maps", _fn_base(params))
+    os.makedirs(folder_z_maps, exist_ok=True)
+    z_map_files = {}
+    for contrast_name, z_map in z_maps.items():
+        z_map_files[contrast_name] = os.path.join(folder_z_maps, f"contrast-{contrast_name}_z_map.nii.gz")
+        z_map.to_filename(z_map_files[contrast_name])
+    return {'z_maps': z_map_files}
+
+
+def _figures_dir(params):
+    return os.path.join(params['path2root'], "figures",
+                        f"sub-{params['subject']:02d}_ses-{params['session']}", "contrasts")
+
+
+def stage_threshold(params, inputs):
+    """
+    FDR/cluster-thresholds one z-map at every alpha of the sweep: the FDR thresholds of all
+    alphas are computed together and one cluster sweep labels the clusters at all of them
+    (see clusters.ClusterSweep). A cluster table per alpha is saved next to the figures.
+    """
+    from clusters import ClusterSweep, fdr_thresholds, save_cluster_table
+
+    z_map_file = inputs['contrasts']['z_maps'][params['contrast_name']]
+    thresholds = fdr_thresholds(z_map_file, params['alphas'])
+    cluster_sweep = ClusterSweep(z_map_file, list(thresholds.values()))
+
+    fn_base = f"contrast-{params['contrast_name']}_{_fn_base(params)}"
+    results = {}
+    for alpha, threshold in thresholds.items():
+        thresholded_file = z_map_file.replace("_z_map.nii.gz", f"_alpha{alpha}_thresholded.nii.gz")
+        cluster_sweep.thresholded_img(threshold, params['cluster_threshold']).to_filename(thresholded_file)
+        cluster_table_file = save_cluster_table(
+            cluster_sweep.cluster_table(threshold, params['cluster_threshold']),
+            os.path.join(_figures_dir(params), f"clusters_alpha{alpha}_{fn_base}.tsv"))
+        results[str(alpha)] = {'thresholded_map': thresholded_file, 'threshold': float(threshold),
+                               'cluster_table': cluster_table_file}
+    return {'alphas': results}
+
+
+def stage_figures(params, inputs):
+    """
+    Plots the stat map and glass brain of one thresholded map through a FigureRenderer, like
+    main_fMRI_analysis: only the selected figure kinds, skipping figures newer than the map.
+    """
+    from rendering import FigureRenderer
+    from viz import submit_thresholded_figures
+
+    thresholded = inputs['threshold']['alphas'][str(params['alpha'])]
+    threshold = thresholded['threshold']
+    fn_base = f"contrast-{params['contrast_name']}_{_fn_base(params)}"
+    folder_figures = _figures_dir(params)
+    os.makedirs(folder_figures, exist_ok=True)
+    title = (f"{params['contrast_name']} (p<{params['alpha']:.3f} FDR; thresh: {threshold:.3f}; "
+             f"clusters > {params['cluster_threshold']} voxels)")
+
+    with FigureRenderer(n_jobs=1, figure_kinds=params['figure_kinds'],
+                        skip_up_to_date=not params['force_figures']) as renderer:
+        figures = submit_thresholded_figures(
+            renderer, thresholded['thresholded_map'], threshold, title, inputs['load']['mean_img'],
+            os.path.join(folder_figures, f"stat_map_alpha{params['alpha']}_{fn_base}.png"),
+            os.path.join(folder_figures, f"glass_brain_alpha{params['alpha']}_{fn_base}.png"))
+    if renderer.failures:
+        output_file, error = renderer.failures[0]
+        raise RuntimeError(f"Rendering {len(renderer.failures)} figure(s) failed, e.g. {output_file}: {error}")
+    return {'figures': figures}
+
+
+# Stages in dependency order: events -> load -> fit -> contrasts -> threshold -> figures
+STAGE_FUNCTIONS = {
+    "events": stage_events,
+    "load": stage_load,
+    "fit": stage_fit,
+    "contrasts": stage_contrasts,
+    "threshold": stage_threshold,
+    "figures": stage_figures,
+}
+
+
+# ==============================================================================
+# Graph construction and scheduling
+# ==============================================================================
+def parse_task_specs(task_specs, contrast_file):
+    """
+    Groups 'task,num_runs,contrast_name' specs by (task, num_runs).
+    A contrast name of 'all' expands to every contrast in the contrast file, and a
+    glob pattern (e.g. 'real > pseudo*') to the contrasts it matches.
+    """
+    from contrasts import ContrastManager
+
+    manager = ContrastManager(contrast_file)
+    tasks = {}
+    for task_spec in task_specs:
+        task, num_runs, contrast_name = [part.strip() for part in task_spec.split(',', 2)]
+        tasks.setdefault((task, int(num_runs)), []).extend(manager.resolve(contrast_name))
+    return tasks
+
+
+def check_sweep_inputs(subjects, session, tasks, path2root, make_events=False):
+    """
+    Lists the input files of a sweep that are missing. Event files are not required
+    if they are regenerated by the events stage.
+    """
+    from bids_layout import get_layout
+    from utils import check_BIDS_data
+
+    layout = get_layout(path2root)
+    missing = []
+    for subject, (task, num_runs) in product(subjects, tasks):
+        exp_params = {'subject': subject, 'session': session, 'task': task}
+        run_ids = _run_ids({'num_runs': num_runs})
+        missing.extend(check_BIDS_data(exp_params, run_ids, path2root, load_confounds=True, layout=layout))
+    if make_events:
+        missing = [path for path in missing if not path.endswith("_events.tsv")]
+    return missing
+
+
+def expand_sweep(subjects, session, tasks, alphas, cluster_threshold, glm_params,
+                 contrast_file, path2root, work_dir, make_events=False, figure_kinds=None,
+                 force_figures=False):
+    """
+    Expands a subjects x tasks x contrasts x alphas sweep into a graph of stage nodes.
+    Figure nodes are only added if figure_kinds (default: all) includes a kind they draw.
+
+    Returns:
+        dict: node_id -> {'stage', 'params', 'deps'}, where deps are upstream node ids.
+    """
+    nodes = {}
+    draw_figures = figure_kinds is None or bool({"stat_map", "glass_brain"} & set(figure_kinds))
+
+    def add_node(stage, params, deps, *id_parts):
+        node_id = ":".join([stage] + [str(part) for part in id_parts])
+        nodes[node_id] = {'stage': stage, 'params': params, 'deps': deps}
+        return node_id
+
+    for subject in subjects:
+        events_deps = [add_node("events", {'subject': subject}, [], f"sub-{subject:02d}")] if make_events else []
+        for (task, num_runs), contrast_names in tasks.items():
+            base = {'subject': subject, 'session': session, 'task': task, 'num_runs': num_runs,
+                    'path2root': path2root, 'work_dir': work_dir, 'glm_params': glm_params}
+            key = (f"sub-{subject:02d}", f"task-{task}", f"runs-{num_runs}")
+            load_id = add_node("load", base, events_deps, *key)
+            fit_id = add_node("fit", base, [load_id], *key)
+            contrasts_id = add_node("contrasts",
+                                    dict(base, contrast_names=contrast_names, contrast_file=contrast_file),
+                                    [load_id, fit_id], *key)
+            for contrast_name in contrast_names:
+                # One threshold node per z-map covers all alphas; figures are drawn per alpha
+                threshold_id = add_node("threshold",
+                                        dict(base, contrast_name=contrast_name, alphas=list(alphas),
+                                             cluster_threshold=cluster_threshold),
+                                        [contrasts_id], *key, contrast_name)
+                for alpha in (alphas if draw_figures else []):
+                    params = dict(base, contrast_name=contrast_name, alpha=alpha,
+                                  cluster_threshold=cluster_threshold, figure_kinds=figure_kinds,
+                                  force_figures=force_figures)
+                    add_node("figures", params, [load_id, threshold_id],
+                             *key, contrast_name, f"alpha-{alpha}")
+    return nodes
+
+
+def _run_node(stage, params, inputs):
+    """Worker entry point: runs one stage and times it."""
+    t_start = time.perf_counter()
+    result = STAGE_FUNCTIONS[stage](params, inputs)
+    return result, time.perf_counter() - t_start
+
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def node_keys(nodes):
+    """
+    Content keys of the nodes: a hash of the node id, its parameters, the contents of
+    its contrast file (if any) and the keys of its upstream nodes. Changing a parameter
+    (GLM, threshold, contrast definitions, ...) therefore changes the key of the node and
+    of everything downstream of it, so stale completed nodes are not reused.
+
+    Nodes must be in dependency order, as expand_sweep returns them.
+    """
+    keys = {}
+    file_hashes = {}
+    for node_id, node in nodes.items():
+        params = node['params']
+        contents = {}
+        if 'contrast_file' in params:
+            path = params['contrast_file']
+            if path not in file_hashes:
+                file_hashes[path] = _file_hash(path)
+            contents['contrast_file'] = file_hashes[path]
+        keys[node_id] = hashlib.sha256(json.dumps(
+            {'id': node_id, 'params': params, 'contents': contents,
+             'deps': [keys[dep] for dep in node['deps']]},
+            sort_keys=True, default=str).encode()).hexdigest()
+    return keys
+
+
+def _inputs_hash(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _state_file(state_dir, stage, node_key):
+    return os.path.join(state_dir, f"{stage}_{node_key[:32]}.json")
+
+
+def _load_state(state_file, inputs):
+    """The recorded result of a node, or None if it is missing or its upstream results changed."""
+    if not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(state, dict) or state.get('inputs_hash') != _inputs_hash(inputs):
+        return None
+    return state['result']
+
+
+def run_graph(nodes, state_dir, n_jobs=1, restart=False):
+    """
+    Runs the graph on a process pool, starting every node whose dependencies are done.
+
+    Completed nodes are recorded in state_dir under their content key (see node_keys)
+    together with a hash of their upstream results, so a crashed or interrupted sweep
+    resumes from where it stopped while nodes whose parameters or inputs changed are
+    recomputed. A failing node skips its downstream nodes only.
+
+    Returns:
+        tuple: (results of completed nodes, set of failed or skipped node ids)
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    keys = node_keys(nodes)
+    done = {}
+    n_resumed = 0
+    pending = list(nodes)
+    failed = set()
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for node_id in list(pending):
+                    node = nodes[node_id]
+                    if any(dep in failed for dep in node['deps']):
+                        print(f"  Skipping {node_id}: an upstream node failed.")
+                        failed.add(node_id)
+                        pending.remove(node_id)
+                        progress = True
+                    elif all(dep in done for dep in node['deps']):
+                        inputs = {nodes[dep]['stage']: done[dep] for dep in node['deps']}
+                        pending.remove(node_id)
+                        result = None if restart else _load_state(
+                            _state_file(state_dir, node['stage'], keys[node_id]), inputs)
+                        if result is not None:
+                            # Completed in an earlier sweep with the same parameters and inputs
+                            done[node_id] = result
+                            n_resumed += 1
+                            progress = True
+                            continue
+                        future = pool.submit(_run_node, node['stage'], node['params'], inputs)
+                        running[future] = (node_id, inputs)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node_id, inputs = running.pop(future)
+                try:
+                    result, seconds = future.result()
+                except Exception:
+                    print(f"ERROR: Node {node_id} failed:\n{traceback.format_exc()}")
+                    failed.add(node_id)
+                    continue
+                done[node_id] = result
+                with open(_state_file(state_dir, nodes[node_id]['stage'], keys[node_id]), 'w') as f:
+                    json.dump({'node_id': node_id, 'inputs_hash': _inputs_hash(inputs), 'result': result}, f)
+                print(f"  Done {node_id} ({seconds:.1f} s) [{len(done)}/{len(nodes)}]")
+
+    if n_resumed:
+        print(f"Resumed {n_resumed} of {len(nodes)} nodes completed with the same parameters and inputs.")
+    return done, failed
+
+
+def main(argv=None):
+    args = parse_batch_arguments(argv)
+    path2root = os.path.abspath(args.path2root)
+    work_dir = os.path.join(path2root, "output", "batch")
+
+    task_specs = args.task_spec or ["swp,6,all"]
+    tasks = parse_task_specs(task_specs, args.contrast_file)
+    nodes = expand_sweep(args.subjects, args.session, tasks, args.alphas, args.cluster_threshold,
+                         get_glm_params(args), os.path.abspath(args.contrast_file),
+                         path2root, work_dir, make_events=args.make_events,
+                         figure_kinds=args.figure_kinds, force_figures=args.force_figures)
+    print(f"Sweep expanded into {len(nodes)} nodes; running on {args.n_jobs} worker(s)...")
+
+    # Validate the whole sweep against the BIDS layout index before any heavy work starts
+    missing = check_sweep_inputs(args.subjects, args.session, tasks, path2root, make_events=args.make_events)
+    if missing:
+        print(f"ERROR: {len(missing)} input file(s) missing, e.g.:")
+        for path in missing[:10]:
+            print(f"  {path}")
+        return 1
+
+    t_start = time.perf_counter()
+    done, failed = run_graph(nodes, os.path.join(work_dir, "state"), args.n_jobs, args.restart)
+    print(f"Completed {len(done)} of {len(nodes)} nodes in {time.perf_counter() - t_start:.1f} s.")
+    if failed:
+        print(f"ERROR: {len(failed)} nodes failed or were skipped. Re-run to resume.")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    raise SystemExit(main())
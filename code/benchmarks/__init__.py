@@ -0,0 +1,6 @@
+"""
+Benchmarks of the analysis pipeline on synthetic, SWP-shaped BIDS derivatives.
+
+Run from the code folder:
+    python -m benchmarks.run_benchmarks --scales small medium
+"""
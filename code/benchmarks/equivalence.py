@@ -0,0 +1,106 @@
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+# The re-implemented estimators must reproduce FirstLevelModel.compute_contrast within these
+# bounds on the z-maps. AR(1) coefficients are binned to 0.01 as in nilearn; a voxel whose
+# coefficient lies on a bin edge can fall into the neighbouring bin through rounding, which
+# moves its z by up to a few hundredths, so the maximum has a looser bound than the
+# 99.9th percentile.
+Z_TOLERANCE_P999 = 1e-3
+Z_TOLERANCE_MAX = 0.05
+
+# Contrasts of contrasts.json compared, the first ones that compile on the design
+N_CONTRASTS = 5
+
+
+def _contrasts(design_columns, n_contrasts=N_CONTRASTS):
+    from contrasts import ContrastManager
+    from create_contrast import compile_contrast_rules
+
+    manager = ContrastManager(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           "contrasts.json"))
+    columns = list(design_columns)
+    _, errors = compile_contrast_rules(manager.list_contrasts(), columns)
+    contrast_names = [name for name in manager.list_contrasts() if name not in errors][:n_contrasts]
+    return contrast_names, manager.get_matrix(contrast_names, columns)
+
+
+def compare_estimators(work_dir, description, memory_budget_mb=256):
+    """
+    Fits the first subject of a synthetic dataset with FirstLevelModel and with every
+    engine that re-implements it, and compares their z-maps with
+    FirstLevelModel.compute_contrast.
+
+    Engines: 'stored' (glm_store arrays of the fitted model), 'chunked' (chunked_glm voxel
+    blocks) and 'runs' (run_stats sufficient statistics).
+
+    Returns:
+        dict: engine -> {'max_abs_dz', 'p999_abs_dz', 'passed'}
+    """
+    from nilearn.glm.first_level import FirstLevelModel
+
+    from benchmarks.run_benchmarks import _exp_params, _load
+    from chunked_glm import fit_chunked_glm
+    from glm_store import StoredGLM, save_glm_store
+    from multi_contrast import compute_contrasts_batch
+    from parser import default_glm_params
+    from run_stats import fit_run_stats_glm
+
+    description = dict(description, n_subjects=1)
+    dict_BIDS_data = _load(work_dir, description)
+    fns_func, dfs_events, dfs_confounds = (dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                                           dict_BIDS_data['dfs_confounds'])
+    glm_params = default_glm_params()
+    path2check = os.path.join(work_dir, "output", "equivalence")
+    shutil.rmtree(path2check, ignore_errors=True)
+
+    t_start = time.perf_counter()
+    reference_glm = FirstLevelModel(**glm_params).fit(fns_func, dfs_events, dfs_confounds)
+    contrast_names, contrast_matrix = _contrasts(reference_glm.design_matrices_[0].columns)
+    reference = np.stack([reference_glm.masker_.transform(
+        reference_glm.compute_contrast(contrast, output_type="z_score")).ravel() for contrast in contrast_matrix])
+
+    save_glm_store(reference_glm, os.path.join(path2check, "stored"))
+    exp_params = _exp_params(description)
+    engines = {
+        'stored': StoredGLM(os.path.join(path2check, "stored")),
+        'chunked': fit_chunked_glm(fns_func, dfs_events, dfs_confounds, glm_params,
+                                   os.path.join(path2check, "chunked"), memory_budget_mb * 1024**2),
+        'runs': fit_run_stats_glm(f"sub-{exp_params['subject']:02d}_ses-{exp_params['session']}_task-{exp_params['task']}",
+                                  fns_func, dfs_events, dfs_confounds, glm_params,
+                                  os.path.join(path2check, "runs")),
+    }
+
+    comparison = {}
+    for engine, fmri_glm in engines.items():
+        z_maps = compute_contrasts_batch(fmri_glm, contrast_matrix, contrast_names, as_4d=True)
+        abs_dz = np.abs(reference_glm.masker_.transform(z_maps) - reference)
+        comparison[engine] = {'max_abs_dz': float(abs_dz.max()),
+                              'p999_abs_dz': float(np.percentile(abs_dz, 99.9))}
+        comparison[engine]['passed'] = (comparison[engine]['p999_abs_dz'] <= Z_TOLERANCE_P999
+                                        and comparison[engine]['max_abs_dz'] <= Z_TOLERANCE_MAX)
+    shutil.rmtree(path2check, ignore_errors=True)
+    print(f"  Compared {len(contrast_names)} contrasts of {len(engines)} engines with FirstLevelModel "
+          f"in {time.perf_counter() - t_start:.1f} s")
+    return comparison
+
+
+def check_equivalence(results):
+    """
+    Returns:
+        list: (scale, engine, max |dz|, 99.9th percentile |dz|) of the engines whose z-maps
+              differ from FirstLevelModel by more than the tolerances.
+    """
+    failures = []
+    for scale_name, scale_results in results['scales'].items():
+        for engine, metrics in scale_results.get('equivalence', {}).items():
+            status = "ok" if metrics['passed'] else "MISMATCH"
+            print(f"  {scale_name}/{engine:<8} max |dz| {metrics['max_abs_dz']:.2e}  "
+                  f"p99.9 |dz| {metrics['p999_abs_dz']:.2e}  {status}")
+            if not metrics['passed']:
+                failures.append((scale_name, engine, metrics['max_abs_dz'], metrics['p999_abs_dz']))
+    return failures
@@ -0,0 +1,331 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+
+# Dataset sizes; every scale is one subject/task unless --n-subjects is given
+SCALES = {
+    "tiny": {'resolution': 8, 'n_subjects': 1, 'n_runs': 1, 'n_volumes': 60},
+    "small": {'resolution': 8, 'n_subjects': 1, 'n_runs': 2, 'n_volumes': None},
+    "medium": {'resolution': 4, 'n_subjects': 1, 'n_runs': 6, 'n_volumes': None},
+    "large": {'resolution': 2, 'n_subjects': 1, 'n_runs': 6, 'n_volumes': None},
+}
+
+# Command lines of main_fMRI_analysis.py whose start-up time is measured; they must stay
+# under STARTUP_BUDGET_SECONDS, since shell loops launch them many times
+STARTUP_COMMANDS = {
+    "startup_help": ["--help"],
+    "startup_list_contrasts": ["--list-contrasts"],
+}
+STARTUP_BUDGET_SECONDS = 1.0
+
+# Pipeline stages in the order they run; later stages reuse the model the "fit_glm" stage stores
+STAGES = list(STARTUP_COMMANDS) + ["events", "load", "fit_glm", "fit_glm_chunked", "contrasts", "plot_contrast"]
+
+# Memory budget of the "fit_glm_chunked" stage; its peak RSS should stay flat across scales
+CHUNKED_MEMORY_BUDGET_MB = 256
+
+# Figure kinds rendered by the plot_contrast stage; surface figures need fsaverage downloads
+PLOT_FIGURE_KINDS = ["contrast_matrix", "stat_map", "glass_brain"]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size of this process (or its largest child) in MB (ru_maxrss is in bytes on macOS, KB elsewhere)."""
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def prepare_dataset(work_dir, scale, seed=0):
+    """Generates the synthetic dataset of a scale, unless one with the same parameters exists."""
+    from benchmarks.synthetic import make_synthetic_dataset
+
+    description_file = os.path.join(work_dir, "data", "derivatives", "synthetic.json")
+    if os.path.exists(description_file):
+        with open(description_file, 'r') as f:
+            description = json.load(f)
+        # Datasets from before volumes_per_run was recorded are regenerated
+        if all(description.get(key) == value for key, value in scale.items() if key != 'n_volumes') \
+                and 'volumes_per_run' in description and description['volumes_per_run'] == scale['n_volumes'] \
+                and description.get('seed') == seed:
+            return description
+    t_start = time.perf_counter()
+    description = make_synthetic_dataset(work_dir, n_subjects=scale['n_subjects'], n_runs=scale['n_runs'],
+                                         resolution=scale['resolution'], n_volumes=scale['n_volumes'],
+                                         seed=seed)
+    print(f"  Generated {description['n_voxels']} voxels x {sum(description['n_volumes'])} volumes "
+          f"({description['n_bytes'] / 1024**2:.0f} MB) in {time.perf_counter() - t_start:.1f} s")
+    return description
+
+
+def _exp_params(description):
+    subjects = list(range(1, description['n_subjects'] + 1))
+    return {'subject': subjects[0] if len(subjects) == 1 else subjects,
+            'session': description['session'],
+            'task': description['task'],
+            'num_runs': description['n_runs']}
+
+
+def _load(work_dir, description):
+    from utils import load_BIDS_data
+
+    run_ids = list(range(1, description['n_runs'] + 1))
+    return load_BIDS_data(_exp_params(description), run_ids, work_dir, load_confounds=True)
+
+
+def _stored_model(work_dir, description, dict_BIDS_data):
+    from analyses import fit_GLM
+    from parser import default_glm_params
+
+    return fit_GLM(_exp_params(description), dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                   dict_BIDS_data['dfs_confounds'], default_glm_params(), work_dir,
+                   save_model=True, store_format="arrays")
+
+
+def _compiled_contrasts(model_glm):
+    """Names and C x P matrix of every rule of contrasts.json that compiles on the design."""
+    from contrasts import ContrastManager
+    from create_contrast import compile_contrast_rules
+
+    manager = ContrastManager(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           "contrasts.json"))
+    columns = list(model_glm.design_matrices_[0].columns)
+    _, errors = compile_contrast_rules(manager.list_contrasts(), columns)
+    contrast_names = [name for name in manager.list_contrasts() if name not in errors]
+    return contrast_names, manager.get_matrix(contrast_names, columns)
+
+
+def run_stage(stage, work_dir, description, repeats):
+    """
+    Times one stage. Runs in a fresh process, so the peak RSS belongs to this stage (and
+    its untimed setup, e.g. memory-mapping the stored model) only.
+
+    Returns:
+        dict: 'seconds' (one per repeat) and 'peak_rss_mb'
+    """
+    if stage in STARTUP_COMMANDS:
+        command = [sys.executable, "main_fMRI_analysis.py"] + STARTUP_COMMANDS[stage]
+        seconds = []
+        for _ in range(repeats):
+            t_start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            seconds.append(time.perf_counter() - t_start)
+        return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+
+    import profiling
+
+    # The process was spawned from the benchmark driver, whose high-water mark it inherits
+    # (ru_maxrss survives fork and exec on Linux), so the peak is reset and read here
+    with profiling.measure(stage) as measurement:
+        run = _prepare_stage(stage, work_dir, description)
+        seconds = []
+        for _ in range(repeats):
+            t_start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - t_start)
+    return {'seconds': seconds, 'peak_rss_mb': measurement.record['peak_rss_mb']}
+
+
+def _prepare_stage(stage, work_dir, description):
+    """Untimed setup of a stage; returns the function whose repeats are timed."""
+    if stage == "events":
+        import pandas as pd
+        from benchmarks.synthetic import SOURCE_SUBJECTS
+        from create_event_tsv_files import LOCALIZERS, build_main_events, get_event_sources
+
+        def run():
+            for sub_num in SOURCE_SUBJECTS:
+                for kind, source in get_event_sources(sub_num).values():
+                    raw_df = pd.read_csv(source)
+                    if kind == 'main':
+                        build_main_events(raw_df, f"sub{sub_num:02d}")
+                    else:
+                        LOCALIZERS[kind][1](raw_df)
+    elif stage == "load":
+        def run():
+            _load(work_dir, description)
+    elif stage == "fit_glm":
+        from analyses import fit_GLM
+        from parser import default_glm_params
+        dict_BIDS_data = _load(work_dir, description)
+
+        def run():
+            fit_GLM(_exp_params(description), dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                    dict_BIDS_data['dfs_confounds'], default_glm_params(), work_dir, save_model=False)
+    elif stage == "fit_glm_chunked":
+        from chunked_glm import fit_chunked_glm
+        from parser import default_glm_params
+        dict_BIDS_data = _load(work_dir, description)
+
+        def run():
+            fit_chunked_glm(dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                            dict_BIDS_data['dfs_confounds'], default_glm_params(),
+                            os.path.join(work_dir, "output", "chunked_glm"),
+                            memory_budget=CHUNKED_MEMORY_BUDGET_MB * 1024**2)
+    elif stage == "contrasts":
+        from multi_contrast import compute_contrasts_batch
+        model_glm = _stored_model(work_dir, description, _load(work_dir, description))
+        contrast_names, contrast_matrix = _compiled_contrasts(model_glm)
+
+        def run():
+            compute_contrasts_batch(model_glm, contrast_matrix, contrast_names, output_type="z_score")
+    elif stage == "plot_contrast":
+        from analyses import plot_contrast
+        from mean_image import subject_mean_img
+        from multi_contrast import compute_contrasts_batch
+        from rendering import FigureRenderer
+        dict_BIDS_data = _load(work_dir, description)
+        model_glm = _stored_model(work_dir, description, dict_BIDS_data)
+        contrast_names, contrast_matrix = _compiled_contrasts(model_glm)
+        z_map = compute_contrasts_batch(model_glm, contrast_matrix[:1], contrast_names[:1])[contrast_names[0]]
+        mean_func_img = subject_mean_img(dict_BIDS_data['fns_func'],
+                                         os.path.join(work_dir, "output", "mean_images"))
+
+        def run():
+            with FigureRenderer(figure_kinds=PLOT_FIGURE_KINDS, skip_up_to_date=False) as renderer:
+                plot_contrast(_exp_params(description), model_glm, contrast_names[0], contrast_matrix[0],
+                              mean_func_img, work_dir, threshold_z=[3.1], cluster_threshold=[10],
+                              z_map=z_map, renderer=renderer)
+    else:
+        raise ValueError(f"Unknown stage '{stage}'. Choose from {STAGES}.")
+    return run
+
+
+def _run_in_process(func, *args):
+    code_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn"),
+                             initializer=os.chdir, initargs=(code_dir,)) as pool:
+        return pool.submit(func, *args).result()
+
+
+def _run_stage_in_process(stage, work_dir, description, repeats):
+    return _run_in_process(run_stage, stage, work_dir, description, repeats)
+
+
+def run_benchmarks(scales, stages=None, repeats=3, work_root=None, seed=0, equivalence=True):
+    """
+    Generates (or reuses) the synthetic dataset of every scale and times every stage on it.
+    With equivalence=True the z-maps of the re-implemented GLM engines are also compared
+    with FirstLevelModel on every scale (see benchmarks.equivalence).
+
+    Returns:
+        dict: 'machine' and, per scale, the dataset description, per stage the best and
+              median wall time of the repeats and the peak RSS, and the 'equivalence'
+              comparison of every engine.
+    """
+    stages = STAGES if stages is None else stages
+    if work_root is None:
+        work_root = os.path.join("..", "output", "benchmarks")
+    results = {'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                           'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+               'scales': {}}
+    for scale_name, scale in scales.items():
+        print(f"Scale '{scale_name}': {scale}")
+        work_dir = os.path.abspath(os.path.join(work_root, scale_name))
+        description = prepare_dataset(work_dir, scale, seed)
+        scale_results = {'dataset': description, 'stages': {}}
+        for stage in stages:
+            timing = _run_stage_in_process(stage, work_dir, description, repeats)
+            scale_results['stages'][stage] = {'best_seconds': min(timing['seconds']),
+                                              'median_seconds': float(np.median(timing['seconds'])),
+                                              'peak_rss_mb': timing['peak_rss_mb']}
+            print(f"  {stage:<14} best {min(timing['seconds']):8.3f} s  "
+                  f"median {np.median(timing['seconds']):8.3f} s  peak RSS {timing['peak_rss_mb']:8.0f} MB")
+        if equivalence:
+            from benchmarks.equivalence import compare_estimators
+            scale_results['equivalence'] = _run_in_process(compare_estimators, work_dir, description,
+                                                           CHUNKED_MEMORY_BUDGET_MB)
+        results['scales'][scale_name] = scale_results
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """
+    Compares best times and peak RSS with a baseline run of the same scales and stages.
+
+    Returns:
+        list: (scale, stage, metric, baseline value, new value) of every metric more than
+              tolerance (relative) above the baseline.
+    """
+    regressions = []
+    print(f"Comparison with the baseline (tolerance {tolerance:.0%}):")
+    for scale_name, scale_results in results['scales'].items():
+        baseline_stages = baseline.get('scales', {}).get(scale_name, {}).get('stages', {})
+        for stage, metrics in scale_results['stages'].items():
+            if stage not in baseline_stages:
+                print(f"  {scale_name}/{stage}: not in the baseline")
+                continue
+            for metric in ('best_seconds', 'peak_rss_mb'):
+                old, new = baseline_stages[stage][metric], metrics[metric]
+                ratio = new / old if old > 0 else np.inf
+                flag = "REGRESSION" if ratio > 1 + tolerance else ""
+                print(f"  {scale_name}/{stage:<14} {metric:<13} {old:10.3f} -> {new:10.3f} ({ratio:5.2f}x) {flag}")
+                if flag:
+                    regressions.append((scale_name, stage, metric, old, new))
+    return regressions
+
+
+def check_startup_budget(results, budget=STARTUP_BUDGET_SECONDS):
+    """
+    Returns:
+        list: (scale, stage, best seconds) of the start-up stages slower than budget.
+    """
+    over_budget = []
+    for scale_name, scale_results in results['scales'].items():
+        for stage, metrics in scale_results['stages'].items():
+            if stage in STARTUP_COMMANDS and metrics['best_seconds'] > budget:
+                over_budget.append((scale_name, stage, metrics['best_seconds']))
+                print(f"  {scale_name}/{stage}: start-up takes {metrics['best_seconds']:.2f} s, "
+                      f"over the {budget:.2f} s budget")
+    return over_budget
+
+
+def main(argv=None):
+    from benchmarks.equivalence import check_equivalence
+    from parser import parse_benchmark_arguments
+
+    args = parse_benchmark_arguments(argv)
+    scales = {name: SCALES[name] for name in args.scales}
+    if args.resolution is not None:
+        scales = {"custom": {'resolution': args.resolution, 'n_subjects': args.n_subjects,
+                             'n_runs': args.n_runs, 'n_volumes': args.n_volumes}}
+    results = run_benchmarks(scales, args.stages, args.repeats, args.work_dir, args.seed,
+                             equivalence=not args.skip_equivalence)
+    over_budget = check_startup_budget(results)
+    print("Equivalence of the GLM engines with FirstLevelModel:")
+    mismatches = check_equivalence(results)
+    if mismatches:
+        print(f"ERROR: {len(mismatches)} engine(s) differ from FirstLevelModel beyond the tolerance.")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 1 if over_budget or mismatches else 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one.")
+        return 1 if over_budget or mismatches else 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.tolerance:.0%}.")
+    return 1 if regressions or over_budget or mismatches else 0
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    raise SystemExit(main())
@@ -0,0 +1,175 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from confounds import MOTION_COLUMNS
+from create_event_tsv_files import (LOCALIZERS, N_MAIN_RUNS, build_main_events,
+                                    get_event_sources)
+
+
+# Repetition time of the SWP acquisitions (same as the --t-r default)
+T_R = 1.81
+
+# Rest after the last trial, so the last responses are in the run
+END_REST = 15.0
+
+# Real run CSVs exist for these subjects; synthetic subjects cycle through them
+SOURCE_SUBJECTS = [1, 2, 3]
+
+# Columns of the synthetic fMRIPrep confound files. Beyond what the confound strategies
+# read, there are CompCor and cosine columns so column-selective reads have something to skip.
+EXTRA_CONFOUND_COLUMNS = ([f"a_comp_cor_{i:02d}" for i in range(20)]
+                          + [f"cosine{i:02d}" for i in range(8)])
+
+# Fraction of the baseline signal added per unit of task regressor, in the activated region
+ACTIVATION = 0.02
+
+
+def source_events(subject_id, task="swp", run_ids=None):
+    """
+    Builds the event tables of a synthetic subject from the real run CSVs, with the
+    builders of create_event_tsv_files. Subject s uses the CSVs of pilot subject
+    SOURCE_SUBJECTS[(s - 1) % 3]; run r beyond the 6 real runs reuses run (r - 1) % 6 + 1.
+
+    Returns:
+        list: One events DataFrame per run (a single one for localizer tasks).
+    """
+    sub_num = SOURCE_SUBJECTS[(subject_id - 1) % len(SOURCE_SUBJECTS)]
+    sources = get_event_sources(sub_num)
+    if task == "swp":
+        events = []
+        for run_id in run_ids:
+            source_run = (run_id - 1) % N_MAIN_RUNS + 1
+            filename = f"sub-{sub_num:02d}_ses-1_task-swp_run-{source_run:02d}_events.tsv"
+            if filename not in sources:
+                raise FileNotFoundError(f"No run CSV for run {source_run} of pilot subject {sub_num}.")
+            events.append(build_main_events(pd.read_csv(sources[filename][1]), f"sub{sub_num:02d}"))
+        return events
+
+    kinds = {localizer_task: kind for kind, (localizer_task, _) in LOCALIZERS.items()}
+    if task not in kinds:
+        raise ValueError(f"Unknown task '{task}'. Choose 'swp' or one of {list(kinds)}.")
+    filename = f"sub-{sub_num:02d}_ses-1_task-{task}_events.tsv"
+    if filename not in sources:
+        raise FileNotFoundError(f"No {task} CSV for pilot subject {sub_num}.")
+    return [LOCALIZERS[kinds[task]][1](pd.read_csv(sources[filename][1]))]
+
+
+def make_confounds(n_volumes, rng):
+    """fMRIPrep-like confounds: random-walk motion, its derivatives, FD, tissue signals and extras."""
+    motion = np.cumsum(rng.normal(scale=0.02, size=(n_volumes, 6)), axis=0)
+    motion[:, 3:] *= 0.01  # rotations are in radians
+    df = pd.DataFrame(motion, columns=MOTION_COLUMNS)
+    for column in MOTION_COLUMNS:
+        df[f"{column}_derivative1"] = df[column].diff()
+    df["framewise_displacement"] = df[MOTION_COLUMNS[:3]].diff().abs().sum(axis=1) \
+        + 50 * df[MOTION_COLUMNS[3:]].diff().abs().sum(axis=1)
+    df["white_matter"] = 400 + rng.normal(scale=5, size=n_volumes)
+    df["csf"] = 800 + rng.normal(scale=10, size=n_volumes)
+    for column in EXTRA_CONFOUND_COLUMNS:
+        df[column] = rng.normal(size=n_volumes)
+    # fMRIPrep leaves the first derivative row empty
+    df.iloc[0, df.columns.get_indexer([c for c in df.columns if c.endswith("_derivative1")])] = np.nan
+    df.loc[0, "framewise_displacement"] = np.nan
+    return df
+
+
+def make_bold(events, n_volumes, mask, affine, rng, noise=0.01, baseline=1000.0):
+    """
+    Synthetic BOLD run: baseline plus AR(1) noise in the mask, and the task regressors
+    (SPM HRF) with random weights in a box in the middle of the brain.
+
+    Returns:
+        Nifti1Image: float32 4D image.
+    """
+    import nibabel as nib
+    from nilearn.glm.first_level import make_first_level_design_matrix
+
+    frame_times = np.arange(n_volumes) * T_R
+    design = make_first_level_design_matrix(frame_times, events, hrf_model="spm", drift_model=None)
+    regressors = design.drop(columns="constant").to_numpy(dtype=np.float32)
+
+    n_voxels = int(mask.sum())
+    innovations = rng.standard_normal((n_volumes, n_voxels), dtype=np.float32)
+    signal = np.empty_like(innovations)
+    signal[0] = innovations[0]
+    for t in range(1, n_volumes):
+        signal[t] = 0.3 * signal[t - 1] + innovations[t]
+    signal *= noise * baseline
+    signal += baseline
+
+    # Activate a box around the centre of the mask with a random weight per condition
+    ijk = np.argwhere(mask)
+    centre = ijk.mean(axis=0)
+    active = np.all(np.abs(ijk - centre) <= np.array(mask.shape) / 8, axis=1)
+    weights = rng.uniform(0.5, 1.5, size=regressors.shape[1]).astype(np.float32)
+    signal[:, active] += (ACTIVATION * baseline) * (regressors @ weights)[:, None]
+
+    data = np.zeros(mask.shape + (n_volumes,), dtype=np.float32)
+    data[mask] = signal.T
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_xyzt_units("mm", "sec")
+    img.header["pixdim"][4] = T_R
+    return img
+
+
+def make_synthetic_dataset(path2root, n_subjects=1, n_runs=6, resolution=4, n_volumes=None,
+                           task="swp", session=1, seed=0):
+    """
+    Writes synthetic BIDS derivatives laid out like fMRIPrep outputs of the SWP study, so
+    load_BIDS_data, fit_GLM and the rest of the pipeline run on them unchanged.
+
+    Per subject: an MNI T1w, and per run a BOLD image on the MNI152 grid at the given
+    resolution, an events TSV built from the real run CSVs (see source_events) and a
+    confounds TSV. Nothing is downloaded: the grid and brain mask are nilearn's MNI152
+    templates.
+
+    Args:
+        path2root (str): Root of the synthetic study (data/derivatives is created below it).
+        n_subjects (int, optional): Number of subjects. Defaults to 1.
+        n_runs (int, optional): Runs per subject (ignored for localizer tasks). Defaults to 6.
+        resolution (int, optional): Voxel size in mm (2 is the full MNI grid). Defaults to 4.
+        n_volumes (int, optional): Volumes per run. Defaults to the length of the events.
+        task (str, optional): 'swp' or a localizer task (e.g. 'locvis'). Defaults to 'swp'.
+        session (int, optional): Session number. Defaults to 1.
+        seed (int, optional): Seed of the noise. Defaults to 0.
+
+    Returns:
+        dict: The parameters of the dataset and its voxel, volume and byte counts.
+    """
+    from nilearn.datasets import load_mni152_brain_mask, load_mni152_template
+    from utils import get_BIDS_paths
+
+    mask_img = load_mni152_brain_mask(resolution=resolution)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+    run_ids = list(range(1, n_runs + 1)) if task == "swp" else []
+    rng = np.random.default_rng(seed)
+
+    n_bytes, volumes = 0, []
+    for subject_id in range(1, n_subjects + 1):
+        paths = get_BIDS_paths(subject_id, session, task, run_ids, path2root)
+        for folder in {os.path.dirname(paths["anat"]), os.path.dirname(paths["func"][0])}:
+            os.makedirs(folder, exist_ok=True)
+        load_mni152_template(resolution=resolution).to_filename(paths["anat"])
+
+        for events, fn_func, fn_events, fn_confounds in zip(source_events(subject_id, task, run_ids),
+                                                            paths["func"], paths["events"], paths["confounds"]):
+            run_volumes = n_volumes
+            if run_volumes is None:
+                run_volumes = int(np.ceil(((events["onset"] + events["duration"]).max() + END_REST) / T_R))
+            events.to_csv(fn_events, sep="\t", index=False)
+            make_confounds(run_volumes, rng).to_csv(fn_confounds, sep="\t", index=False, na_rep="n/a")
+            make_bold(events, run_volumes, mask, mask_img.affine, rng).to_filename(fn_func)
+            n_bytes += sum(os.path.getsize(path) for path in (fn_func, fn_events, fn_confounds))
+            volumes.append(run_volumes)
+
+    description = {'n_subjects': n_subjects, 'n_runs': len(run_ids), 'resolution': resolution,
+                   'task': task, 'session': session, 'seed': seed,
+                   'grid': list(mask.shape), 'n_voxels': int(mask.sum()),
+                   'volumes_per_run': n_volumes, 'n_volumes': volumes, 'n_bytes': n_bytes}
+    with open(Path(path2root) / "data" / "derivatives" / "synthetic.json", 'w') as f:
+        json.dump(description, f, indent=2)
+    return description
@@ -0,0 +1,154 @@
+import json
+import os
+import re
+
+
+# BIDS entities parsed from file names, in the order they appear in fMRIPrep outputs
+ENTITIES = ["sub", "ses", "task", "dir", "run", "space", "desc"]
+
+LAYOUT_FORMAT_VERSION = 1
+
+_ENTITY_PATTERN = re.compile(r"^([a-zA-Z0-9]+)-([a-zA-Z0-9]+)$")
+
+
+def parse_bids_filename(filename):
+    """
+    Splits a BIDS file name into its entities, suffix and extension.
+
+    Example: 'sub-01_ses-1_task-swp_run-01_events.tsv' ->
+             {'sub': '01', 'ses': '1', 'task': 'swp', 'run': '01',
+              'suffix': 'events', 'extension': '.tsv'}
+    Returns None for files that are not BIDS-named.
+    """
+    stem, dot, extension = filename.partition(".")
+    parts = stem.split("_")
+    if len(parts) < 2:
+        return None
+    entities = {}
+    for part in parts[:-1]:
+        match = _ENTITY_PATTERN.match(part)
+        if match is None:
+            return None
+        entities[match.group(1)] = match.group(2)
+    if "sub" not in entities:
+        return None
+    entities["suffix"] = parts[-1]
+    entities["extension"] = dot + extension
+    return entities
+
+
+class BIDSLayout:
+    """
+    Index of the files below a BIDS derivatives directory, scanned once and cached.
+
+    The index is saved to cache_file together with the modification time of every
+    directory it covers. Adding or removing a file changes its directory's mtime,
+    so the index is rebuilt only when something below the root actually changed.
+    """
+    def __init__(self, root, cache_file=None):
+        """
+        Parameters:
+        root (str): Directory to index, e.g. <path2root>/data/derivatives.
+        cache_file (str, optional): JSON file the index is kept in. None keeps it in memory only.
+        """
+        self.root = os.path.abspath(root)
+        self.cache_file = cache_file
+        index = self._read_cache()
+        if index is None:
+            index = self._scan()
+            self._write_cache(index)
+        self.dir_mtimes = index['dirs']
+        self.files = index['files']
+
+        # Lookup tables: relative path -> entities, and subject -> entries
+        self._by_path = {entry['path']: entry for entry in self.files}
+        self._by_subject = {}
+        for entry in self.files:
+            self._by_subject.setdefault(entry['sub'], []).append(entry)
+
+    def _scan(self):
+        """Walks the root once and parses every BIDS-named file."""
+        dirs, files = {}, []
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(f"BIDS derivatives directory not found: {self.root}")
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, self.root)
+            dirs[rel_dir] = os.stat(dirpath).st_mtime_ns
+            for filename in sorted(filenames):
+                entities = parse_bids_filename(filename)
+                if entities is None:
+                    continue
+                entities['path'] = os.path.normpath(os.path.join(rel_dir, filename))
+                files.append(entities)
+        print(f"  Indexed {len(files)} BIDS files in {len(dirs)} directories below {self.root}")
+        return {'format_version': LAYOUT_FORMAT_VERSION, 'root': self.root, 'dirs': dirs, 'files': files}
+
+    def _read_cache(self):
+        """Returns the cached index if it exists and no indexed directory has changed."""
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, 'r') as f:
+                index = json.load(f)
+        except json.JSONDecodeError:
+            return None
+        if index.get('format_version') != LAYOUT_FORMAT_VERSION or index.get('root') != self.root:
+            return None
+        for rel_dir, mtime_ns in index['dirs'].items():
+            try:
+                if os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns != mtime_ns:
+                    return None
+            except FileNotFoundError:
+                return None
+        return index
+
+    def _write_cache(self, index):
+        if self.cache_file is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        tmp_path = f"{self.cache_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.cache_file)
+
+    def exists(self, path):
+        """True if path (absolute, or relative to the working directory) is in the index."""
+        rel_path = os.path.relpath(os.path.abspath(path), self.root)
+        return rel_path in self._by_path
+
+    def get(self, subject, **filters):
+        """
+        Returns the absolute paths of all files of one subject matching the filters.
+
+        Args:
+            subject (int or str): Subject label, e.g. 2 or '02'.
+            **filters: Entity values to match, e.g. task='swp', suffix='bold', extension='.nii.gz'.
+                Integers are compared to zero-padded labels as numbers (run=1 matches 'run-01').
+        """
+        matches = []
+        for entry in self._by_subject.get(_label(subject), []):
+            if all(_matches(entry.get(name), value) for name, value in filters.items()):
+                matches.append(os.path.join(self.root, entry['path']))
+        return matches
+
+    def subjects(self):
+        return sorted(self._by_subject)
+
+
+def _label(value):
+    return f"{value:02d}" if isinstance(value, int) else str(value)
+
+
+def _matches(label, value):
+    if label is None:
+        return value is None
+    if isinstance(value, int):
+        return label.isdigit() and int(label) == value
+    return label == value
+
+
+def get_layout(path2root):
+    """Layout of <path2root>/data/derivatives, cached in <path2root>/output/bids_layout.json."""
+    return BIDSLayout(os.path.join(path2root, "data", "derivatives"),
+                      cache_file=os.path.join(path2root, "output", "bids_layout.json"))
@@ -0,0 +1,78 @@
+import gzip
+import hashlib
+import os
+import shutil
+
+from glm_cache import GLMCache
+
+
+# Bytes copied per read while decompressing
+_COPY_BUFFER_BYTES = 16 * 1024**2
+
+
+def _source_key(fn_func):
+    """Hash of the identity of a source run (path, size, mtime)."""
+    stat = os.stat(fn_func)
+    identity = f"{os.path.abspath(fn_func)}|{stat.st_size}|{stat.st_mtime_ns}|"
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def _fn_root(fn_func):
+    filename = os.path.basename(fn_func)
+    for ext in (".nii.gz", ".nii"):
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+class BoldCache(GLMCache):
+    """
+    Local cache of BOLD runs in uncompressed, memory-mappable form.
+
+    Runs are stored once as plain .nii, decompressed by streaming and never loaded as a
+    whole. Entries are keyed by the identity of the source file and evicted least recently
+    used first, like GLMCache. The index records the source of every copy, so caches keyed
+    on glm_cache.file_identity treat a copy as its source.
+    """
+    entry_kind = "BOLD run"
+
+    def get_niftis(self, fns_func):
+        """
+        Returns the paths of uncompressed copies of all runs, as get_nifti. Copies handed out
+        earlier in the list are kept while later ones are added, so every returned path still
+        exists even if the runs together exceed max_bytes.
+        """
+        paths, keys = [], set()
+        for fn_func in fns_func:
+            paths.append(self.get_nifti(fn_func, keep=keys))
+            if fn_func.endswith(".gz"):
+                keys.add(_source_key(fn_func))
+        return paths
+
+    def get_nifti(self, fn_func, keep=()):
+        """
+        Returns the path of an uncompressed copy of fn_func, decompressing it on first use.
+
+        Caches keyed on glm_cache.file_identity (fit_GLM, mean_image, run_stats) identify
+        the copy by its source, so turning the BOLD cache on or off reuses their entries.
+        Entries whose keys are in keep are not evicted to make room for it.
+        """
+        if not fn_func.endswith(".gz"):
+            return fn_func
+        key = _source_key(fn_func)
+        path2entry = self.lookup(key)
+        if path2entry is not None:
+            return path2entry
+
+        filename = f"{_fn_root(fn_func)}_{key[:16]}.nii"
+        path2entry = self.entry_path(filename)
+        print(f"  Decompressing {os.path.basename(fn_func)} into the BOLD cache...")
+        tmp_path = f"{path2entry}.{os.getpid()}.tmp"
+        with gzip.open(fn_func, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, _COPY_BUFFER_BYTES)
+        stat = os.stat(fn_func)
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_path, path2entry)
+        self.add(key, filename, description={'source': os.path.abspath(fn_func), 'format': 'nii'},
+                 keep=keep)
+        return path2entry
@@ -0,0 +1,367 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from glm_store import META_FILENAME, MASK_FILENAME, STORE_FORMAT_VERSION, StoredGLM, _run_prefix
+from profiling import profiled
+
+
+# Bins of the AR(1) coefficient histogram, as FirstLevelModel.fit (bins=100)
+AR1_BINS = 100
+
+# Bytes per voxel and volume of a block: the float64 data and up to three float64
+# working arrays (OLS residuals or whitened data, and their whitened residuals)
+_BYTES_PER_SAMPLE = 4 * 8
+
+# Smallest block worth fitting; a budget that cannot hold it is rejected
+_MIN_BLOCK_VOXELS = 1024
+
+# FirstLevelModel options the engine reproduces; any other non-default value is refused
+_NOISE_MODELS = ("ols", "ar1")
+
+
+def _model_params(glm_params):
+    """FirstLevelModel parameters (its defaults completed with glm_params) the engine can reproduce."""
+    from nilearn.glm.first_level import FirstLevelModel
+
+    params = FirstLevelModel(**glm_params).get_params()
+    if params['noise_model'] not in _NOISE_MODELS:
+        raise ValueError(f"The chunked GLM supports noise models {_NOISE_MODELS}, "
+                         f"got '{params['noise_model']}'.")
+    if params['signal_scaling'] not in (0, False):
+        raise ValueError(f"The chunked GLM only scales signals over time (signal_scaling=0), "
+                         f"got {params['signal_scaling']}.")
+    if params['signal_scaling'] is False and params['standardize']:
+        raise ValueError("The chunked GLM does not standardize signals; use signal_scaling=0.")
+    if params['target_affine'] is not None or params['target_shape'] is not None:
+        raise ValueError("The chunked GLM fits on the grid of the runs; target_affine and "
+                         "target_shape are not supported.")
+    return params
+
+
+def _iter_volumes(fn_func):
+    """Yields the volumes of a 4D run one at a time, without loading or memory-mapping the run."""
+    import nibabel as nib
+
+    # Plain reads (no mmap) keep the pages of volumes already read out of the resident set;
+    # keeping the file open makes reads of a .nii.gz stream forward instead of restarting
+    img = nib.load(fn_func, mmap=False, keep_file_open=True)
+    n_volumes = img.shape[3] if len(img.shape) > 3 else 1
+    for i_volume in range(n_volumes):
+        volume = img.dataobj[..., i_volume] if len(img.shape) > 3 else img.dataobj[...]
+        yield np.asanyarray(volume)
+
+
+def _run_shape(fn_func):
+    """(grid shape, number of volumes, affine) of a run, from its header."""
+    import nibabel as nib
+
+    img = nib.load(fn_func)
+    return img.shape[:3], (img.shape[3] if len(img.shape) > 3 else 1), img.affine
+
+
+def compute_mask(fns_func, mask_img=None):
+    """
+    Brain mask of the runs as FirstLevelModel computes it (nilearn's multi-run EPI mask),
+    but from mean images streamed one volume at a time instead of the loaded runs.
+
+    Returns:
+        Nifti1Image: The mask (mask_img itself if given).
+    """
+    import nibabel as nib
+    from nilearn.image import load_img
+    from nilearn.masking import compute_multi_epi_mask
+
+    if mask_img is not None:
+        return load_img(mask_img)
+    mean_imgs = []
+    for fn_func in fns_func:
+        shape, n_volumes, affine = _run_shape(fn_func)
+        total = np.zeros(shape)
+        for volume in _iter_volumes(fn_func):
+            total += volume
+        mean_imgs.append(nib.Nifti1Image((total / n_volumes).astype(np.float32), affine))
+    return compute_multi_epi_mask(mean_imgs)
+
+
+def make_design_matrix(params, n_volumes, events, confounds):
+    """Design matrix of one run, built exactly as FirstLevelModel builds it."""
+    from nilearn.glm.first_level import make_first_level_design_matrix
+
+    confounds_matrix, confounds_names = None, None
+    if confounds is not None:
+        confounds_matrix = confounds.to_numpy()
+        confounds_names = confounds.columns.tolist()
+        if confounds_matrix.shape[0] != n_volumes:
+            raise ValueError(f"Confounds have {confounds_matrix.shape[0]} rows but the run has {n_volumes} volumes.")
+    frame_times = np.linspace(params['slice_time_ref'] * params['t_r'],
+                              (n_volumes - 1 + params['slice_time_ref']) * params['t_r'],
+                              n_volumes)
+    return make_first_level_design_matrix(frame_times, events,
+                                          hrf_model=params['hrf_model'],
+                                          drift_model=params['drift_model'],
+                                          high_pass=params['high_pass'],
+                                          drift_order=params['drift_order'],
+                                          fir_delays=params['fir_delays'] or [0],
+                                          add_regs=confounds_matrix,
+                                          add_reg_names=confounds_names,
+                                          min_onset=params['min_onset'])
+
+
+def stage_run(fn_func, mask, affine, smoothing_fwhm, path2staged):
+    """
+    Smooths (like NiftiMasker) and masks a run one volume at a time into a float32
+    time x voxel .npy array, so blocks of voxels can later be read from it.
+    """
+    from nilearn.image.image import smooth_array
+
+    _, n_volumes, _ = _run_shape(fn_func)
+    staged = np.lib.format.open_memmap(path2staged, mode='w+', dtype=np.float32,
+                                       shape=(n_volumes, int(mask.sum())))
+    for i_volume, volume in enumerate(_iter_volumes(fn_func)):
+        if smoothing_fwhm is not None:
+            volume = smooth_array(volume, affine, smoothing_fwhm)
+        staged[i_volume] = volume[mask]
+    staged.flush()
+    del staged
+
+
+class _DesignSolver:
+    """
+    Pseudo-inverses of one design matrix, whitened for every AR(1) coefficient met so far.
+
+    Each coefficient's whitened design, pseudo-inverse and normalized covariance are
+    computed once per run and reused by every block, as nilearn's ARModel computes them.
+    """
+    def __init__(self, design):
+        from numpy.linalg import matrix_rank
+
+        self.design = design
+        self.n_volumes, self.n_regressors = design.shape
+        eps = np.abs(design).sum() * np.finfo(np.float64).eps
+        self.df_residuals = self.n_volumes - matrix_rank(design, eps)
+        self._whitened = {}
+
+    def whitened(self, rho):
+        """(whitened design, its pseudo-inverse, normalized covariance) for AR coefficient rho."""
+        if rho not in self._whitened:
+            import scipy.linalg as spl
+
+            whitened_design = self.design.copy()
+            whitened_design[1:] -= rho * self.design[:-1]
+            pinv = spl.pinv(whitened_design)
+            self._whitened[rho] = (whitened_design, pinv, pinv @ pinv.T)
+        return self._whitened[rho]
+
+    def cache_bytes(self, n_labels):
+        """Bytes held by the whitened solutions of n_labels coefficients."""
+        return n_labels * 8 * (2 * self.n_volumes * self.n_regressors + self.n_regressors ** 2)
+
+
+def block_size(n_volumes, n_regressors, memory_budget, fixed_bytes=0):
+    """
+    Number of voxels per block such that a block's working arrays fit in memory_budget bytes
+    next to fixed_bytes of per-run state.
+    """
+    bytes_per_voxel = _BYTES_PER_SAMPLE * n_volumes + 8 * (n_regressors + 2)
+    n_voxels = int((memory_budget - fixed_bytes) // bytes_per_voxel)
+    if n_voxels < _MIN_BLOCK_VOXELS:
+        needed = fixed_bytes + _MIN_BLOCK_VOXELS * bytes_per_voxel
+        raise ValueError(f"A memory budget of {memory_budget / 1024**2:.0f} MB is too small to fit runs of "
+                         f"{n_volumes} volumes; at least {needed / 1024**2:.0f} MB is needed.")
+    return n_voxels
+
+
+def fit_block(Y, solver, noise_model, signal_scaling):
+    """
+    Fits OLS or AR(1) models to a block of voxels, like nilearn's run_glm.
+
+    Args:
+        Y (np.ndarray): float64 time x voxel data of the block. Modified in place.
+        solver (_DesignSolver): Pseudo-inverses of the run's design.
+        noise_model (str): 'ols' or 'ar1'.
+        signal_scaling (int or bool): 0 to scale each voxel to percent signal change, or False.
+
+    Returns:
+        tuple: (theta (P x voxels), dispersion (voxels,), AR(1) coefficient of each voxel)
+    """
+    if signal_scaling is not False:
+        mean = np.maximum(Y.mean(axis=0), 1)
+        Y /= mean
+        Y -= 1
+        Y *= 100
+
+    design, pinv, cov = solver.whitened(0.0)
+    n_volumes, n_regressors = design.shape
+    if noise_model == "ols":
+        theta = pinv @ Y
+        residuals = Y - design @ theta
+        dispersion = np.einsum('tv,tv->v', residuals, residuals) / (n_volumes - n_regressors)
+        return theta, dispersion, np.zeros(Y.shape[1])
+
+    # Yule-Walker AR(1) estimate from the OLS residuals; with the constant regressor of
+    # every design the residuals are already centred
+    residuals = Y - design @ (pinv @ Y)
+    lag0 = np.einsum('tv,tv->v', residuals, residuals) / n_volumes
+    lag1 = np.einsum('tv,tv->v', residuals[1:], residuals[:-1]) / (n_volumes - 1)
+    del residuals
+    rho = np.divide(lag1, lag0, out=np.zeros_like(lag0), where=lag0 > 0)
+    rho = (rho * AR1_BINS).astype(int) * 1.0 / AR1_BINS
+
+    # Whiten every voxel with its own coefficient, then solve per coefficient
+    Y[1:] -= rho * Y[:-1]
+    theta = np.empty((n_regressors, Y.shape[1]))
+    dispersion = np.empty(Y.shape[1])
+    for value in np.unique(rho):
+        voxels = rho == value
+        whitened_design, pinv, _ = solver.whitened(float(value))
+        wY = Y[:, voxels]
+        theta[:, voxels] = pinv @ wY
+        wY -= whitened_design @ theta[:, voxels]
+        dispersion[voxels] = np.einsum('tv,tv->v', wY, wY) / (n_volumes - n_regressors)
+    return theta, dispersion, rho
+
+
+def fit_run_blocks(fn_func, mask, affine, solver, params, memory_budget, path2staged):
+    """
+    Stages one run (see stage_run) and fits it block of voxels by block.
+
+    Args:
+        fn_func (str): Path to the 4D run.
+        mask (np.ndarray): Boolean brain mask on the grid of the run.
+        affine (np.ndarray): Affine of the run (for smoothing).
+        solver (_DesignSolver): Pseudo-inverses of the run's design.
+        params (dict): FirstLevelModel parameters (see _model_params).
+        memory_budget (int): Bytes the block working arrays may use.
+        path2staged (str): Path of the staging array, deleted once the run is fitted.
+
+    Yields:
+        tuple: (first voxel, last voxel + 1, theta, dispersion, AR(1) coefficients) of each block.
+    """
+    n_voxels = int(mask.sum())
+    stage_run(fn_func, mask, affine, params['smoothing_fwhm'], path2staged)
+    try:
+        # At most 2 * AR1_BINS + 1 coefficients can occur, each with its whitened solution
+        n_labels = 1 if params['noise_model'] == "ols" else 2 * AR1_BINS + 1
+        n_block = min(n_voxels, block_size(solver.n_volumes, solver.n_regressors, memory_budget,
+                                           fixed_bytes=solver.cache_bytes(n_labels)))
+        n_blocks = -(-n_voxels // n_block)
+        print(f"  {os.path.basename(fn_func)}: fitting {n_voxels} voxels x {solver.n_volumes} volumes "
+              f"in {n_blocks} block(s) of up to {n_block} voxels...")
+        for start in range(0, n_voxels, n_block):
+            stop = min(start + n_block, n_voxels)
+            # The staging array is opened per block, so pages of finished blocks leave the resident set
+            staged = np.load(path2staged, mmap_mode='r')
+            Y = np.array(staged[:, start:stop], dtype=np.float64)
+            del staged
+            yield (start, stop) + fit_block(Y, solver, params['noise_model'], params['signal_scaling'])
+    finally:
+        os.remove(path2staged)
+
+
+@profiled("glm_fit_chunked")
+def fit_chunked_glm(fns_func, dfs_events, dfs_confounds, glm_params, path2store,
+                    memory_budget, work_dir=None):
+    """
+    Fits a first-level GLM block of voxels by block within a memory budget and writes it
+    as a GLM store (see glm_store), answering contrasts like the FirstLevelModel it replaces.
+
+    Runs are fitted one after the other. Each run is smoothed and masked one volume at a
+    time into a float32 staging array on disk, then fitted in blocks of voxels sized so
+    their float64 working arrays fit in memory_budget, with the pseudo-inverse of the design
+    (whitened per AR(1) coefficient) computed once per run. Peak memory therefore depends
+    on the budget and on one volume, not on the number of runs or subjects.
+
+    Args:
+        fns_func (list): Paths to the 4D runs.
+        dfs_events (list): Events DataFrame of each run.
+        dfs_confounds (list): Confounds DataFrame of each run (or None).
+        glm_params (dict): FirstLevelModel keyword arguments.
+        path2store (str): Directory to write the store to. Replaced if it exists.
+        memory_budget (int): Bytes the block working arrays may use.
+        work_dir (str, optional): Folder for the staging arrays. Defaults to next to path2store.
+
+    Returns:
+        StoredGLM: The fitted model, memory-mapped from path2store.
+    """
+    params = _model_params(glm_params)
+    if dfs_confounds is None:
+        dfs_confounds = [None] * len(fns_func)
+
+    tmp_path = f"{path2store}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    staging_dir = tempfile.mkdtemp(prefix="glm_staging_",
+                                   dir=work_dir or os.path.dirname(os.path.abspath(path2store)))
+    try:
+        print("  Computing the brain mask from streamed mean images...")
+        mask_img = compute_mask(fns_func, params['mask_img'])
+        mask_img.to_filename(os.path.join(tmp_path, MASK_FILENAME))
+        mask = np.asanyarray(mask_img.dataobj) != 0
+        n_voxels = int(mask.sum())
+
+        runs_meta = []
+        for run_idx, (fn_func, events, confounds) in enumerate(zip(fns_func, dfs_events, dfs_confounds)):
+            prefix = _run_prefix(run_idx)
+            shape, n_volumes, affine = _run_shape(fn_func)
+            if shape != mask.shape:
+                raise ValueError(f"Run {fn_func} has shape {shape}, the mask {mask.shape}.")
+            design_matrix = make_design_matrix(params, n_volumes, events, confounds)
+            solver = _DesignSolver(design_matrix.to_numpy(dtype=np.float64))
+
+            outputs = {
+                'theta': ((solver.n_regressors, n_voxels), np.float32),
+                'dispersion': ((n_voxels,), np.float32),
+                'label_codes': ((n_voxels,), np.int32),
+            }
+            for name, (out_shape, dtype) in outputs.items():
+                np.lib.format.open_memmap(os.path.join(tmp_path, f"{prefix}_{name}.npy"), mode='w+',
+                                          dtype=dtype, shape=out_shape).flush()
+
+            label_codes = {}
+            blocks = fit_run_blocks(fn_func, mask, affine, solver, params, memory_budget,
+                                    os.path.join(staging_dir, f"{prefix}_staged.npy"))
+            for start, stop, theta, dispersion, rho in blocks:
+                codes = np.empty(rho.size, dtype=np.int32)
+                for value in np.unique(rho):
+                    codes[rho == value] = label_codes.setdefault(float(value), len(label_codes))
+
+                # Outputs are opened per block too, so written pages leave the resident set
+                for name, values in (('theta', theta), ('dispersion', dispersion), ('label_codes', codes)):
+                    out = np.load(os.path.join(tmp_path, f"{prefix}_{name}.npy"), mmap_mode='r+')
+                    out[..., start:stop] = values
+                    out.flush()
+                    del out
+
+            # Labels are the AR(1) coefficients as strings, as nilearn's labels_
+            covs = np.stack([solver.whitened(rho)[2] for rho in label_codes])
+            np.save(os.path.join(tmp_path, f"{prefix}_cov.npy"), covs)
+            np.savez(os.path.join(tmp_path, f"{prefix}_design.npz"),
+                     values=design_matrix.to_numpy(dtype=np.float32),
+                     frame_times=design_matrix.index.to_numpy(dtype=float))
+            runs_meta.append({
+                'labels': [str(rho) for rho in label_codes],
+                'columns': [str(col) for col in design_matrix.columns],
+                'df_residuals': float(solver.df_residuals),
+            })
+
+        meta = {
+            'format_version': STORE_FORMAT_VERSION,
+            'n_runs': len(runs_meta),
+            'n_voxels': n_voxels,
+            'runs': runs_meta,
+        }
+        with open(os.path.join(tmp_path, META_FILENAME), 'w') as f:
+            json.dump(meta, f, indent=2)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    shutil.rmtree(path2store, ignore_errors=True)
+    os.replace(tmp_path, path2store)
+    return StoredGLM(path2store)
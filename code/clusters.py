@@ -0,0 +1,180 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Columns of the cluster tables written next to the contrast figures
+CLUSTER_TABLE_COLUMNS = ["cluster_id", "sign", "peak_z", "x", "y", "z",
+                         "size_voxels", "size_mm3", "mean_z"]
+
+
+def fdr_thresholds(z_map, alphas):
+    """
+    Two-sided FDR height thresholds of a z-map for several alphas, as threshold_stats_img
+    computes them (over the non-zero voxels of a masked z-map).
+
+    Returns:
+        dict: alpha -> z threshold (np.inf if no voxel survives)
+    """
+    from nilearn.glm import fdr_threshold
+    from nilearn.image import load_img
+
+    z_data = np.asanyarray(load_img(z_map).dataobj)
+    z_values = np.abs(z_data[(z_data != 0) & np.isfinite(z_data)])
+    return {alpha: float(fdr_threshold(z_values, alpha / 2)) for alpha in alphas}
+
+
+class ClusterSweep:
+    """
+    Connected clusters of a z-map at several height thresholds, from one sweep per sign.
+
+    Supra-threshold voxels are visited from the highest to the lowest |z| and merged with
+    their already visited face neighbours (6-connectivity, as nilearn) in a union-find, so
+    the clusters at every threshold of the list are snapshots of the same sweep instead of
+    a new labelling per threshold. The root of every cluster is its peak voxel.
+    Thresholding follows nilearn's threshold_img: voxels with |z| >= threshold are kept and
+    clusters smaller than cluster_threshold voxels are removed, each sign separately.
+    """
+    def __init__(self, z_map, thresholds):
+        """
+        Parameters:
+        z_map (Nifti1Image or str): 3D z-map.
+        thresholds (float or list): Height thresholds to label the clusters at (> 0).
+        """
+        from nilearn.image import load_img
+
+        z_map = load_img(z_map)
+        self.affine = z_map.affine
+        self.header = z_map.header
+        self.data = np.asanyarray(z_map.dataobj).astype(np.float64)
+        if self.data.ndim == 4 and self.data.shape[3] == 1:
+            self.data = self.data[..., 0]
+        if self.data.ndim != 3:
+            raise ValueError(f"ClusterSweep needs a 3D z-map, got shape {self.data.shape}.")
+        self.thresholds = sorted({float(t) for t in np.atleast_1d(thresholds)}, reverse=True)
+        if self.thresholds[-1] <= 0:
+            raise ValueError(f"Cluster thresholds must be > 0, got {self.thresholds[-1]}.")
+        self._tails = {sign: self._sweep(sign) for sign in (1, -1)}
+
+    def _sweep(self, sign):
+        """
+        Runs the union-find sweep for one sign.
+
+        Returns:
+            tuple: (flat indices of the swept voxels in descending order, their |z|,
+                    dict of threshold -> cluster root of each voxel above it)
+        """
+        values = sign * self.data.ravel()
+        flat = np.flatnonzero(np.nan_to_num(values, nan=-np.inf) >= self.thresholds[-1])
+        order = np.argsort(-values[flat], kind='stable')
+        flat, sorted_values = flat[order], values[flat[order]]
+
+        # Node ids are ranks in the sweep; an edge joins the sweep when its later voxel does
+        node = np.full(values.size, -1, dtype=np.int64)
+        node[flat] = np.arange(flat.size)
+        coords = np.unravel_index(flat, self.data.shape)
+        edges = []
+        for axis, stride in enumerate(np.cumprod((1,) + self.data.shape[:0:-1])[::-1]):
+            has_next = coords[axis] < self.data.shape[axis] - 1
+            a = node[flat[has_next]]
+            b = node[flat[has_next] + stride]
+            edges.append(np.stack([a[b >= 0], b[b >= 0]], axis=1))
+        edges = np.concatenate(edges) if edges else np.empty((0, 2), dtype=np.int64)
+        edges.sort(axis=1)
+        edges = edges[np.argsort(edges[:, 1], kind='stable')]
+
+        parent = list(range(flat.size))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        roots_at = {}
+        edge_list = edges.tolist()
+        i_edge = 0
+        for threshold in self.thresholds:
+            n_active = int(np.searchsorted(-sorted_values, -threshold, side='right'))
+            # Merge every edge whose two voxels are at or above this threshold
+            while i_edge < len(edge_list) and edge_list[i_edge][1] < n_active:
+                root_a, root_b = find(edge_list[i_edge][0]), find(edge_list[i_edge][1])
+                if root_a != root_b:
+                    # The root with the lower rank (higher |z|) stays the peak of the cluster
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+                i_edge += 1
+            roots = np.array(parent[:n_active], dtype=np.int64)
+            while True:
+                next_roots = roots[roots]
+                if np.array_equal(next_roots, roots):
+                    break
+                roots = next_roots
+            roots_at[threshold] = roots
+        return flat, sorted_values, roots_at
+
+    def _roots(self, threshold, sign):
+        if float(threshold) not in self._tails[sign][2]:
+            raise ValueError(f"Threshold {threshold} was not swept. Swept thresholds: {self.thresholds}")
+        flat, sorted_values, roots_at = self._tails[sign]
+        roots = roots_at[float(threshold)]
+        return flat[:roots.size], sorted_values[:roots.size], roots
+
+    def cluster_sizes(self, threshold, sign=1):
+        """Sizes in voxels of the clusters of one sign at threshold, largest first."""
+        _, _, roots = self._roots(threshold, sign)
+        sizes = np.bincount(roots)
+        return np.sort(sizes[sizes > 0])[::-1]
+
+    def thresholded_data(self, threshold, cluster_threshold=0):
+        """The z-map with voxels below threshold and clusters under cluster_threshold voxels zeroed."""
+        thresholded = np.zeros(self.data.size)
+        for sign in (1, -1):
+            flat, _, roots = self._roots(threshold, sign)
+            keep = np.bincount(roots, minlength=roots.size)[roots] >= cluster_threshold
+            thresholded[flat[keep]] = self.data.ravel()[flat[keep]]
+        return thresholded.reshape(self.data.shape)
+
+    def thresholded_img(self, threshold, cluster_threshold=0):
+        """Same map as thresholded_data, as a Nifti1Image on the grid of the z-map."""
+        import nibabel as nib
+
+        return nib.Nifti1Image(self.thresholded_data(threshold, cluster_threshold).astype(np.float32),
+                               self.affine, self.header)
+
+    def cluster_table(self, threshold, cluster_threshold=0):
+        """
+        Table of the clusters at threshold, one row per cluster of at least cluster_threshold
+        voxels, sorted by decreasing |peak z|.
+
+        Returns:
+            pd.DataFrame: Columns CLUSTER_TABLE_COLUMNS; x, y, z are the world (MNI)
+                          coordinates of the peak in mm.
+        """
+        voxel_mm3 = float(abs(np.linalg.det(self.affine[:3, :3])))
+        rows = []
+        for sign in (1, -1):
+            flat, sorted_values, roots = self._roots(threshold, sign)
+            sizes = np.bincount(roots, minlength=roots.size)
+            sums = np.bincount(roots, weights=sorted_values, minlength=roots.size)
+            peaks = np.flatnonzero(sizes >= max(cluster_threshold, 1))
+            ijk = np.stack(np.unravel_index(flat[peaks], self.data.shape), axis=1)
+            xyz = ijk @ self.affine[:3, :3].T + self.affine[:3, 3]
+            for peak, (x, y, z) in zip(peaks, xyz):
+                rows.append({"sign": "+" if sign > 0 else "-",
+                             "peak_z": sign * sorted_values[peak],
+                             "x": x, "y": y, "z": z,
+                             "size_voxels": int(sizes[peak]),
+                             "size_mm3": sizes[peak] * voxel_mm3,
+                             "mean_z": sign * sums[peak] / sizes[peak]})
+        table = pd.DataFrame(rows, columns=CLUSTER_TABLE_COLUMNS[1:])
+        table = table.reindex(table["peak_z"].abs().sort_values(ascending=False).index).reset_index(drop=True)
+        table.insert(0, "cluster_id", np.arange(1, len(table) + 1))
+        return table
+
+
+def save_cluster_table(table, filepath):
+    """Writes a cluster table as TSV, creating the folder if needed."""
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    table.to_csv(filepath, sep="\t", index=False, float_format="%.3f")
+    return filepath
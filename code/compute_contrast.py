@@ -114,6 +114,125 @@ def _check_features_match(regressor_features: dict, target_key_features: dict) -
     return True
 
 
+def _split_contrast_name(contrast_name: str) -> tuple[str, str]:
+    """
+    Splits "positive_key > negative_key" (or a single "positive_key") into its two keys.
+    The negative key is "" for single-key contrasts.
+    """
+    if ">" in contrast_name:
+        positive_key_str, negative_key_str = [part.strip() for part in contrast_name.split(">", 1)]
+        if not positive_key_str or not negative_key_str:
+            raise ValueError(
+                f"Contrast name '{contrast_name}' has an empty positive or negative key. "
+                "Required format: 'positive_key > negative_key'."
+            )
+        return positive_key_str, negative_key_str
+
+    positive_key_str = contrast_name.strip()
+    if not positive_key_str:
+        raise ValueError("Contrast name for single key cannot be empty.")
+    return positive_key_str, ""
+
+
+class RegressorFeatureIndex:
+    """
+    Design-matrix columns compiled into a boolean membership matrix of
+    regressors x factor levels (every (factor, value) pair of CONDITIONS).
+
+    Column names are parsed once; a contrast key then selects regressors with
+    mask algebra instead of re-parsing and comparing names per contrast.
+    """
+    def __init__(self, columns):
+        """
+        Parameters:
+        columns (list): Design matrix column names.
+        """
+        self.columns = [str(col) for col in columns]
+        self.levels = [(factor, value) for factor, values in CONDITIONS.items() for value in values]
+        self._level_index = {level: i for i, level in enumerate(self.levels)}
+        self._key_levels = {}
+
+        self.membership = np.zeros((len(self.columns), len(self.levels)), dtype=bool)
+        self.is_task = np.zeros(len(self.columns), dtype=bool)
+        for idx, col_name in enumerate(self.columns):
+            regressor_features = _parse_regressor_to_features(col_name)
+            if regressor_features is None: # Confound or unparseable
+                continue
+            self.is_task[idx] = True
+            for level in regressor_features.items():
+                self.membership[idx, self._level_index[level]] = True
+
+    def key_levels(self, key_str: str) -> np.ndarray:
+        """Boolean vector over self.levels of the features a contrast key requires."""
+        if key_str not in self._key_levels:
+            required = np.zeros(len(self.levels), dtype=bool)
+            for level in _parse_key_to_features(key_str).items():
+                required[self._level_index[level]] = True
+            self._key_levels[key_str] = required
+        return self._key_levels[key_str]
+
+    def match(self, key_levels: np.ndarray) -> np.ndarray:
+        """
+        Regressors matching each key: those that have all of the key's levels.
+
+        Args:
+            key_levels (np.ndarray): K x L (or L) boolean matrix from key_levels().
+
+        Returns:
+            np.ndarray: K x P (or P) boolean matrix. Empty keys match nothing.
+        """
+        key_levels = np.asarray(key_levels, dtype=bool)
+        n_required = key_levels.sum(axis=-1)
+        n_present = key_levels.astype(np.int32) @ self.membership.T.astype(np.int32)
+        return (n_present == n_required[..., None]) & (n_required[..., None] > 0)
+
+    def contrast_matrix(self, contrast_names: list) -> tuple[np.ndarray, list]:
+        """
+        Builds the C x P contrast matrix of several contrast names at once.
+
+        "P > N" rows are +1 on regressors matching P and -1 on those matching N (a regressor
+        matching both gets 0). Single-key rows are +1 on matching task regressors and -1 on
+        all other task regressors. Confounds are always 0.
+
+        Returns:
+            tuple: (C x P contrast matrix, list of warning messages)
+        """
+        keys = [_split_contrast_name(contrast_name) for contrast_name in contrast_names]
+        positive_levels = np.array([self.key_levels(positive) for positive, _ in keys]).reshape(len(keys), -1)
+        negative_levels = np.array([self.key_levels(negative) for _, negative in keys]).reshape(len(keys), -1)
+        is_single_key = np.array([not negative for _, negative in keys], dtype=bool)
+
+        positive_match = self.match(positive_levels) & self.is_task
+        negative_match = self.match(negative_levels) & self.is_task
+        # Single keys are contrasted against every other task regressor
+        negative_match[is_single_key] = ~positive_match[is_single_key] & self.is_task
+        contrast_matrix = positive_match.astype(float) - negative_match.astype(float)
+
+        warnings = []
+        for i, (contrast_name, (positive_key_str, negative_key_str)) in enumerate(zip(contrast_names, keys)):
+            if positive_levels[i].any() and not positive_match[i].any():
+                warnings.append(f"Warning: Positive key features from '{positive_key_str}' did not match any task regressors.")
+            if negative_key_str and negative_levels[i].any() and not negative_match[i].any():
+                warnings.append(f"Warning: Negative key features from '{negative_key_str}' did not match any task regressors.")
+            if not contrast_matrix[i].any() and (positive_levels[i].any() or negative_levels[i].any()):
+                warnings.append(f"Warning: Contrast vector for '{contrast_name}' is all zeros. "
+                                "Check if keys correctly specify distinct and present conditions, "
+                                "or if positive/negative keys effectively cancel out for all regressors.")
+        return contrast_matrix, warnings
+
+
+# Compiled indices by column tuple: runs and subjects usually share the same design columns
+_FEATURE_INDEX_CACHE = {}
+
+
+def get_regressor_index(design_matrix) -> RegressorFeatureIndex:
+    """Returns the compiled RegressorFeatureIndex of a design matrix (or list of columns)."""
+    columns = tuple(str(col) for col in getattr(design_matrix, 'columns', design_matrix))
+    if columns not in _FEATURE_INDEX_CACHE:
+        _FEATURE_INDEX_CACHE[columns] = RegressorFeatureIndex(columns)
+    return _FEATURE_INDEX_CACHE[columns]
+
+
 def load_contrast_vector(contrast_name: str, design_matrix: pd.DataFrame) -> np.ndarray:
     """
     Generates a contrast vector based on feature matching against design_matrix columns.
@@ -126,77 +245,29 @@ def load_contrast_vector(contrast_name: str, design_matrix: pd.DataFrame) -> np.
     Returns:
         np.ndarray: The contrast vector.
     """
-    positive_key_str = ""
-    negative_key_str = "" # Only used if ">" is in contrast_name
+    index = get_regressor_index(design_matrix)
+    contrast_matrix, warnings = index.contrast_matrix([contrast_name])
+    contrast_vector = contrast_matrix[0]
+    for warning in warnings:
+        print(warning)
+    if contrast_vector.any() and index.key_levels(_split_contrast_name(contrast_name)[0]).any():
+        print(f"Generated contrast vector for '{contrast_name}'. Sum: {np.sum(contrast_vector)}, Non-zero elements: {np.count_nonzero(contrast_vector)}")
+    return contrast_vector
 
-    if ">" in contrast_name:
-        parts = contrast_name.split(">", 1)
-        if len(parts) == 2:
-            positive_key_str = parts[0].strip()
-            negative_key_str = parts[1].strip()
-            if not positive_key_str or not negative_key_str:
-                raise ValueError(
-                    f"Contrast name '{contrast_name}' has an empty positive or negative key. "
-                    "Required format: 'positive_key > negative_key'."
-                )
-        else: # Should not happen with split(">", 1)
-            raise ValueError(
-                f"Contrast name '{contrast_name}' format is invalid. "
-                "Use 'positive_key' or 'positive_key > negative_key'."
-            )
-    else:
-        positive_key_str = contrast_name.strip()
-        if not positive_key_str:
-            raise ValueError("Contrast name for single key cannot be empty.")
 
-    positive_target_features = _parse_key_to_features(positive_key_str)
-    negative_target_features = _parse_key_to_features(negative_key_str) if negative_key_str else {}
+def load_contrast_matrix(contrast_names: list, design_matrix: pd.DataFrame) -> np.ndarray:
+    """
+    Generates the contrast vectors of many contrast names in one vectorized pass.
 
-    n_regressors = design_matrix.shape[1]
-    contrast_vector = np.zeros(n_regressors)
-    
-    found_any_positive_match = False
-    found_any_negative_match = False
-
-    for idx, col_name in enumerate(design_matrix.columns):
-        regressor_features = _parse_regressor_to_features(col_name)
-
-        if regressor_features is None: # Confound or unparseable
-            contrast_vector[idx] = 0
-            continue
-
-        # Logic for "P > N" contrasts
-        if negative_key_str: # Implies "P > N" format
-            is_positive_match = _check_features_match(regressor_features, positive_target_features)
-            is_negative_match = _check_features_match(regressor_features, negative_target_features)
-
-            if is_positive_match:
-                contrast_vector[idx] += 1
-                found_any_positive_match = True
-            if is_negative_match: # Use 'if' not 'elif' in case a regressor could match aspects of both
-                contrast_vector[idx] -= 1
-                found_any_negative_match = True
-        # Logic for single "P" key (contrast P vs all other task conditions)
-        else:
-            if _check_features_match(regressor_features, positive_target_features):
-                contrast_vector[idx] = 1
-                found_any_positive_match = True
-            else:
-                # It's a task regressor but didn't match the positive key
-                contrast_vector[idx] = -1 
-                # No specific found_any_negative_match here, as it's an implicit negative
-
-    # Warnings
-    if not found_any_positive_match and positive_target_features:
-        print(f"Warning: Positive key features from '{positive_key_str}' did not match any task regressors.")
-    if negative_key_str and not found_any_negative_match and negative_target_features:
-        print(f"Warning: Negative key features from '{negative_key_str}' did not match any task regressors.")
-
-    if np.sum(np.abs(contrast_vector)) == 0 and (positive_target_features or negative_target_features) :
-        print(f"Warning: Contrast vector for '{contrast_name}' is all zeros. "
-              "Check if keys correctly specify distinct and present conditions, "
-              "or if positive/negative keys effectively cancel out for all regressors.")
-    elif positive_target_features : # Print success only if a positive key was processed and vector is non-zero or warning issued
-        print(f"Generated contrast vector for '{contrast_name}'. Sum: {np.sum(contrast_vector)}, Non-zero elements: {np.count_nonzero(contrast_vector)}")
-            
-    return contrast_vector
+    Args:
+        contrast_names: list of contrast names, in the format of load_contrast_vector.
+        design_matrix: pd.DataFrame (or list of column names) of the model.
+
+    Returns:
+        np.ndarray: Contrast matrix of shape (len(contrast_names), n_regressors).
+    """
+    contrast_matrix, warnings = get_regressor_index(design_matrix).contrast_matrix(list(contrast_names))
+    for warning in warnings:
+        print(warning)
+    print(f"Generated {len(contrast_names)} contrast vectors over {contrast_matrix.shape[1]} regressors.")
+    return contrast_matrix
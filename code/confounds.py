@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+
+# numpy and pandas are imported where they are used, so the command-line parsers can
+# read STRATEGIES without paying for them
+
+
+MOTION_COLUMNS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+# Named confound strategies: the fMRIPrep columns to read and the expansions computed from them.
+# Expansions are computed here (see expand_confounds: all runs stacked into one vectorized
+# pass, with derivatives restarted at every run), so only the base columns are read from disk.
+STRATEGIES = {
+    "motion6": {'columns': MOTION_COLUMNS},
+    "motion12": {'columns': MOTION_COLUMNS, 'derivatives': True},
+    "motion24": {'columns': MOTION_COLUMNS, 'derivatives': True, 'quadratics': True},
+    "motion6+fd": {'columns': MOTION_COLUMNS, 'framewise_displacement': True},
+    "motion24+fd": {'columns': MOTION_COLUMNS, 'derivatives': True, 'quadratics': True,
+                    'framewise_displacement': True},
+    "motion6+wm+csf": {'columns': MOTION_COLUMNS + ['white_matter', 'csf']},
+    "motion24+wm+csf": {'columns': MOTION_COLUMNS + ['white_matter', 'csf'],
+                        'derivatives': True, 'quadratics': True},
+}
+
+# Head radius in mm used to turn rotations (radians) into displacements, as in Power et al. (2012)
+FD_HEAD_RADIUS = 50.0
+
+
+def get_strategy(strategy):
+    """
+    Resolves a strategy name from STRATEGIES, or a list of column names (read as is).
+    """
+    if isinstance(strategy, str):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown confound strategy '{strategy}'. Choose from {list(STRATEGIES)}.")
+        return STRATEGIES[strategy]
+    return {'columns': list(strategy)}
+
+
+def _read_header(fn_confounds):
+    with open(fn_confounds, 'r') as f:
+        return f.readline().rstrip('\n').split('\t')
+
+
+def read_confound_columns(fn_confounds, columns, cache_dir=None):
+    """
+    Reads only the requested columns of a confounds TSV file.
+
+    Parsed columns are cached as a compact .npy array keyed by the file identity
+    (path, size, mtime) and the column list, so repeat loads skip the text parser.
+
+    Args:
+        fn_confounds (str): Path to an fMRIPrep desc-confounds_timeseries.tsv file.
+        columns (list): Column names to read.
+        cache_dir (str, optional): Directory for parsed confounds. None disables caching.
+
+    Returns:
+        np.ndarray: float64 array of shape (n_volumes, len(columns)).
+    """
+    import numpy as np
+    import pandas as pd
+
+    path2cache = None
+    if cache_dir is not None:
+        stat = os.stat(fn_confounds)
+        identity = f"{os.path.abspath(fn_confounds)}|{stat.st_size}|{stat.st_mtime_ns}|{json.dumps(columns)}"
+        key = hashlib.sha256(identity.encode()).hexdigest()
+        fn_root = os.path.basename(fn_confounds).rsplit('.', 1)[0]
+        path2cache = os.path.join(cache_dir, f"{fn_root}_{key[:16]}.npy")
+        if os.path.exists(path2cache):
+            return np.load(path2cache)
+
+    missing_columns = [col for col in columns if col not in _read_header(fn_confounds)]
+    if missing_columns:
+        raise ValueError(f"Missing confound columns {missing_columns} in file {fn_confounds}.")
+    df = pd.read_table(fn_confounds, usecols=columns, na_values="n/a", dtype=np.float64)
+    values = df[columns].to_numpy()
+
+    if path2cache is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path2cache[:-len('.npy')]}.tmp.npy"
+        np.save(tmp_path, values)
+        os.replace(tmp_path, path2cache)
+    return values
+
+
+def _run_derivatives(values, run_starts):
+    """Backward differences of stacked runs; the first volume of every run gets 0."""
+    import numpy as np
+
+    derivatives = np.zeros_like(values)
+    derivatives[1:] = np.diff(values, axis=0)
+    derivatives[run_starts] = 0
+    return derivatives
+
+
+def expand_confounds(run_values, columns, derivatives=False, quadratics=False,
+                     framewise_displacement=False):
+    """
+    Computes confound expansions for all runs at once.
+
+    The runs are stacked into one array, so derivatives, quadratic terms and framewise
+    displacement are single vectorized operations; differences never cross run boundaries.
+
+    Args:
+        run_values (list): Per-run arrays of shape (n_volumes, len(columns)).
+        columns (list): Names of the base columns.
+        derivatives (bool, optional): Add first temporal derivatives (<col>_derivative1).
+        quadratics (bool, optional): Add squares of the base columns (<col>_power2), and of the
+            derivatives if those are added too (<col>_derivative1_power2).
+        framewise_displacement (bool, optional): Add framewise displacement computed from
+            the six motion parameters.
+
+    Returns:
+        list: Per-run DataFrames with the expanded confounds.
+    """
+    import numpy as np
+    import pandas as pd
+
+    run_lengths = [len(values) for values in run_values]
+    run_starts = np.cumsum([0] + run_lengths[:-1])
+    stacked = np.vstack(run_values)
+    # fMRIPrep leaves gaps as n/a; a GLM cannot use them
+    stacked = np.nan_to_num(stacked)
+
+    blocks, names = [stacked], list(columns)
+    if derivatives or framewise_displacement:
+        stacked_derivatives = _run_derivatives(stacked, run_starts)
+    if derivatives:
+        blocks.append(stacked_derivatives)
+        names += [f"{col}_derivative1" for col in columns]
+    if quadratics:
+        blocks.append(np.hstack(blocks) ** 2)
+        names += [f"{name}_power2" for name in names]
+    if framewise_displacement:
+        missing_columns = [col for col in MOTION_COLUMNS if col not in columns]
+        if missing_columns:
+            raise ValueError(f"Framewise displacement needs the motion columns {missing_columns}.")
+        motion_derivatives = np.abs(stacked_derivatives[:, [columns.index(col) for col in MOTION_COLUMNS]])
+        fd = motion_derivatives[:, :3].sum(axis=1) + FD_HEAD_RADIUS * motion_derivatives[:, 3:].sum(axis=1)
+        blocks.append(fd[:, None])
+        names.append("framewise_displacement")
+
+    expanded = np.hstack(blocks)
+    return [pd.DataFrame(expanded[start:start + length], columns=names)
+            for start, length in zip(run_starts, run_lengths)]
+
+
+def load_confounds(fns_confounds, strategy="motion6", cache_dir=None):
+    """
+    Loads the confounds of several runs with a named strategy.
+
+    Args:
+        fns_confounds (list): Paths to the confounds TSV files, one per run.
+        strategy (str or list, optional): A key of STRATEGIES, or a list of columns. Defaults to "motion6".
+        cache_dir (str, optional): Directory for parsed confounds. None disables caching.
+
+    Returns:
+        list: One DataFrame of confounds per run.
+    """
+    spec = get_strategy(strategy)
+    columns = list(spec['columns'])
+    run_values = [read_confound_columns(fn_confounds, columns, cache_dir) for fn_confounds in fns_confounds]
+    return expand_confounds(run_values, columns,
+                            derivatives=spec.get('derivatives', False),
+                            quadratics=spec.get('quadratics', False),
+                            framewise_displacement=spec.get('framewise_displacement', False))
@@ -1,19 +1,48 @@
+import fnmatch
 import json
 import os
+import re
+
+
+def is_pattern(contrast_name):
+    """True if a contrast name is a glob pattern (contains *, ? or [)."""
+    return any(char in contrast_name for char in "*?[")
+
 
 class ContrastManager:
     """
     Manages a collection of contrasts, primarily loaded from a file.
+
+    The file is read on first use, so creating a manager for a large contrast library
+    costs nothing until a contrast is needed. Contrasts compiled against a design matrix
+    are cached as one NumPy matrix per design, with a name -> row index.
     """
-    def __init__(self, filepath="contrasts.json"):
+    def __init__(self, filepath="contrasts.json", lazy=True):
         """
-        Initializes the ContrastManager by loading contrasts from a specified JSON file.
+        Initializes the ContrastManager for a specified JSON file.
 
         Parameters:
         filepath (str): The path to the JSON file containing contrast definitions.
+        lazy (bool): If True, the file is loaded on first access instead of immediately.
         """
-        self.contrasts = {}
-        self._load_contrasts_from_file(filepath)
+        self.filepath = filepath
+        self._contrasts = None
+        # Design columns -> (C x P matrix, name -> row index)
+        self._compiled = {}
+        if not lazy:
+            self._load_contrasts_from_file(filepath)
+
+    @property
+    def contrasts(self):
+        """Dictionary of contrast name -> definition, loaded from the file on first access."""
+        if self._contrasts is None:
+            self._load_contrasts_from_file(self.filepath)
+        return self._contrasts
+
+    @contrasts.setter
+    def contrasts(self, contrasts):
+        self._contrasts = contrasts
+        self._compiled = {}
 
     def _load_contrasts_from_file(self, filepath):
         """
@@ -60,3 +89,90 @@ class ContrastManager:
         list: A list of all contrast names.
         """
         return list(self.contrasts.keys())
+
+    def select(self, pattern, regex=False):
+        """
+        Selects contrast names by a glob pattern (e.g. 'real > pseudo*') or a regular expression.
+
+        Parameters:
+        pattern (str): Glob pattern matched against whole names, or a regular expression
+                       searched for in the names if regex is True.
+        regex (bool): Interpret pattern as a regular expression.
+
+        Returns:
+        list: Matching contrast names, in file order.
+        """
+        if regex:
+            compiled = re.compile(pattern)
+            return [name for name in self.contrasts if compiled.search(name)]
+        return [name for name in self.contrasts if fnmatch.fnmatchcase(name, pattern)]
+
+    def resolve(self, name_or_pattern):
+        """
+        Resolves a contrast name given on the command line: 'all' selects every contrast,
+        a glob pattern (e.g. 'real > pseudo*') the contrasts it matches, and any other
+        value the contrast of that name.
+
+        Parameters:
+        name_or_pattern (str): 'all', a glob pattern or a contrast name.
+
+        Returns:
+        list: Contrast names, in file order for 'all' and patterns.
+
+        Raises:
+        ValueError: If no contrast matches the pattern or the name is not found.
+        """
+        if name_or_pattern == 'all':
+            return self.list_contrasts()
+        if is_pattern(name_or_pattern):
+            contrast_names = self.select(name_or_pattern)
+            if not contrast_names:
+                raise ValueError(f"No contrast in {self.filepath} matches '{name_or_pattern}'")
+            return contrast_names
+        if name_or_pattern not in self.contrasts:
+            raise ValueError(f"Contrast '{name_or_pattern}' not found in {self.filepath}")
+        return [name_or_pattern]
+
+    def get_matrix(self, contrast_names, design_columns):
+        """
+        Returns the C x P weights of several contrasts for a design matrix.
+
+        Contrasts are compiled and checked against the design columns the first time they
+        are requested for that design (see multi_contrast.stack_contrast_weights); later
+        calls only gather cached rows.
+
+        Parameters:
+        contrast_names (list): Names of the contrasts, in row order.
+        design_columns (list or pd.Index): Columns of the design matrix.
+
+        Returns:
+        np.ndarray: Contrast matrix of shape (len(contrast_names), len(design_columns)).
+
+        Raises:
+        ValueError: If a contrast is not found or does not fit the design matrix.
+        """
+        import numpy as np
+        from multi_contrast import stack_contrast_weights
+
+        design_key = tuple(str(col) for col in design_columns)
+        matrix, row_index = self._compiled.get(design_key, (np.zeros((0, len(design_key))), {}))
+
+        new_names = [name for name in dict.fromkeys(contrast_names) if name not in row_index]
+        if new_names:
+            missing = [name for name in new_names if name not in self.contrasts]
+            if missing:
+                raise ValueError(f"Contrasts not found in {self.filepath}: {missing}")
+            new_rows = stack_contrast_weights(self, new_names, design_key)
+            row_index = {**row_index, **{name: len(row_index) + i for i, name in enumerate(new_names)}}
+            matrix = np.vstack([matrix, new_rows])
+            matrix.flags.writeable = False
+            self._compiled[design_key] = (matrix, row_index)
+
+        return matrix[[row_index[name] for name in contrast_names]]
+
+    def row_index(self, design_columns):
+        """
+        Name -> row index of the contrasts compiled so far for a design matrix.
+        """
+        design_key = tuple(str(col) for col in design_columns)
+        return dict(self._compiled.get(design_key, (None, {}))[1])
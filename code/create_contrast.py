@@ -1,85 +1,134 @@
-import numpy as np
+import itertools
 import json
 
-def create_contrast_vector(contrast_rule):
+import numpy as np
+
+from compute_contrast import CONDITIONS, get_regressor_index
+
+
+def condition_columns():
     """
-    Creates a contrast vector (48-dim) based on a given contrast rule.
-    It assigns 1s and -1s and then scales the values only if the vector
-    does not sum to zero to ensure a zero sum.
+    Names of all task conditions of the factorial design, in design-matrix (alphabetical) order,
+    e.g. 'audio_speech_pseudo_long_complex'. Pseudowords have no frequency level.
     """
-    vector = np.zeros(48)
-    
-    group_indices = {
-    'audio': list(range(0, 24)),
-    'visual': list(range(24, 48)),
-    'speech': list(range(0, 12)) + list(range(24, 36)),
-    'write': list(range(12, 24)) + list(range(36, 48)),
-    'pseudo': [0, 1, 2, 3, 12, 13, 14, 15, 24, 25, 26, 27, 36, 37, 38, 39],
-    'real': [4, 5, 6, 7, 8, 9, 10, 11, 16, 17, 18, 19, 20, 21, 22, 23, 28, 29, 30, 31, 32, 33, 34, 35, 40, 41, 42, 43, 44, 45, 46, 47],
-    'long': [0, 1, 4, 5, 6, 7, 12, 13, 16, 17, 18, 19, 24, 25, 28, 29, 30, 31, 36, 37, 40, 41, 42, 43],
-    'short': [2, 3, 8, 9, 10, 11, 14, 15, 20, 21, 22, 23, 26, 27, 32, 33, 34, 35, 38, 39, 44, 45, 46, 47],
-    'complex': [0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30, 32, 34, 36, 38, 40, 42, 44, 46],
-    'simple': [1, 3, 5, 7, 9, 11, 13, 15, 17, 19, 21, 23, 25, 27, 29, 31, 33, 35, 37, 39, 41, 43, 45, 47],
-    'high': [4, 5, 8, 9, 16, 17, 20, 21, 28, 29, 32, 33, 40, 41, 44, 45],
-    'low': [6, 7, 10, 11, 18, 19, 22, 23, 30, 31, 34, 35, 42, 43, 46, 47]
-}
+    columns = set()
+    for levels in itertools.product(*CONDITIONS.values()):
+        features = dict(zip(CONDITIONS, levels))
+        if features["lexicality"] == "pseudo":
+            del features["frequency"]
+        columns.add("_".join(features.values()))
+    return sorted(columns)
 
+
+def parse_contrast_rule(contrast_rule):
+    """
+    Splits a rule like 'high > low | real | audio' into ('high', 'low', ['real', 'audio']).
+    """
     parts = contrast_rule.split('|')
     main_contrast_str = parts[0].strip()
     filters = [f.strip() for f in parts[1:]]
-    pos_group, neg_group = main_contrast_str.split('>')
-    pos_group = pos_group.strip()
-    neg_group = neg_group.strip()
-
-    base_indices = set(range(48))
-    for f in filters:
-        if f in group_indices:
-            base_indices = base_indices.intersection(set(group_indices[f]))
-    
-    pos_indices = sorted(list(set(group_indices.get(pos_group, [])).intersection(base_indices)))
-    neg_indices = sorted(list(set(group_indices.get(neg_group, [])).intersection(base_indices)))
-    
-    for idx in pos_indices:
-        vector[idx] = 1
-    for idx in neg_indices:
-        vector[idx] = -1
-
-    if np.isclose(np.sum(vector), 0):
-        return vector
-    else:
-        n_pos = len(pos_indices)
-        n_neg = len(neg_indices)
-        if n_pos == 0 or n_neg == 0:
-            raise ValueError("One or both groups are empty after filtering.")
-        
-        pos_weight = 1 / n_pos
-        neg_weight = 1 / n_neg
-        
-        scaled_vector = np.zeros(48)
-        for idx in pos_indices:
-            scaled_vector[idx] = pos_weight
-        for idx in neg_indices:
-            scaled_vector[idx] = -neg_weight
-        
-        return scaled_vector
-
-
-def create_contrast_dict(contrast_rule, task="swp"):
+    groups = main_contrast_str.split('>')
+    if len(groups) != 2:
+        raise ValueError(f"Contrast rule '{contrast_rule}' must have the form 'positive > negative | filter | ...'.")
+    return groups[0].strip(), groups[1].strip(), filters
+
+
+def compile_contrast_rules(contrast_rules, design_columns):
+    """
+    Compiles contrast rules into weights over the columns of an actual design matrix.
+
+    Every factor level of CONDITIONS is a bitmask over the design columns (from
+    compute_contrast.RegressorFeatureIndex). A rule selects the task regressors in all of
+    its filters, then its positive and negative groups within those. Groups of equal size
+    get +1/-1; otherwise the groups are scaled to +1/n_pos and -1/n_neg so that the weights
+    sum to zero. Unknown group or filter terms, and groups that select no regressor, are
+    errors. Confounds, drifts and the constant get 0, and
+    with run-suffixed columns every run of a condition is weighted.
+
+    Args:
+        contrast_rules (list): Rules like 'real > pseudo | audio'.
+        design_columns (list or pd.Index): Columns of the design matrix.
+
+    Returns:
+        tuple: (C x P weights, dict of rule -> error message). Rules that could not be
+               compiled have all-zero rows.
+    """
+    index = get_regressor_index(design_columns)
+    value_levels = {value: i for i, (_, value) in enumerate(index.levels)}
+    n_rules, n_levels = len(contrast_rules), len(index.levels)
+
+    positive_levels = np.zeros((n_rules, n_levels), dtype=bool)
+    negative_levels = np.zeros((n_rules, n_levels), dtype=bool)
+    filter_levels = np.zeros((n_rules, n_levels), dtype=bool)
+    errors = {}
+    for i, contrast_rule in enumerate(contrast_rules):
+        try:
+            pos_group, neg_group, filters = parse_contrast_rule(contrast_rule)
+        except ValueError as e:
+            errors[contrast_rule] = str(e)
+            continue
+        unknown = [value for value in [pos_group, neg_group] + filters if value not in value_levels]
+        if unknown:
+            errors[contrast_rule] = f"Unknown group or filter term(s) {unknown}."
+            continue
+        for levels, values in [(positive_levels, [pos_group]), (negative_levels, [neg_group]),
+                               (filter_levels, filters)]:
+            levels[i, [value_levels[value] for value in values if value in value_levels]] = True
+
+    # Set algebra on bitmasks: base = task & all filters, groups = base & group level
+    has_filters = filter_levels.any(axis=1)
+    base = np.where(has_filters[:, None], index.match(filter_levels), True) & index.is_task
+    positive = (positive_levels.astype(np.int32) @ index.membership.T.astype(np.int32) > 0) & base
+    negative = (negative_levels.astype(np.int32) @ index.membership.T.astype(np.int32) > 0) & base
+
+    # A regressor in both groups counts as negative
+    weights = np.where(negative, -1.0, np.where(positive, 1.0, 0.0))
+    n_positive, n_negative = positive.sum(axis=1), negative.sum(axis=1)
+    for i in np.flatnonzero((n_positive == 0) | (n_negative == 0)):
+        errors.setdefault(contrast_rules[i], "One or both groups are empty after filtering.")
+    unbalanced = ~np.isclose(weights.sum(axis=1), 0)
+    for i in np.flatnonzero(unbalanced):
+        if contrast_rules[i] in errors:
+            continue
+        weights[i] = np.where(negative[i], -1.0 / n_negative[i], np.where(positive[i], 1.0 / n_positive[i], 0.0))
+    for contrast_rule in errors:
+        weights[contrast_rules.index(contrast_rule)] = 0
+    return weights, errors
+
+
+def create_contrast_vector(contrast_rule, design_columns=None):
+    """
+    Creates a contrast vector based on a given contrast rule, over design_columns
+    (default: the task conditions of the full factorial design, see condition_columns).
+    It assigns 1s and -1s and then scales the values only if the vector
+    does not sum to zero to ensure a zero sum.
+    """
+    if design_columns is None:
+        design_columns = condition_columns()
+    weights, errors = compile_contrast_rules([contrast_rule], design_columns)
+    if errors:
+        raise ValueError(errors[contrast_rule])
+    return weights[0]
+
+
+def create_contrast_dict(contrast_rule, task="swp", weights_vector=None):
     """
     Generates a dictionary for a contrast rule, including the weighted vector.
 
     Args:
         contrast_rule (str): The contrast rule, e.g., 'audio > visual'.
         task (str, optional): The name of the task. Defaults to "swp".
+        weights_vector (np.ndarray, optional): Precompiled weights; computed from the rule if None.
 
     Returns:
         dict: A dictionary containing the contrast definition.
     """
-    try:
-        weights_vector = create_contrast_vector(contrast_rule)
-    except ValueError as e:
-        print(f"Skipping rule '{contrast_rule}' due to error: {e}")
-        return {}
+    if weights_vector is None:
+        try:
+            weights_vector = create_contrast_vector(contrast_rule)
+        except ValueError as e:
+            print(f"Skipping rule '{contrast_rule}' due to error: {e}")
+            return {}
     
     # Use the contrast_rule directly as the dictionary key
     dict_key = contrast_rule
@@ -87,11 +136,8 @@ def create_contrast_dict(contrast_rule, task="swp"):
     # Set the name field to be the same as the contrast_rule
     name = contrast_rule
     
-    parts = contrast_rule.split('|')
-    main_contrast_str = parts[0].strip()
-    pos_group, neg_group = main_contrast_str.split('>')
-    
-    description = f"Contrast comparing {pos_group.strip()} and {neg_group.strip()} conditions"
+    pos_group, neg_group, _ = parse_contrast_rule(contrast_rule)
+    description = f"Contrast comparing {pos_group} and {neg_group} conditions"
     
     contrast_dict = {
         dict_key: {
@@ -103,84 +149,92 @@ def create_contrast_dict(contrast_rule, task="swp"):
     }
     return contrast_dict
 
-def generate_contrast_json_object(contrast_rules, task="swp"):
+def generate_contrast_json_object(contrast_rules, task="swp", design_columns=None):
     """
     Generates a single Python dictionary from a list of contrast rules.
+    All rules are compiled in one pass over design_columns (default: condition_columns()).
     """
+    if design_columns is None:
+        design_columns = condition_columns()
+    weights, errors = compile_contrast_rules(list(contrast_rules), design_columns)
+
     all_contrasts = {}
-    for rule in contrast_rules:
-        single_contrast = create_contrast_dict(rule, task)
-        all_contrasts.update(single_contrast)
+    for rule, weights_vector in zip(contrast_rules, weights):
+        if rule in errors:
+            print(f"Skipping rule '{rule}' due to error: {errors[rule]}")
+            continue
+        all_contrasts.update(create_contrast_dict(rule, task, weights_vector))
     return all_contrasts
 
-# Define a list of example contrast rules
-example_rules = [
-    # audio > visual
-    "audio > visual",
-    "audio > visual | speech",
-    "audio > visual | write",
+if __name__ == '__main__':
+    # Define a list of example contrast rules
+    example_rules = [
+        # audio > visual
+        "audio > visual",
+        "audio > visual | speech",
+        "audio > visual | write",
     
-    # speech > write
-    "speech > write",
-    "speech > write | audio",
-    "speech > write | visual",
+        # speech > write
+        "speech > write",
+        "speech > write | audio",
+        "speech > write | visual",
     
-    # long > short
-    "long > short",
-    "long > short | audio",
-    "long > short | visual",
-    "long > short | speech",
-    "long > short | write",
-    "long > short | audio | speech",
-    "long > short | audio | write",
-    "long > short | visual | speech",
-    "long > short | visual | write",
+        # long > short
+        "long > short",
+        "long > short | audio",
+        "long > short | visual",
+        "long > short | speech",
+        "long > short | write",
+        "long > short | audio | speech",
+        "long > short | audio | write",
+        "long > short | visual | speech",
+        "long > short | visual | write",
     
-    # real > pseudo
-    "real > pseudo",
-    "real > pseudo | audio",
-    "real > pseudo | visual",
-    "real > pseudo | speech",
-    "real > pseudo | write",
-    "real > pseudo | audio | speech",
-    "real > pseudo | audio | write",
-    "real > pseudo | visual | speech",
-    "real > pseudo | visual | write",
+        # real > pseudo
+        "real > pseudo",
+        "real > pseudo | audio",
+        "real > pseudo | visual",
+        "real > pseudo | speech",
+        "real > pseudo | write",
+        "real > pseudo | audio | speech",
+        "real > pseudo | audio | write",
+        "real > pseudo | visual | speech",
+        "real > pseudo | visual | write",
     
-    # complex > simple
-    "complex > simple",
-    "complex > simple | audio",
-    "complex > simple | visual",
-    "complex > simple | speech",
-    "complex > simple | write",
-    "complex > simple | audio | speech",
-    "complex > simple | audio | write",
-    "complex > simple | visual | speech",
-    "complex > simple | visual | write",
+        # complex > simple
+        "complex > simple",
+        "complex > simple | audio",
+        "complex > simple | visual",
+        "complex > simple | speech",
+        "complex > simple | write",
+        "complex > simple | audio | speech",
+        "complex > simple | audio | write",
+        "complex > simple | visual | speech",
+        "complex > simple | visual | write",
     
-    # high > low | real
-    "high > low | real | audio",
-    "high > low | real | visual",
-    "high > low | real | audio | speech",
-    "high > low | real | audio | write",
-    "high > low | real | visual | speech",
-    "high > low | real | visual | write",
-]
-
-# 1. Generate the Python dictionary
-contrasts_data = generate_contrast_json_object(example_rules)
-
-# 2. Save the dictionary as a JSON file, with a compact format for the weights
-file_path = "contrasts.json"
-with open(file_path, "w") as json_file:
-    # Use json.dumps to get a string representation with custom formatting
-    formatted_json_string = json.dumps(contrasts_data, indent=4)
+        # high > low | real
+        "high > low | real | audio",
+        "high > low | real | visual",
+        "high > low | real | audio | speech",
+        "high > low | real | audio | write",
+        "high > low | real | visual | speech",
+        "high > low | real | visual | write",
+    ]
+
+    # 1. Generate the Python dictionary
+    contrasts_data = generate_contrast_json_object(example_rules)
+
+    # 2. Save the dictionary as a JSON file, with a compact format for the weights
+    file_path = "contrasts.json"
+    with open(file_path, "w") as json_file:
+        # Use json.dumps to get a string representation with custom formatting
+        formatted_json_string = json.dumps(contrasts_data, indent=4)
     
-    # Replace the default list formatting with a compact single-line version
-    for key, value in contrasts_data.items():
-        weights_list_str = str(value['weights']).replace(' ', '')
-        formatted_json_string = formatted_json_string.replace(json.dumps(value['weights']), weights_list_str)
+        # Replace the default list formatting with a compact single-line version
+        for key, value in contrasts_data.items():
+            weights_list_str = str(value['weights']).replace(' ', '')
+            formatted_json_string = formatted_json_string.replace(json.dumps(value['weights']), weights_list_str)
 
-    json_file.write(formatted_json_string)
+        json_file.write(formatted_json_string)
 
-print(f"✅ Successfully saved {len(contrasts_data)} contrasts to '{file_path}'.")
\ No newline at end of file
+    print(f"✅ Successfully saved {len(contrasts_data)} contrasts to '{file_path}'.")
\ No newline at end of file
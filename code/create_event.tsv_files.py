@@ -1,353 +0,0 @@
-import pandas as pd
-import os
-from pathlib import Path
-
-# Base directory for BIDS output (relative to script location)
-SCRIPT_DIR = Path(__file__).parent
-BASE_BIDS_DIR = (SCRIPT_DIR.parent / "data/derivatives")
-EVENT_TSVS_DIR = (SCRIPT_DIR.parent / "event_tsvs")
-
-# Function for condition mappings
-# Extract the trial_type from Condition and Modalities
-
-def build_trial_type_list(df):
-    # Mappings for Condition column parts
-    lexicality_map = {'R': 'real', 'P': 'pseudo'}
-    length_map = {'L': 'long', 'S': 'short'}
-    frequency_map = {'L': 'low', 'H': 'high'}
-    complexity_map = {'S': 'simple', 'C': 'complex'}
-
-    def trial_type_row(row):
-        # Input and output modalities
-        input_mod = row['Input Modality'].lower()
-        output_mod = row['Output Modality'].lower()
-        # Condition string
-        cond = row['Condition']
-        # Lexicality, Length, Frequency, Complexity
-        lexicality = lexicality_map.get(cond[0], cond[0])
-        length = length_map.get(cond[1], cond[1])
-        # If pseudo, skip frequency
-        if cond[0] == 'P':
-            complexity = complexity_map.get(cond[2], cond[2])
-            trial_parts = [input_mod, output_mod, lexicality, length, complexity]
-        else:
-            frequency = frequency_map.get(cond[2], cond[2])
-            complexity = complexity_map.get(cond[3], cond[3])
-            trial_parts = [input_mod, output_mod, lexicality, length, frequency, complexity]
-        return '_'.join(trial_parts)
-
-    return trial_type_row
-
-    
-# Function to create event tsv files from run csvs
-def create_main_event_files(RUN_DIR, SUBJECT_ID, RUN_NUM):
-    
-    # Load the csv files from the data directory
-    event_df = pd.read_csv(os.path.join(RUN_DIR, f'{SUBJECT_ID}_run_{RUN_NUM}.csv'))
-    """
-    Create the event_df DataFrame with the required columns
-    Calculate base onset (start time of each trial)
-    Initial 5s delay, then cumulative sum of previous trial durations
-    All times seconds
-    The term (event_df['Trial Duration'].cumsum() - event_df['Trial Duration'])
-    gives the sum of durations of all preceding trials
-    """
-     
-    # Determine if Input or Output Modalities changed compared to the previous trial
-    input_modality_changed = (event_df['Input Modality'] != event_df['Input Modality'].shift(1)).fillna(False)
-    output_modality_changed = (event_df['Output Modality'] != event_df['Output Modality'].shift(1)).fillna(False)
-    
-    # A modality change event occurs if either input or output modality has changed
-    modality_change_event = input_modality_changed | output_modality_changed
-
-    # Ensure the first trial never has a modality change penalty
-    if not modality_change_event.empty:
-        modality_change_event.iloc[0] = False
-    
-    # Calculate base onset times (initial 5s delay + sum of previous trial durations)
-    # All times in seconds.
-    # The term (event_df['Trial Duration'].cumsum() - event_df['Trial Duration'])
-    # gives the sum of durations of all preceding trials.
-    initial_delay = 5
-    sum_prev_durations = (event_df['Trial Duration'].cumsum() - event_df['Trial Duration'])
-    base_onset = initial_delay + sum_prev_durations
-    
-    # Define the rest period for modality change
-    modality_rest = 15
-    
-    # Calculate cumulative penalty from modality changes.
-    # A penalty of modality_rest_ms is applied for each trial where a modality change occurs.
-    # This penalty is cumulative, affecting the onset of the current trial and all subsequent trials.
-    penalties_for_change = modality_change_event.astype(int) * modality_rest
-    cumulative_penalties = penalties_for_change.cumsum()
-    
-    # The final 'onset' is the base_onset plus the cumulative penalty from modality changes
-    onset_times = base_onset + cumulative_penalties
-    event_df['onset'] = onset_times
-    # Assign duration: 9.0 for Write or Type, 4.0 for Speech
-    event_df['duration'] = event_df['Output Modality'].apply(lambda x: 4.0 if x == "Speech" else 9.0 if x in ["Write", "Type"] else 9.0)
-    
-    # Correction for subject 1: duration should be 4.0 when onset is 82.0 due to csv error during experiment 
-    if SUBJECT_ID == "sub01":
-        mask = event_df['onset'] == 82.0
-        event_df.loc[mask, 'duration'] = 4.0
-    
-    # Apply trial_type based on conditions
-    trial_type_func = build_trial_type_list(event_df)
-    event_df['trial_type'] = event_df.apply(trial_type_func, axis=1)
-
-    # Change 'Type' to 'Write' in the trial_type column for consistency
-    event_df['trial_type'] = event_df['trial_type'].str.replace('type', 'write', case=False)
-
-    # Limit the DataFrame to the required columns
-    event_df = event_df[['onset', 'duration', 'trial_type']]
-
-    # Prepare BIDS compliant path and filename
-    subject_label = SUBJECT_ID.replace('sub', '')
-    if subject_label.isdigit() and len(subject_label) == 1:
-        subject_label = f"0{subject_label}"
-    
-    run_label = RUN_NUM
-    if run_label.isdigit() and len(run_label) == 1:
-        run_label = f"0{run_label}"
-
-    output_dir = BASE_BIDS_DIR / f"sub-{subject_label}" / "ses-1" / "func"
-    os.makedirs(output_dir, exist_ok=True)
-    
-    filename = f"sub-{subject_label}_ses-1_task-swp_run-{run_label}_events.tsv"
-    output_path = output_dir / filename
-    
-    # Save the DataFrame to a tsv file
-    event_df.to_csv(output_path, sep='\t', index=False)
-    # Also save a copy to the event_tsvs directory
-    EVENT_TSVS_DIR.mkdir(exist_ok=True)
-    event_df.to_csv(EVENT_TSVS_DIR / filename, sep='\t', index=False)
-    
-    
-    
-
-def create_visual_localizer_event_files(CSV_PATH, SUBJECT_ID):
-    visual_stim_df_raw = pd.read_csv(CSV_PATH)
-    
-    # Create a new DataFrame with the required columns 
-    visual_stim_df = pd.DataFrame()
-    visual_stim_df['trial_type'] = visual_stim_df_raw['cond']
-    
-    # Set a fixed duration of 6 seconds for all trials
-    visual_stim_df['duration'] = 6.0
-    
-    # Set the initial delay for the first trial
-    initial_delay = 6.0
-    
-    # Set rest time between trials
-    rest_time = 6.0
-    
-    # Initialize onset times list
-    onset_times = [initial_delay] 
-
-    # Calculate base onset times (initial 6s delay + cumulative sum of previous trial durations)
-    for i in range(1, len(visual_stim_df)):
-        # The next onset is the previous onset + previous duration
-        next_onset = onset_times[i-1] + visual_stim_df.at[i-1, 'duration'] + rest_time
-        onset_times.append(next_onset)
-    
-    visual_stim_df['onset'] = onset_times
-
-    # Reorder columns
-    visual_stim_df = visual_stim_df[['onset', 'duration', 'trial_type']]
-
-    # Prepare BIDS compliant path and filename
-    subject_label = SUBJECT_ID.replace('sub', '')
-    if subject_label.isdigit() and len(subject_label) == 1:
-        subject_label = f"0{subject_label}"
-
-    output_dir = BASE_BIDS_DIR / f"sub-{subject_label}" / "ses-1" / "func"
-    os.makedirs(output_dir, exist_ok=True)
-
-    filename = f"sub-{subject_label}_ses-1_task-locvis_events.tsv"
-    output_path = output_dir / filename
-    
-    # Save the DataFrame to a tsv file
-    visual_stim_df.to_csv(output_path, sep='\t', index=False)
-    # Also save a copy to the event_tsvs directory
-    EVENT_TSVS_DIR.mkdir(exist_ok=True)
-    visual_stim_df.to_csv(EVENT_TSVS_DIR / filename, sep='\t', index=False)
-    print(f"Visual localizer event file created: {output_path}")
-
-
-def create_auditory_localizer_event_files(CSV_PATH, SUBJECT_ID):
-    auditory_stim_df_raw = pd.read_csv(CSV_PATH)
-    
-    # Create a new DataFrame with the required columns 
-    auditory_stim_df = pd.DataFrame()
-    auditory_stim_df['onset'] = auditory_stim_df_raw['onset']/ 1000  # Convert ms to seconds
-    
-    auditory_stim_df['trial_type'] = auditory_stim_df_raw['stim'].str[:-6]
-    
-    # Assign duration based on trial_type
-    auditory_stim_df['duration'] = auditory_stim_df['trial_type'].apply(lambda x: 2.0 if x == 'scrambled_words' else 1.0)
-    
-    # Ensure the trial_type column is properly assigned and reorder if necessary
-    # If 'onset', 'duration', 'trial_type' are the only columns desired in a specific order:
-    auditory_stim_df = auditory_stim_df[['onset', 'duration', 'trial_type']]
-
-    # Prepare BIDS compliant path and filename
-    subject_label = SUBJECT_ID.replace('sub', '')
-    if subject_label.isdigit() and len(subject_label) == 1:
-        subject_label = f"0{subject_label}"
-
-    output_dir = BASE_BIDS_DIR / f"sub-{subject_label}" / "ses-1" / "func"
-    os.makedirs(output_dir, exist_ok=True)
-    
-    filename = f"sub-{subject_label}_ses-1_task-locaudio_events.tsv"
-    output_path = output_dir / filename
-    
-    # Save the DataFrame to a tsv file
-    auditory_stim_df.to_csv(output_path, sep='\t', index=False)
-    # Also save a copy to the event_tsvs directory
-    EVENT_TSVS_DIR.mkdir(exist_ok=True)
-    auditory_stim_df.to_csv(EVENT_TSVS_DIR / filename, sep='\t', index=False)
-    print(f"Auditory localizer event file created: {output_path}")
-    
-
-def create_hand_localizer_event_files(CSV_PATH, SUBJECT_ID):
-    hand_stim_df_raw = pd.read_csv(CSV_PATH)
-    # Create a new DataFrame with the required columns
-    hand_stim_df = pd.DataFrame()
-    
-    hand_stim_df['onset'] = hand_stim_df_raw['onset'] / 1000  # Convert ms to seconds
-    hand_stim_df['trial_type'] = hand_stim_df_raw['stim'].str[:-4]  # Remove the last 4 characters
-    hand_stim_df['type'] = hand_stim_df_raw['type']  # Keep the type column for calculating duratuib
-    
-    # Remove irrelevant rows
-    hand_stim_df = hand_stim_df[hand_stim_df['type'] != 'blank']
-    hand_stim_df = hand_stim_df[hand_stim_df['trial_type'] != 'write']
-    
-    # Rename all trial_type values that are not 'finger' to 'write' (i.e., words)
-    hand_stim_df.loc[hand_stim_df['trial_type'] != 'finger', 'trial_type'] = 'write'
-    
-    # Assign duration based on trial_type
-    def assign_duration(row):
-        if row['trial_type'] == 'finger':
-            return 10.0
-        elif row['trial_type'] == 'write':
-            return 10.0
-
-    
-    hand_stim_df['duration'] = hand_stim_df.apply(assign_duration, axis=1)
-    
-    # Reorder columns to match the desired output
-    hand_stim_df = hand_stim_df[['onset', 'duration', 'trial_type']]
-
-    # Drop rows with missing trial_type, if any
-    hand_stim_df = hand_stim_df.dropna(subset=['trial_type'])
-    
-    # Prepare BIDS compliant path and filename
-    subject_label = SUBJECT_ID.replace('sub', '')
-    if subject_label.isdigit() and len(subject_label) == 1:
-        subject_label = f"0{subject_label}"
-
-    output_dir = BASE_BIDS_DIR / f"sub-{subject_label}" / "ses-1" / "func"
-    os.makedirs(output_dir, exist_ok=True)
-    
-    filename = f"sub-{subject_label}_ses-1_task-lochand_events.tsv"
-    output_path = output_dir / filename
-    
-    # Save the DataFrame to a tsv file
-    hand_stim_df.to_csv(output_path, sep='\t', index=False)
-    # Also save a copy to the event_tsvs directory
-    EVENT_TSVS_DIR.mkdir(exist_ok=True)
-    hand_stim_df.to_csv(EVENT_TSVS_DIR / filename, sep='\t', index=False)
-    print(f"Hand localizer event file created: {output_path}")
-
-
-def create_speech_localizer_event_files(CSV_PATH, SUBJECT_ID):
-    speech_stim_df_raw = pd.read_csv(CSV_PATH)
-    # Create a new DataFrame with the required columns
-    speech_stim_df = pd.DataFrame()
-    
-    speech_stim_df['onset'] = speech_stim_df_raw['onset'] / 1000  # Convert ms to seconds
-    speech_stim_df['trial_type'] = speech_stim_df_raw['stim'].str[:-4]  # Remove the last 4 characters
-    speech_stim_df['type'] = speech_stim_df_raw['type']  # Keep the type column for calculating duratuib
-    
-    # Remove irrelevant rows
-    speech_stim_df = speech_stim_df[speech_stim_df['type'] != 'blank']
-    speech_stim_df = speech_stim_df[speech_stim_df['trial_type'] != 'speech']
-    
-    # Rename all trial_type values that are not 'hum' to 'speech' (i.e., words)
-    speech_stim_df.loc[speech_stim_df['trial_type'] != 'hum', 'trial_type'] = 'speech'
-    
-
-    def assign_duration(row):
-        if row['trial_type'] == 'hum':
-            return 10.0
-        elif row['trial_type'] == 'speech':
-            return 5.0
-
-    
-    speech_stim_df['duration'] = speech_stim_df.apply(assign_duration, axis=1)
-    
-    # Reorder columns to match the desired output
-    speech_stim_df = speech_stim_df[['onset', 'duration', 'trial_type']]
-
-    # Drop rows with missing trial_type, if any
-    speech_stim_df = speech_stim_df.dropna(subset=['trial_type'])
-    
-    # Prepare BIDS compliant path and filename
-    subject_label = SUBJECT_ID.replace('sub', '')
-    if subject_label.isdigit() and len(subject_label) == 1:
-        subject_label = f"0{subject_label}"
-
-    output_dir = BASE_BIDS_DIR / f"sub-{subject_label}" / "ses-1" / "func"
-    os.makedirs(output_dir, exist_ok=True)
-    
-    filename = f"sub-{subject_label}_ses-1_task-locspeech_events.tsv"
-    output_path = output_dir / filename
-    
-    # Save the DataFrame to a tsv file
-    speech_stim_df.to_csv(output_path, sep='\t', index=False)
-    # Also save a copy to the event_tsvs directory
-    EVENT_TSVS_DIR.mkdir(exist_ok=True)
-    speech_stim_df.to_csv(EVENT_TSVS_DIR / filename, sep='\t', index=False)
-    print(f"Speech localizer event file created: {output_path}")
-
-def create_all_event_files_for_subject(sub_num):
-    """
-    Generate all event files for a given subject
-    Handles zero-padding for single-digit subjects
-    """
-    # Ensure subject number is a string and zero-padded
-    sub_num_str = str(sub_num).zfill(2)
-    subject_id = f"sub{sub_num_str}"
-
-    RUN_DIR = (SCRIPT_DIR.parent / f"run_csvs/SWP_Pilot_{sub_num}/").resolve()
-
-    for i in range(1, 7):
-        create_main_event_files(Path(RUN_DIR), SUBJECT_ID=subject_id, RUN_NUM=str(i))
-
-    create_visual_localizer_event_files(
-        CSV_PATH=(SCRIPT_DIR.parent / f"run_csvs/SWP_Pilot_{sub_num}/{subject_id}_vis.csv"),
-        SUBJECT_ID=subject_id
-    )
-
-    create_auditory_localizer_event_files(
-        CSV_PATH=(SCRIPT_DIR.parent / f"run_csvs/SWP_Pilot_{sub_num}/{subject_id}_audio.csv"),
-        SUBJECT_ID=subject_id
-    )
-
-    create_hand_localizer_event_files(
-        CSV_PATH=(SCRIPT_DIR.parent / f"run_csvs/SWP_Pilot_{sub_num}/{subject_id}_hand.csv"),
-        SUBJECT_ID=subject_id
-    )
-
-    create_speech_localizer_event_files(
-        CSV_PATH=(SCRIPT_DIR.parent / f"run_csvs/SWP_Pilot_{sub_num}/{subject_id}_speech.csv"),
-        SUBJECT_ID=subject_id
-    )
-
-# Run the function for subjects 1, 2, and 3
-create_all_event_files_for_subject(1)
-create_all_event_files_for_subject(2)
-create_all_event_files_for_subject(3)
-
-
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Base directory for BIDS output (relative to script location)
+SCRIPT_DIR = Path(__file__).parent
+BASE_BIDS_DIR = (SCRIPT_DIR.parent / "data/derivatives")
+EVENT_TSVS_DIR = (SCRIPT_DIR.parent / "event_tsvs")
+RUN_CSVS_DIR = (SCRIPT_DIR.parent / "run_csvs")
+# One manifest per subject, so subjects can be processed in parallel
+MANIFEST_DIR = EVENT_TSVS_DIR / "manifests"
+
+# Bump when the event logic changes, so every subject is regenerated once
+EVENTS_VERSION = 2
+
+N_MAIN_RUNS = 6
+
+# Mappings for Condition column parts
+LEXICALITY_MAP = {'R': 'real', 'P': 'pseudo'}
+LENGTH_MAP = {'L': 'long', 'S': 'short'}
+FREQUENCY_MAP = {'L': 'low', 'H': 'high'}
+COMPLEXITY_MAP = {'S': 'simple', 'C': 'complex'}
+
+
+def _map_letters(letters, mapping):
+    """Maps condition letters to labels; unknown letters are kept as they are."""
+    return letters.map(mapping).fillna(letters)
+
+
+def build_trial_types(event_df):
+    """
+    Builds trial_type from the modalities and the Condition code, for all trials at once.
+    Condition codes are lexicality, length, (frequency, real words only) and complexity,
+    e.g. 'RSHC' -> real_short_high_complex and 'PLS' -> pseudo_long_simple.
+    """
+    cond = event_df['Condition'].astype(str)
+    is_pseudo = cond.str[0] == 'P'
+    parts = [event_df['Input Modality'].str.lower(),
+             event_df['Output Modality'].str.lower(),
+             _map_letters(cond.str[0], LEXICALITY_MAP),
+             _map_letters(cond.str[1], LENGTH_MAP)]
+    # Pseudowords have no frequency letter, so their complexity letter comes one earlier
+    frequency = "_" + _map_letters(cond.str[2], FREQUENCY_MAP)
+    complexity = _map_letters(cond.str[2].where(is_pseudo, cond.str[3]), COMPLEXITY_MAP)
+    trial_type = parts[0] + "_" + parts[1] + "_" + parts[2] + "_" + parts[3] \
+        + frequency.where(~is_pseudo, "") + "_" + complexity
+
+    # Change 'Type' to 'Write' in the trial_type column for consistency
+    return trial_type.str.replace('type', 'write', case=False)
+
+
+def build_main_events(event_df, subject_id):
+    """
+    Computes onset, duration and trial_type of one main-task run.
+
+    Onsets start after an initial 5 s delay and add up the durations of all preceding
+    trials, plus a 15 s rest for every change of input or output modality.
+    """
+    # A modality change event occurs if either input or output modality has changed;
+    # the first trial never has a modality change penalty
+    modality_change_event = (event_df['Input Modality'] != event_df['Input Modality'].shift(1)) | \
+        (event_df['Output Modality'] != event_df['Output Modality'].shift(1))
+    modality_change_event.iloc[:1] = False
+
+    initial_delay = 5
+    modality_rest = 15
+    sum_prev_durations = event_df['Trial Duration'].cumsum() - event_df['Trial Duration']
+    cumulative_penalties = (modality_change_event.astype(int) * modality_rest).cumsum()
+
+    events = pd.DataFrame({'onset': initial_delay + sum_prev_durations + cumulative_penalties})
+    # Duration: 4.0 for Speech, 9.0 for Write or Type
+    events['duration'] = np.where(event_df['Output Modality'] == "Speech", 4.0, 9.0)
+
+    # Correction for subject 1: duration should be 4.0 when onset is 82.0 due to csv error during experiment
+    if subject_id == "sub01":
+        events.loc[events['onset'] == 82.0, 'duration'] = 4.0
+
+    events['trial_type'] = build_trial_types(event_df)
+    return events
+
+
+def build_visual_localizer_events(raw_df):
+    """Visual localizer: 6 s blocks, the first after 6 s, separated by 6 s of rest."""
+    duration, initial_delay, rest_time = 6.0, 6.0, 6.0
+    onsets = initial_delay + np.arange(len(raw_df)) * (duration + rest_time)
+    return pd.DataFrame({'onset': onsets, 'duration': duration, 'trial_type': raw_df['cond'].to_numpy()})
+
+
+def build_auditory_localizer_events(raw_df):
+    """Auditory localizer: onsets in ms; scrambled words last 2 s, everything else 1 s."""
+    trial_type = raw_df['stim'].str[:-6]
+    return pd.DataFrame({'onset': raw_df['onset'] / 1000,  # Convert ms to seconds
+                         'duration': np.where(trial_type == 'scrambled_words', 2.0, 1.0),
+                         'trial_type': trial_type})
+
+
+def _build_motor_localizer_events(raw_df, control, task, durations):
+    """
+    Hand and speech localizers: drops blanks and task instruction screens, labels every
+    non-control stimulus (i.e. words) as the task, and assigns a duration per trial type.
+    """
+    trial_type = raw_df['stim'].str[:-4]
+    keep = (raw_df['type'] != 'blank') & (trial_type != task)
+    trial_type = trial_type[keep].where(trial_type[keep] == control, task)
+    events = pd.DataFrame({'onset': raw_df['onset'][keep] / 1000,  # Convert ms to seconds
+                           'duration': trial_type.map(durations),
+                           'trial_type': trial_type})
+    return events.dropna(subset=['trial_type'])
+
+
+def build_hand_localizer_events(raw_df):
+    return _build_motor_localizer_events(raw_df, control='finger', task='write',
+                                         durations={'finger': 10.0, 'write': 10.0})
+
+
+def build_speech_localizer_events(raw_df):
+    return _build_motor_localizer_events(raw_df, control='hum', task='speech',
+                                         durations={'hum': 10.0, 'speech': 5.0})
+
+
+# Localizer tasks: source CSV suffix -> (BIDS task label, builder)
+LOCALIZERS = {
+    'vis': ('locvis', build_visual_localizer_events),
+    'audio': ('locaudio', build_auditory_localizer_events),
+    'hand': ('lochand', build_hand_localizer_events),
+    'speech': ('locspeech', build_speech_localizer_events),
+}
+
+
+def write_event_file(events_df, subject_label, filename):
+    """Saves an event table to the subject's BIDS func folder and a copy to event_tsvs."""
+    output_dir = BASE_BIDS_DIR / f"sub-{subject_label}" / "ses-1" / "func"
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = output_dir / filename
+    events_df.to_csv(output_path, sep='\t', index=False)
+    EVENT_TSVS_DIR.mkdir(exist_ok=True)
+    events_df.to_csv(EVENT_TSVS_DIR / filename, sep='\t', index=False)
+    return output_path
+
+
+def _find_source_csv(run_dir, sub_num, name):
+    """
+    Finds <subject>_<name>.csv, accepting both zero-padded (sub01) and plain (sub1) subject IDs.
+    """
+    for subject_id in (f"sub{sub_num:02d}", f"sub{sub_num}"):
+        path = Path(run_dir) / f"{subject_id}_{name}.csv"
+        if path.exists():
+            return path
+    return None
+
+
+def get_event_sources(sub_num):
+    """
+    Lists the event files of a subject and the run CSV each one is built from.
+
+    Returns:
+        dict: event TSV filename -> (builder kind, source CSV path). Kinds are 'main'
+              or a key of LOCALIZERS. Outputs whose source CSV is missing are left out.
+    """
+    subject_label = f"{sub_num:02d}"
+    run_dir = RUN_CSVS_DIR / f"SWP_Pilot_{sub_num}"
+    sources = {}
+    for run_num in range(1, N_MAIN_RUNS + 1):
+        source = _find_source_csv(run_dir, sub_num, f"run_{run_num}")
+        if source is not None:
+            sources[f"sub-{subject_label}_ses-1_task-swp_run-{run_num:02d}_events.tsv"] = ('main', source)
+    for name, (task, _) in LOCALIZERS.items():
+        source = _find_source_csv(run_dir, sub_num, name)
+        if source is not None:
+            sources[f"sub-{subject_label}_ses-1_task-{task}_events.tsv"] = (name, source)
+    return sources
+
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _manifest_path(sub_num):
+    return MANIFEST_DIR / f"sub-{sub_num:02d}.json"
+
+
+def _read_manifest(sub_num):
+    path = _manifest_path(sub_num)
+    if not path.exists():
+        return {}
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except json.JSONDecodeError:
+        return {}
+    return manifest if manifest.get('events_version') == EVENTS_VERSION else {}
+
+
+def _write_manifest(sub_num, manifest):
+    MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+    path = _manifest_path(sub_num)
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def create_all_event_files_for_subject(sub_num, force=False):
+    """
+    Generates the event files of one subject whose source CSVs changed since the last run.
+
+    The SHA-256 of every source CSV is kept in a per-subject manifest; an event file is
+    rebuilt only if its source hash changed, it is new, or its output file is missing.
+
+    Args:
+        sub_num (int): Subject number, e.g. 1.
+        force (bool, optional): Regenerate every event file of the subject. Defaults to False.
+
+    Returns:
+        tuple: (number of files written, number of files up to date)
+    """
+    subject_id = f"sub{sub_num:02d}"
+    subject_label = f"{sub_num:02d}"
+    sources = get_event_sources(sub_num)
+    if not sources:
+        print(f"WARNING: No run CSVs found for subject {sub_num} in {RUN_CSVS_DIR / f'SWP_Pilot_{sub_num}'}")
+
+    old_entries = {} if force else _read_manifest(sub_num).get('files', {})
+    entries, n_written = {}, 0
+    for filename, (kind, source) in sources.items():
+        source_hash = _hash_file(source)
+        entries[filename] = {'source': str(Path(source).relative_to(RUN_CSVS_DIR)), 'sha256': source_hash}
+        output_path = BASE_BIDS_DIR / f"sub-{subject_label}" / "ses-1" / "func" / filename
+        if old_entries.get(filename) == entries[filename] and output_path.exists():
+            continue
+
+        raw_df = pd.read_csv(source)
+        if kind == 'main':
+            events_df = build_main_events(raw_df, subject_id)
+        else:
+            events_df = LOCALIZERS[kind][1](raw_df)
+        write_event_file(events_df, subject_label, filename)
+        n_written += 1
+
+    _write_manifest(sub_num, {'events_version': EVENTS_VERSION, 'files': entries})
+    n_up_to_date = len(sources) - n_written
+    print(f"Subject {sub_num}: {n_written} event files written, {n_up_to_date} up to date.")
+    return n_written, n_up_to_date
+
+
+def create_event_files(subjects, n_jobs=1, force=False):
+    """
+    Generates the event files of several subjects, one subject per worker process.
+
+    Returns:
+        dict: subject -> (number of files written, number of files up to date)
+    """
+    if n_jobs <= 1 or len(subjects) <= 1:
+        return {sub_num: create_all_event_files_for_subject(sub_num, force) for sub_num in subjects}
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(subjects))) as pool:
+        futures = {sub_num: pool.submit(create_all_event_files_for_subject, sub_num, force)
+                   for sub_num in subjects}
+        return {sub_num: future.result() for sub_num, future in futures.items()}
+
+
+if __name__ == '__main__':
+    from parser import parse_event_arguments
+
+    args = parse_event_arguments()
+    create_event_files(args.subjects, n_jobs=args.n_jobs, force=args.force)
@@ -0,0 +1,257 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, the index is then single-process only
+    fcntl = None
+
+import pandas as pd
+
+
+INDEX_FILENAME = "index.json"
+LOCK_FILENAME = "index.json.lock"
+
+
+def _hash_dataframes(hasher, dfs):
+    """Feeds the column names and contents of a list of DataFrames into a hash."""
+    if dfs is None:
+        hasher.update(b"none")
+        return
+    for df in dfs:
+        if df is None:
+            hasher.update(b"none")
+            continue
+        hasher.update(json.dumps([str(col) for col in df.columns]).encode())
+        hasher.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+
+
+def _cached_source(path):
+    """Source of a copy registered in the cache index of its directory (see bold_cache), or None."""
+    index_path = os.path.join(os.path.dirname(path), INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    for entry in index.values():
+        if entry.get('filename') == os.path.basename(path):
+            return entry.get('description', {}).get('source')
+    return None
+
+
+def file_identity(fn_func):
+    """
+    Identity of a file: absolute path, size and modification time. A cached copy (the
+    uncompressed runs of bold_cache.BoldCache) is identified by its source, so keys do not
+    change when the copies are used in place of the sources.
+    """
+    path = os.path.abspath(fn_func)
+    source = _cached_source(path)
+    if source is not None and os.path.exists(source):
+        path = source
+    stat = os.stat(path)
+    return f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def compute_glm_key(fns_func, dfs_events, dfs_confounds, glm_params):
+    """
+    Computes a content hash identifying a GLM fit.
+
+    The key covers the identity of every functional file (see file_identity),
+    the contents of the event and confound tables, the GLM parameters and the
+    nilearn version, so changing any of them selects a different cache entry.
+    """
+    import nilearn
+
+    hasher = hashlib.sha256()
+    hasher.update(f"nilearn={nilearn.__version__}".encode())
+    hasher.update(json.dumps(glm_params, sort_keys=True, default=str).encode())
+
+    for fn_func in fns_func:
+        if isinstance(fn_func, (str, os.PathLike)):
+            hasher.update(file_identity(fn_func).encode())
+        else:
+            # In-memory image: hash its data instead of a file identity
+            hasher.update(fn_func.get_fdata(dtype="float32").tobytes())
+
+    hasher.update(b"events")
+    _hash_dataframes(hasher, dfs_events)
+    hasher.update(b"confounds")
+    _hash_dataframes(hasher, dfs_confounds)
+    return hasher.hexdigest()
+
+
+def _path_size(path):
+    """Size in bytes of a file, or of all files below a directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, fn))
+                   for root, _, fns in os.walk(path) for fn in fns)
+    return os.path.getsize(path)
+
+
+class GLMCache:
+    """
+    Content-addressed cache of fitted GLMs with an index file and LRU eviction.
+
+    Several variants of the same subject/task (different parameters, runs, events or
+    confounds) live side by side; each entry is a file or directory named after its key.
+    """
+    # Used in log messages; subclasses caching other artifacts override it
+    entry_kind = "GLM"
+
+    def __init__(self, cache_dir, max_bytes=None, max_entries=None):
+        """
+        Parameters:
+        cache_dir (str): Directory holding the cached models and the index file.
+        max_bytes (int, optional): Evict least recently used entries above this total size.
+        max_entries (int, optional): Evict least recently used entries above this count.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.index_path = os.path.join(cache_dir, INDEX_FILENAME)
+        self.lock_path = os.path.join(cache_dir, LOCK_FILENAME)
+        self._lock_depth = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._read_index()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Holds an exclusive lock on the index while the block runs, so processes sharing the
+        cache (parallel subjects or batch nodes) read, modify and write it one at a time.
+        Re-entrant within a process.
+        """
+        if self._lock_depth > 0 or fcntl is None:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except json.JSONDecodeError:
+            print(f"WARNING: {self.entry_kind} cache index {self.index_path} is corrupt. Starting a new index.")
+            return {}
+        # Drop entries whose files were deleted by hand
+        return {key: entry for key, entry in index.items()
+                if os.path.exists(os.path.join(self.cache_dir, entry['filename']))}
+
+    def _write_index(self):
+        # A private temporary file per writer, atomically moved over the index
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{INDEX_FILENAME}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.index, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def entry_path(self, filename):
+        """Path at which a new entry should be written before it is registered with add()."""
+        return os.path.join(self.cache_dir, filename)
+
+    def lookup(self, key):
+        """
+        Returns the path of the cached entry for key, or None. Marks the entry as recently used.
+        """
+        with self._locked():
+            # The index on disk is authoritative: another process may have added or evicted the entry
+            self.index = self._read_index()
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            entry['last_used'] = time.time()
+            self._write_index()
+        return os.path.join(self.cache_dir, entry['filename'])
+
+    def add(self, key, filename, description=None, keep=()):
+        """
+        Registers a file or directory already written at entry_path(filename),
+        then evicts old entries if the cache is over budget.
+
+        keep lists further keys that must not be evicted, e.g. the other entries a caller
+        is still going to use.
+        """
+        path = os.path.join(self.cache_dir, filename)
+        size = _path_size(path)
+        with self._locked():
+            # Start from the index on disk, so entries other processes added are kept and
+            # entries they evicted are not brought back
+            self.index = self._read_index()
+            now = time.time()
+            self.index[key] = {
+                'filename': filename,
+                'size': size,
+                'created': now,
+                'last_used': now,
+                'description': description or {},
+            }
+            self._evict(keep={key, *keep})
+            self._write_index()
+
+    def remove(self, key):
+        """Deletes an entry and its files."""
+        with self._locked():
+            self.index = self._read_index()
+            self._delete(key)
+            self._write_index()
+
+    def _delete(self, key):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return
+        path = os.path.join(self.cache_dir, entry['filename'])
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.index.values())
+
+    def evict(self, keep=()):
+        """
+        Removes least recently used entries until the cache fits max_bytes and max_entries,
+        never removing the keys in keep.
+        """
+        with self._locked():
+            self.index = self._read_index()
+            self._evict(keep={keep} if isinstance(keep, str) else set(keep))
+            self._write_index()
+
+    def _evict(self, keep=()):
+        by_age = sorted(self.index, key=lambda k: self.index[k]['last_used'])
+        for key in by_age:
+            over_bytes = self.max_bytes is not None and self.total_bytes() > self.max_bytes
+            over_entries = self.max_entries is not None and len(self.index) > self.max_entries
+            if not (over_bytes or over_entries):
+                break
+            if key in keep:
+                continue
+            print(f"  Evicting cached {self.entry_kind} {self.index[key]['filename']} (least recently used)")
+            self._delete(key)
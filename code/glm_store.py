@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from multi_contrast import fixed_effects_contrasts
+
+
+STORE_FORMAT_VERSION = 1
+META_FILENAME = "meta.json"
+MASK_FILENAME = "mask.nii.gz"
+
+
+def _run_prefix(run_idx):
+    return f"run-{run_idx + 1:02d}"
+
+
+def save_glm_store(fmri_glm, path2store):
+    """
+    Saves only what contrasts need from a fitted FirstLevelModel as flat arrays.
+
+    Per run, the store holds the betas (P x V, float32), the residual variance per voxel
+    (float32), the noise-model label of each voxel, the normalized covariance of each
+    label and the design matrix. The mask is saved as NIfTI. Everything is written to a
+    temporary directory first, so an interrupted save never leaves a half-written store.
+
+    Args:
+        fmri_glm (FirstLevelModel): Fitted model.
+        path2store (str): Directory to write the store to. Replaced if it exists.
+    """
+    tmp_path = f"{path2store}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    fmri_glm.masker_.mask_img_.to_filename(os.path.join(tmp_path, MASK_FILENAME))
+
+    runs_meta = []
+    for run_idx, (labels, results) in enumerate(zip(fmri_glm.labels_, fmri_glm.results_)):
+        prefix = _run_prefix(run_idx)
+        design_matrix = fmri_glm.design_matrices_[run_idx]
+        n_regressors, n_voxels = design_matrix.shape[1], labels.size
+
+        # Scatter the per-label results back into voxel order
+        label_values = list(results.keys())
+        theta = np.empty((n_regressors, n_voxels), dtype=np.float32)
+        dispersion = np.empty(n_voxels, dtype=np.float32)
+        label_codes = np.empty(n_voxels, dtype=np.int32)
+        covs = np.empty((len(label_values), n_regressors, n_regressors))
+        for code, label in enumerate(label_values):
+            voxels = labels == label
+            result = results[label]
+            theta[:, voxels] = result.theta
+            dispersion[voxels] = result.dispersion
+            label_codes[voxels] = code
+            covs[code] = result.cov
+
+        np.save(os.path.join(tmp_path, f"{prefix}_theta.npy"), theta)
+        np.save(os.path.join(tmp_path, f"{prefix}_dispersion.npy"), dispersion)
+        np.save(os.path.join(tmp_path, f"{prefix}_label_codes.npy"), label_codes)
+        np.save(os.path.join(tmp_path, f"{prefix}_cov.npy"), covs)
+        np.savez(os.path.join(tmp_path, f"{prefix}_design.npz"),
+                 values=design_matrix.to_numpy(dtype=np.float32),
+                 frame_times=design_matrix.index.to_numpy(dtype=float))
+
+        runs_meta.append({
+            'labels': [str(label) for label in label_values],
+            'columns': [str(col) for col in design_matrix.columns],
+            'df_residuals': float(results[label_values[0]].df_residuals),
+        })
+
+    meta = {
+        'format_version': STORE_FORMAT_VERSION,
+        'n_runs': len(runs_meta),
+        'n_voxels': int(fmri_glm.labels_[0].size),
+        'runs': runs_meta,
+    }
+    with open(os.path.join(tmp_path, META_FILENAME), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    shutil.rmtree(path2store, ignore_errors=True)
+    os.replace(tmp_path, path2store)
+
+
+class StoredGLM:
+    """
+    Lightweight, memory-mapped view of a GLM saved with save_glm_store.
+
+    Answers compute_contrast like a fitted FirstLevelModel, but only reads the
+    beta rows a contrast actually weights.
+    """
+    def __init__(self, path2store, mmap_mode='r'):
+        """
+        Parameters:
+        path2store (str): Directory written by save_glm_store.
+        mmap_mode (str, optional): Memory-map mode passed to np.load (None loads into memory).
+        """
+        meta_path = os.path.join(path2store, META_FILENAME)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"GLM store not found at: {path2store}")
+        with open(meta_path, 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] != STORE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported GLM store version {self.meta['format_version']} in {path2store}")
+
+        self.path2store = path2store
+        self.mask_path = os.path.join(path2store, MASK_FILENAME)
+        self.mmap_mode = mmap_mode
+        self.n_runs = self.meta['n_runs']
+        self.runs_meta = self.meta['runs']
+        self._masker = None
+        self._design_matrices = None
+
+    def _load(self, run_idx, name):
+        return np.load(os.path.join(self.path2store, f"{_run_prefix(run_idx)}_{name}.npy"),
+                       mmap_mode=self.mmap_mode)
+
+    @property
+    def masker_(self):
+        """NiftiMasker fitted on the stored mask, used to turn voxel arrays back into images."""
+        if self._masker is None:
+            from nilearn.maskers import NiftiMasker
+            self._masker = NiftiMasker(mask_img=self.mask_path).fit()
+        return self._masker
+
+    @property
+    def design_matrices_(self):
+        if self._design_matrices is None:
+            self._design_matrices = []
+            for run_idx, run_meta in enumerate(self.runs_meta):
+                with np.load(os.path.join(self.path2store, f"{_run_prefix(run_idx)}_design.npz")) as design:
+                    self._design_matrices.append(pd.DataFrame(design['values'],
+                                                              index=design['frame_times'],
+                                                              columns=run_meta['columns']))
+        return self._design_matrices
+
+    def run_contrasts(self, run_idx, contrast_matrix):
+        """
+        Contrast effects and variances of one run.
+
+        Returns:
+            tuple: (effect, variance), arrays of shape (C, n_voxels)
+        """
+        # Only the beta rows with a non-zero weight are read from disk
+        weighted_columns = np.flatnonzero(np.any(contrast_matrix != 0, axis=0))
+        theta = self._load(run_idx, "theta")
+        effect = contrast_matrix[:, weighted_columns] @ theta[weighted_columns]
+
+        covs = self._load(run_idx, "cov")
+        con_cov_con = np.einsum('ij,ljk,ik->il', contrast_matrix, covs, contrast_matrix)
+        label_codes = self._load(run_idx, "label_codes")
+        dispersion = self._load(run_idx, "dispersion")
+        return effect, con_cov_con[:, label_codes] * dispersion
+
+    def compute_contrast_arrays(self, contrast_matrices):
+        """
+        Computes fixed-effects t-contrasts for all C contrasts from the stored arrays.
+
+        Args:
+            contrast_matrices (np.ndarray or list): A C x P matrix applied to every run,
+                or one C x P matrix per run.
+
+        Returns:
+            dict: Arrays of shape (C, n_voxels), see multi_contrast.contrast_statistics.
+        """
+        return fixed_effects_contrasts(contrast_matrices, self.n_runs, self.run_contrasts,
+                                       [run_meta['df_residuals'] for run_meta in self.runs_meta])
+
+    def compute_contrast(self, contrast_def, stat_type=None, output_type="z_score"):
+        """
+        Computes a t-contrast image, like FirstLevelModel.compute_contrast.
+
+        Args:
+            contrast_def (array-like, str or list): Contrast vector, an expression over the
+                design matrix columns, or one of those per run.
+            stat_type (str, optional): Only 't' (or None) is supported.
+            output_type (str, optional): One of multi_contrast.OUTPUT_TYPES. Defaults to "z_score".
+
+        Returns:
+            Nifti1Image: The requested contrast map.
+        """
+        if stat_type not in (None, 't'):
+            raise ValueError(f"StoredGLM only supports t contrasts, got stat_type='{stat_type}'.")
+
+        per_run = isinstance(contrast_def, (list, tuple)) and \
+            (isinstance(contrast_def[0], str) or not np.isscalar(contrast_def[0]))
+        if not per_run:
+            contrast_def = [contrast_def] * self.n_runs
+        con_vals = []
+        for design_matrix, con in zip(self.design_matrices_, contrast_def):
+            if isinstance(con, str):
+                from nilearn.glm.contrasts import expression_to_contrast_vector
+                con = expression_to_contrast_vector(con, design_matrix.columns)
+            con = np.asarray(con, dtype=float)
+            if con.ndim != 1:
+                raise ValueError("StoredGLM only supports t contrasts (one weight vector per run).")
+            con_vals.append(con[None, :])
+
+        arrays = self.compute_contrast_arrays(con_vals)
+        if output_type not in arrays:
+            raise ValueError(f"output_type must be one of {list(arrays)}, got '{output_type}'.")
+        return self.masker_.inverse_transform(arrays[output_type][0])
@@ -0,0 +1,431 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from multi_contrast import contrast_statistics
+
+
+# Second-level designs: one map per subject, or the difference of two contrasts per subject
+GROUP_MODELS = ["one-sample", "paired"]
+
+# Bump when the saved first-level maps change, so every subject is recomputed once
+FIRST_LEVEL_VERSION = 1
+
+MANIFEST_FILENAME = "manifest.json"
+MASK_FILENAME = "mask.nii.gz"
+
+
+def _fn_base(subject_id, session, task):
+    return f"sub-{subject_id:02d}_ses-{session}_task-{task}"
+
+
+def first_level_dir(path2root, subject_id, session, task):
+    """Folder holding the effect and variance maps of one subject/task."""
+    return os.path.join(path2root, "output", "group", "first_level", _fn_base(subject_id, session, task))
+
+
+def first_level_map_path(folder, contrast_name, kind):
+    """Path of a saved first-level map; kind is 'effect' or 'variance'."""
+    return os.path.join(folder, f"contrast-{contrast_name}_{kind}.nii.gz")
+
+
+def difference_name(contrast_name, paired_with):
+    """Name under which the first-level map of contrast_name minus paired_with is saved."""
+    return f"({contrast_name})-({paired_with})"
+
+
+def _definition_hash(contrast_definition):
+    return hashlib.sha256(json.dumps(contrast_definition, sort_keys=True).encode()).hexdigest()
+
+
+def _read_manifest(folder):
+    path = os.path.join(folder, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except json.JSONDecodeError:
+        return {}
+    return manifest if manifest.get('version') == FIRST_LEVEL_VERSION else {}
+
+
+def _write_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST_FILENAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def fit_first_level(subject_id, session, task, run_ids, path2root, glm_params, contrast_file,
+                    contrast_names, confound_strategy="motion6", force=False, differences=()):
+    """
+    Fits the first level of one subject and saves its effect and variance maps per contrast.
+    Differences of two contrasts (paired designs) are computed as contrasts of their own,
+    C_a - C_b, so their variances include the covariance of the two estimates.
+
+    The maps are kept in output/group/first_level/<subject/task> with a manifest recording
+    the GLM key (see glm_cache.compute_glm_key) and the definition of every contrast.
+    Contrasts whose GLM and definition are unchanged are not recomputed.
+
+    Args:
+        subject_id (int): Subject number.
+        session (int): Session number.
+        task (str): Task name.
+        run_ids (list): Run numbers to fit.
+        path2root (str): Path to the BIDS root directory.
+        glm_params (dict): FirstLevelModel keyword arguments.
+        contrast_file (str): Path to the contrast file.
+        contrast_names (list): Contrasts to save maps for.
+        confound_strategy (str, optional): Confound strategy, see confounds.STRATEGIES.
+        force (bool, optional): Recompute every map even if it is up to date. Defaults to False.
+        differences (list, optional): (contrast_name, paired_with) pairs whose difference
+                                      maps are saved under difference_name. Defaults to ().
+
+    Returns:
+        str: Folder holding the subject's maps.
+    """
+    from analyses import fit_GLM
+    from contrasts import ContrastManager
+    from glm_cache import compute_glm_key
+    from multi_contrast import compute_contrasts_batch
+    from utils import load_BIDS_data
+
+    exp_args = {'subject': subject_id, 'session': session, 'task': task, 'num_runs': len(run_ids)}
+    dict_BIDS_data = load_BIDS_data(exp_args, run_ids, path2root, load_confounds=True,
+                                    confound_strategy=confound_strategy)
+    glm_key = compute_glm_key(dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                              dict_BIDS_data['dfs_confounds'], glm_params)
+
+    manager = ContrastManager(contrast_file)
+    definitions = {name: _definition_hash(manager.get_contrast(name)) for name in contrast_names}
+    pairs = {difference_name(name, paired_with): (name, paired_with) for name, paired_with in differences}
+    for name, (contrast_name, paired_with) in pairs.items():
+        definitions[name] = _definition_hash({'minuend': manager.get_contrast(contrast_name),
+                                              'subtrahend': manager.get_contrast(paired_with)})
+    contrast_names = list(dict.fromkeys(list(contrast_names) + list(pairs)))
+
+    folder = first_level_dir(path2root, subject_id, session, task)
+    manifest = {} if force else _read_manifest(folder)
+    saved = manifest.get('contrasts', {}) if manifest.get('glm_key') == glm_key else {}
+    todo = [name for name in contrast_names
+            if saved.get(name) != definitions[name]
+            or not os.path.exists(first_level_map_path(folder, name, "effect"))]
+    if not todo:
+        print(f"Subject {subject_id}: first-level maps of {len(contrast_names)} contrasts are up to date.")
+        return folder
+
+    model_glm = fit_GLM(exp_args,
+                        dict_BIDS_data['fns_func'],
+                        dict_BIDS_data['dfs_events'],
+                        dict_BIDS_data['dfs_confounds'],
+                        glm_params,
+                        path2root,
+                        save_model=True,
+                        store_format="arrays")
+    design_columns = model_glm.design_matrices_[0].columns
+    contrast_matrix = np.vstack([
+        np.subtract(*manager.get_matrix(list(pairs[name]), design_columns)) if name in pairs
+        else manager.get_matrix([name], design_columns)[0]
+        for name in todo])
+    maps = compute_contrasts_batch(model_glm, contrast_matrix, todo, output_type="all")
+
+    os.makedirs(folder, exist_ok=True)
+    model_glm.masker_.mask_img_.to_filename(os.path.join(folder, MASK_FILENAME))
+    for name in todo:
+        maps["effect_size"][name].to_filename(first_level_map_path(folder, name, "effect"))
+        maps["effect_variance"][name].to_filename(first_level_map_path(folder, name, "variance"))
+
+    saved = {**saved, **{name: definitions[name] for name in todo}}
+    _write_manifest(folder, {'version': FIRST_LEVEL_VERSION, 'glm_key': glm_key, 'contrasts': saved})
+    print(f"Subject {subject_id}: saved first-level maps of {len(todo)} contrasts to {folder}")
+    return folder
+
+
+def fit_first_levels(subjects, session, task, run_ids, path2root, glm_params, contrast_file,
+                     contrast_names, confound_strategy="motion6", force=False, n_jobs=1, differences=()):
+    """
+    Runs fit_first_level for several subjects, one subject per worker process.
+
+    Returns:
+        dict: subject -> folder holding its maps
+    """
+    args = (session, task, run_ids, path2root, glm_params, contrast_file, contrast_names,
+            confound_strategy, force, differences)
+    if n_jobs <= 1 or len(subjects) <= 1:
+        return {subject_id: fit_first_level(subject_id, *args) for subject_id in subjects}
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(subjects))) as pool:
+        futures = {subject_id: pool.submit(fit_first_level, subject_id, *args) for subject_id in subjects}
+        return {subject_id: future.result() for subject_id, future in futures.items()}
+
+
+def load_group_mask(folders):
+    """
+    Intersects the first-level masks of all subjects.
+
+    Returns:
+        tuple: (3D boolean mask, reference Nifti1Image for the grid)
+
+    Raises:
+        ValueError: If the subjects' maps are not on the same grid.
+    """
+    import nibabel as nib
+
+    mask, ref_img = None, None
+    for folder in folders:
+        img = nib.load(os.path.join(folder, MASK_FILENAME))
+        subject_mask = np.asanyarray(img.dataobj) != 0
+        if ref_img is None:
+            mask, ref_img = subject_mask, img
+            continue
+        if img.shape != ref_img.shape or not np.allclose(img.affine, ref_img.affine):
+            raise ValueError(f"First-level maps in {folder} are not on the grid of {os.path.dirname(ref_img.get_filename())}. "
+                             "Group analysis needs all subjects in the same space.")
+        mask &= subject_mask
+    return mask, ref_img
+
+
+def _iter_subject_maps(folders, contrast_name, mask, paired_with=None):
+    """
+    Yields the in-mask (effect, variance) of one subject at a time. For paired designs these
+    are the maps of the difference contrast (see fit_first_level).
+    """
+    import nibabel as nib
+
+    def read(folder, name, kind):
+        return np.asanyarray(nib.load(first_level_map_path(folder, name, kind)).dataobj)[mask].astype(np.float64)
+
+    name = contrast_name if paired_with is None else difference_name(contrast_name, paired_with)
+    for folder in folders:
+        yield read(folder, name, "effect"), read(folder, name, "variance")
+
+
+def random_effects_test(subject_maps):
+    """
+    One-sample t-test over subjects, streaming: maps are folded into a running mean and
+    sum of squared deviations (Welford), so only one subject is in memory at a time.
+
+    Returns:
+        tuple: (group effect, variance of the effect, degrees of freedom)
+    """
+    n, mean, m2 = 0, None, None
+    for effect, _ in subject_maps:
+        n += 1
+        if mean is None:
+            mean, m2 = effect.copy(), np.zeros_like(effect)
+            continue
+        delta = effect - mean
+        mean += delta / n
+        m2 += delta * (effect - mean)
+    if n < 2:
+        raise ValueError(f"A group test needs at least 2 subjects, got {n}.")
+    return mean, m2 / (n - 1) / n, n - 1
+
+
+def mixed_effects_test(subject_maps_factory):
+    """
+    Random-effects meta-analysis over subjects (DerSimonian-Laird), weighting every subject
+    by the inverse of its first-level variance plus the between-subject variance tau^2.
+
+    The first pass accumulates the fixed-effects sums that give Cochran's Q and tau^2, the
+    second the re-weighted estimate; each pass streams over the subjects once.
+
+    Args:
+        subject_maps_factory (callable): Returns a fresh iterator of (effect, variance) per subject.
+
+    Returns:
+        tuple: (group effect, variance of the effect, degrees of freedom)
+    """
+    n, sum_w, sum_w2, sum_wy, sum_wy2 = 0, 0, 0, 0, 0
+    for effect, variance in subject_maps_factory():
+        w = 1 / np.maximum(variance, 1e-50)
+        n += 1
+        sum_w, sum_w2 = sum_w + w, sum_w2 + w ** 2
+        sum_wy, sum_wy2 = sum_wy + w * effect, sum_wy2 + w * effect ** 2
+    if n < 2:
+        raise ValueError(f"A group test needs at least 2 subjects, got {n}.")
+
+    q = sum_wy2 - sum_wy ** 2 / sum_w
+    tau2 = np.maximum(0, (q - (n - 1)) / (sum_w - sum_w2 / sum_w))
+
+    sum_w, sum_wy = 0, 0
+    for effect, variance in subject_maps_factory():
+        w = 1 / (np.maximum(variance, 1e-50) + tau2)
+        sum_w, sum_wy = sum_w + w, sum_wy + w * effect
+    # The estimate is normally distributed: infinite degrees of freedom turn t into z
+    return sum_wy / sum_w, 1 / sum_w, np.inf
+
+
+def second_level(folders, contrast_name, model="one-sample", paired_with=None, mixed_effects=False):
+    """
+    Fits a second-level model to the first-level maps of several subjects.
+
+    Args:
+        folders (list): First-level folders of the subjects (see fit_first_level).
+        contrast_name (str): Contrast to test.
+        model (str, optional): One of GROUP_MODELS. Defaults to "one-sample".
+        paired_with (str, optional): For model="paired", the contrast subtracted from contrast_name.
+        mixed_effects (bool, optional): Weight subjects by their first-level variances
+                                        (DerSimonian-Laird) instead of an ordinary t-test.
+
+    Returns:
+        dict: Nifti1Images for every entry of multi_contrast.OUTPUT_TYPES.
+    """
+    import nibabel as nib
+
+    if model not in GROUP_MODELS:
+        raise ValueError(f"model must be one of {GROUP_MODELS}, got '{model}'.")
+    if model == "paired" and paired_with is None:
+        raise ValueError("A paired model needs a second contrast (paired_with).")
+    if model == "one-sample":
+        paired_with = None
+
+    mask, ref_img = load_group_mask(folders)
+
+    def subject_maps():
+        return _iter_subject_maps(folders, contrast_name, mask, paired_with)
+
+    if mixed_effects:
+        effect, variance, dof = mixed_effects_test(subject_maps)
+    else:
+        effect, variance, dof = random_effects_test(subject_maps())
+    arrays = contrast_statistics(effect[None], variance[None], np.array([dof]))
+
+    images = {}
+    for output_type, values in arrays.items():
+        volume = np.zeros(mask.shape, dtype=np.float32)
+        volume[mask] = values[0]
+        images[output_type] = nib.Nifti1Image(volume, ref_img.affine)
+    return images
+
+
+def permutation_inference(folders, contrast_names, paired_with=None, n_permutations=10000,
+                          cluster_forming_z=None, seed=0, n_jobs=1):
+    """
+    Sign-flipping permutation inference on the one-sample t-test of every contrast at once
+    (see permutation.permutation_test). For paired designs the subject maps are the
+    differences with paired_with.
+
+    Returns:
+        tuple: (dict of contrast name -> dict of output type -> Nifti1Image, with 't',
+                'logp_max_t' and optionally 'logp_max_mass'; the permutation_test summary)
+    """
+    import nibabel as nib
+    from permutation import permutation_test
+
+    mask, ref_img = load_group_mask(folders)
+    data = np.empty((len(folders), len(contrast_names), int(mask.sum())), dtype=np.float32)
+    for c, contrast_name in enumerate(contrast_names):
+        for s, (effect, _) in enumerate(_iter_subject_maps(folders, contrast_name, mask, paired_with)):
+            data[s, c] = effect
+
+    outputs = permutation_test(data, mask, n_permutations, cluster_forming_z, seed, n_jobs,
+                               work_dir=os.path.dirname(folders[0]))
+    images = {}
+    for c, contrast_name in enumerate(contrast_names):
+        images[contrast_name] = {}
+        for output_type in ("t", "logp_max_t", "logp_max_mass"):
+            if output_type not in outputs:
+                continue
+            volume = np.zeros(mask.shape, dtype=np.float32)
+            volume[mask] = outputs[output_type][c]
+            images[contrast_name][output_type] = nib.Nifti1Image(volume, ref_img.affine)
+    summary = {key: outputs[key] for key in ("n_permutations", "exhaustive", "seconds", "permutations_per_second")}
+    return images, summary
+
+
+def group_tag(model, paired_with=None, mixed_effects=False):
+    tag = f"{model}-{paired_with}" if model == "paired" else model
+    return f"{tag}_mixed" if mixed_effects else tag
+
+
+def run_group_analysis(subjects, session, task, run_ids, path2root, glm_params, contrast_file,
+                       contrast_names, model="one-sample", paired_with=None, mixed_effects=False,
+                       confound_strategy="motion6", n_jobs=1, force=False, n_permutations=0,
+                       cluster_forming_z=None, seed=0):
+    """
+    Fits (or reuses) the first levels of all subjects in parallel, then the second level
+    of every contrast. Group maps are saved to output/group/second_level/<session/task>.
+    With n_permutations > 0, FWE-corrected -log10 p-maps from sign-flipping permutations
+    (voxel maximum, and cluster mass if cluster_forming_z is given) are saved as well.
+
+    Returns:
+        dict: contrast name -> dict of output type -> path of the saved group map
+    """
+    differences = [(name, paired_with) for name in contrast_names] if model == "paired" else []
+    t_start = time.perf_counter()
+    folders = fit_first_levels(subjects, session, task, run_ids, path2root, glm_params, contrast_file,
+                               contrast_names, confound_strategy, force, n_jobs, differences)
+    print(f"First levels of {len(subjects)} subjects ready in {time.perf_counter() - t_start:.1f} s.")
+
+    folder_group = os.path.join(path2root, "output", "group", "second_level", f"ses-{session}_task-{task}")
+    os.makedirs(folder_group, exist_ok=True)
+    tag = group_tag(model, paired_with, mixed_effects)
+    group_maps = {}
+    for contrast_name in contrast_names:
+        t_start = time.perf_counter()
+        images = second_level([folders[subject_id] for subject_id in subjects], contrast_name,
+                              model, paired_with, mixed_effects)
+        group_maps[contrast_name] = {}
+        for output_type, img in images.items():
+            path = os.path.join(folder_group, f"{output_type}_contrast-{contrast_name}_group-{tag}_ses-{session}_task-{task}.nii.gz")
+            img.to_filename(path)
+            group_maps[contrast_name][output_type] = path
+        max_z = np.abs(np.asanyarray(images["z_score"].dataobj)).max()
+        print(f"  {contrast_name}: {len(subjects)} subjects, max |z| = {max_z:.2f} "
+              f"({time.perf_counter() - t_start:.2f} s)")
+
+    permutation_summary = None
+    if n_permutations > 0:
+        if mixed_effects:
+            print("Permutation inference uses the ordinary one-sample t-test, not mixed effects.")
+        images, permutation_summary = permutation_inference(
+            [folders[subject_id] for subject_id in subjects], contrast_names,
+            paired_with if model == "paired" else None, n_permutations, cluster_forming_z, seed, n_jobs)
+        perm_tag = f"{group_tag(model, paired_with)}_perm"
+        for contrast_name, contrast_images in images.items():
+            for output_type, img in contrast_images.items():
+                path = os.path.join(folder_group, f"{output_type}_contrast-{contrast_name}_group-{perm_tag}_ses-{session}_task-{task}.nii.gz")
+                img.to_filename(path)
+                group_maps[contrast_name][f"perm_{output_type}"] = path
+        print(f"{permutation_summary['n_permutations']} "
+              f"{'exhaustive' if permutation_summary['exhaustive'] else 'random'} sign flips of "
+              f"{len(contrast_names)} contrasts in {permutation_summary['seconds']:.1f} s "
+              f"({permutation_summary['permutations_per_second']:.1f} permutations/s)")
+
+    with open(os.path.join(folder_group, f"group-{tag}_subjects.json"), 'w') as f:
+        json.dump({'subjects': subjects, 'model': model, 'paired_with': paired_with,
+                   'mixed_effects': mixed_effects, 'contrasts': contrast_names,
+                   'permutations': permutation_summary, 'cluster_forming_z': cluster_forming_z,
+                   'seed': seed}, f, indent=2)
+    return group_maps
+
+
+def main(argv=None):
+    from contrasts import ContrastManager
+    from parser import parse_group_arguments, get_glm_params
+
+    args = parse_group_arguments(argv)
+    manager = ContrastManager(args.contrast_file)
+    contrast_names = manager.resolve(args.contrast_name)
+    if args.paired_with and args.paired_with not in manager.contrasts:
+        raise ValueError(f"Contrast '{args.paired_with}' not found in {args.contrast_file}")
+
+    run_ids = list(range(1, args.num_runs + 1)) if args.num_runs else []
+    run_group_analysis(args.subjects, args.session, args.task, run_ids, os.path.abspath(args.path2root),
+                       get_glm_params(args), os.path.abspath(args.contrast_file), contrast_names,
+                       model=args.model, paired_with=args.paired_with, mixed_effects=args.mixed_effects,
+                       confound_strategy=args.confounds, n_jobs=args.n_jobs, force=args.force,
+                       n_permutations=args.n_permutations, cluster_forming_z=args.cluster_forming_z,
+                       seed=args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    raise SystemExit(main())
@@ -1,14 +1,12 @@
 import os
+import time
 from pathlib import Path
 import sys
-from analyses import fit_GLM
-from analyses import plot_contrast
-from utils import load_BIDS_data
-from viz import plot_diagnostic_images_to_file
-from viz import plot_design_matrix_to_file
-from contrasts import ContrastManager
-from nilearn.image import mean_img
+# Only light modules are imported here, so --help and --list-contrasts start instantly.
+# The analysis modules (numpy, nilearn, sklearn, matplotlib) are imported in run_analysis.
+from contrasts import ContrastManager, is_pattern
 from parser import parse_arguments, get_arg_groups
+import profiling
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
@@ -17,51 +15,188 @@ def main():
     args = parse_arguments()
     exp_params, glm_params = get_arg_groups(args)
 
+    if args.list_contrasts:
+        print_contrast_list(args)
+        return
+
+    # With --profile every stage records its wall/CPU time, peak RSS and bytes read
+    profiler = None
+    if args.profile:
+        profiler = profiling.start(profiling.Profiler(get_profile_dir(args),
+                                                      get_profile_run_name(exp_params),
+                                                      cprofile=args.cprofile))
+    try:
+        run_analysis(args, exp_params, glm_params)
+    finally:
+        if profiler is not None:
+            profiling.stop()
+            profiler.print_summary()
+            profiler.write()
+
+
+def run_analysis(args, exp_params, glm_params):
+    """Loads the data, fits the GLM and computes and plots the requested contrasts."""
+    from analyses import fit_GLM, plot_contrast
+    from bold_cache import BoldCache
+    from mean_image import subject_mean_imgs
+    from multi_contrast import compute_contrasts_batch
+    from rendering import FigureRenderer
+    from utils import load_BIDS_data
+    from viz import plot_diagnostic_images_to_file, plot_design_matrix_to_file
+
     n_subjects = 1 if isinstance(exp_params['subject'], int) else len(exp_params['subject'])
-    confound_columns = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
 
     # LOAD DATA - Anatomy, functional and events
-    run_ids = list(range(1, args.num_runs + 1)) if args.num_runs else []
+    run_ids = [run_id for run_id in range(1, args.num_runs + 1) if run_id not in args.exclude_runs] \
+        if args.num_runs else []
+    bold_cache = None
+    if args.bold_cache:
+        bold_cache = BoldCache(os.path.join(args.path2root, "output", "bold_cache"),
+                               max_bytes=get_cache_max_bytes(args.bold_cache_max_gb))
     dict_BIDS_data = load_BIDS_data(exp_params,
                                     run_ids,
                                     args.path2root,
-                                    confound_columns)
+                                    load_confounds=True,
+                                    bold_cache=bold_cache,
+                                    confound_strategy=args.confounds)
 
-    # Plot diagnostic images
-    mean_func_img = mean_img(dict_BIDS_data["fns_func"][0], copy_header=True)
-    plot_diagnostic_images_to_file(exp_params,
-                                   [mean_func_img]*n_subjects,
-                                   dict_BIDS_data["fn_anat"],
-                                   args.path2root)
+    # Plot diagnostic images. Mean images are streamed from disk once and cached.
+    # A compute-only run needs no background image and draws nothing.
+    mean_func_img = None
+    if not args.compute_only:
+        mean_func_imgs = subject_mean_imgs(dict_BIDS_data["fns_func"], n_subjects,
+                                           os.path.join(args.path2root, "output", "mean_images"))
+        mean_func_img = mean_func_imgs[0]
+        plot_diagnostic_images_to_file(exp_params,
+                                       mean_func_imgs,
+                                       dict_BIDS_data["fn_anat"],
+                                       args.path2root)
 
     # FIT MODEL: GLM
-    glm_params['smoothing_fwhm'] = 8.0  # Example smoothing parameter
     model_glm = fit_GLM(exp_params,
                         dict_BIDS_data['fns_func'],
                         dict_BIDS_data['dfs_events'],
                         dict_BIDS_data['dfs_confounds'],
                         glm_params,
                         args.path2root,
-                        save_model=True)
+                        save_model=True,
+                        cache_max_bytes=get_cache_max_bytes(args.glm_cache_max_gb),
+                        store_format=args.glm_store,
+                        memory_budget=get_cache_max_bytes(args.memory_budget))
     
     # Plot the design matrix
-    plot_design_matrix_to_file(model_glm, exp_params, args.path2root)
+    if not args.compute_only:
+        plot_design_matrix_to_file(model_glm, exp_params, args.path2root)
 
     # CONTRAST ANALYSIS
     manager = ContrastManager(args.contrast_file)
-    contrast = manager.get_contrast(args.contrast_name)
-
-    # Hack to ensure the contrast weights are the same length as the design matrix
-    if len(contrast['weights']) < model_glm.design_matrices_[0].shape[1]:
-        contrast['weights'] += [0] * (model_glm.design_matrices_[0].shape[1] - len(contrast['weights']))
-
-    # Plot the contrast
-    plot_contrast(exp_params,
-                  model_glm, args.contrast_name, contrast['weights'],
-                  mean_func_img,
-                  args.path2root,
-                  args.threshold_z, args.cluster_threshold,
-                  save_plots=True)
+    contrast_names = get_contrast_names(args, manager)
+    print(f"Running {len(contrast_names)} contrast(s) on the loaded model...")
+
+    # Compute the z-maps of all contrasts in one batched pass over the fitted runs.
+    # Contrast rules are compiled against the columns of the fitted design matrix.
+    contrast_matrix = manager.get_matrix(contrast_names, model_glm.design_matrices_[0].columns)
+    t_start = time.perf_counter()
+    z_maps = compute_contrasts_batch(model_glm, contrast_matrix, contrast_names,
+                                     output_type="z_score")
+    compute_seconds = time.perf_counter() - t_start
+    print(f"  Computed {len(contrast_names)} z-maps in {compute_seconds:.2f} s")
+
+    # Figures render in background processes while the next contrasts are thresholded.
+    # Compute-only runs still save the thresholded maps and cluster tables.
+    contrast_timings = []
+    render_jobs = 1 if args.compute_only else args.render_jobs
+    with FigureRenderer(n_jobs=render_jobs,
+                        figure_kinds=[] if args.compute_only else args.figure_kinds,
+                        skip_up_to_date=not args.force_figures) as renderer:
+        for contrast_name, contrast_vector in zip(contrast_names, contrast_matrix):
+            t_start = time.perf_counter()
+
+            # Plot the contrast
+            plot_contrast(exp_params,
+                          model_glm, contrast_name, contrast_vector,
+                          mean_func_img,
+                          args.path2root,
+                          args.threshold_z, args.cluster_threshold,
+                          save_plots=True,
+                          z_map=z_maps[contrast_name],
+                          alphas=args.alpha,
+                          renderer=renderer)
+            contrast_timings.append((contrast_name, time.perf_counter() - t_start))
+        t_start = time.perf_counter()
+    # Leaving the renderer waits for the figures still rendering in the background
+    render_wait_seconds = time.perf_counter() - t_start
+
+    print_contrast_timings(contrast_timings, compute_seconds, render_wait_seconds,
+                           background_figures=render_jobs > 1)
+
+
+def get_contrast_names(args, manager):
+    """
+    Resolves which contrasts to run from --contrasts-from or --contrast-name.
+    'all' selects every contrast in the contrast file, and a glob pattern
+    (e.g. 'real > pseudo*') the contrasts it matches.
+    """
+    if not args.contrasts_from:
+        return manager.resolve(args.contrast_name)
+    with open(args.contrasts_from, 'r') as f:
+        contrast_names = [line.strip() for line in f
+                          if line.strip() and not line.strip().startswith('#')]
+
+    # Fail before any contrast is computed rather than midway through the loop
+    missing = [name for name in contrast_names if name not in manager.contrasts]
+    if missing:
+        raise ValueError(f"Contrasts not found in {args.contrast_file}: {missing}")
+    return contrast_names
+
+
+def print_contrast_list(args):
+    """Prints the contrasts --contrast-name selects (a glob pattern), or all of them."""
+    manager = ContrastManager(args.contrast_file)
+    if is_pattern(args.contrast_name):
+        contrast_names = manager.select(args.contrast_name)
+    else:
+        contrast_names = manager.list_contrasts()
+    for contrast_name in contrast_names:
+        print(contrast_name)
+
+
+def get_profile_dir(args):
+    """Folder of the --profile outputs (default: output/profiles)."""
+    return args.profile_dir or os.path.join(args.path2root, "output", "profiles")
+
+
+def get_profile_run_name(exp_params):
+    """Prefix of the profile files of this run: subject(s), session, task and start time."""
+    subjects = exp_params['subject'] if isinstance(exp_params['subject'], list) else [exp_params['subject']]
+    subject_ids_str = "_".join(f"{sub:02d}" for sub in subjects)
+    return (f"sub-{subject_ids_str}_ses-{exp_params['session']}_task-{exp_params['task']}_"
+            f"{time.strftime('%Y%m%d-%H%M%S')}")
+
+
+def get_cache_max_bytes(max_gb):
+    """Converts a size limit in GB (--glm-cache-max-gb, --bold-cache-max-gb, --memory-budget) to bytes (None means unlimited)."""
+    if max_gb is None:
+        return None
+    return int(max_gb * 1024**3)
+
+
+def print_contrast_timings(contrast_timings, compute_seconds, render_wait_seconds, background_figures=False):
+    """
+    Prints where the contrast wall time went: the batched z-maps of all contrasts, then
+    per contrast its thresholding and figures (only queued if figures render in the
+    background), then the wait for the background figures.
+    """
+    per_contrast = "thresholding, figures queued" if background_figures else "thresholding and figures"
+    print("Contrast timing summary:")
+    print(f"  {compute_seconds:8.2f} s  z-maps of all {len(contrast_timings)} contrasts (one batch)")
+    print(f"  Per contrast ({per_contrast}):")
+    for contrast_name, seconds in contrast_timings:
+        print(f"  {seconds:8.2f} s    {contrast_name}")
+    if background_figures:
+        print(f"  {render_wait_seconds:8.2f} s  waiting for the background figures")
+    total = compute_seconds + sum(seconds for _, seconds in contrast_timings) + render_wait_seconds
+    print(f"  {total:8.2f} s  total ({len(contrast_timings)} contrasts)")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
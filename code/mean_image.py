@@ -0,0 +1,149 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+from glm_cache import file_identity
+from profiling import profiled
+
+
+# Upper bound on the raw volume data held in memory at once while averaging
+DEFAULT_CHUNK_BYTES = 256 * 1024**2
+
+
+def _file_key(fn_func):
+    """Hash of the identity of a source file (see glm_cache.file_identity)."""
+    return hashlib.sha256(file_identity(fn_func).encode()).hexdigest()
+
+
+def _strip_nifti_ext(filename):
+    for ext in (".nii.gz", ".nii"):
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def compute_mean_img(fn_func, max_chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Computes the mean over time of a 4D NIfTI file by streaming over chunks of volumes.
+
+    The file is read once, front to back, so a compressed .nii.gz is decompressed only
+    once and never held in memory as a whole.
+
+    Args:
+        fn_func (str): Path to a 3D or 4D NIfTI file.
+        max_chunk_bytes (int, optional): Raw bytes read per chunk. Defaults to 256 MB.
+
+    Returns:
+        Nifti1Image: float32 mean image with the affine and header of the source.
+    """
+    import nibabel as nib
+    from nibabel.openers import ImageOpener
+
+    img = nib.load(fn_func)
+    if len(img.shape) == 3:
+        data = np.asanyarray(img.dataobj, dtype=np.float32)
+        return nib.Nifti1Image(data, img.affine, img.header)
+
+    shape = img.shape
+    n_voxels, n_volumes = int(np.prod(shape[:3])), int(np.prod(shape[3:]))
+    dtype = img.header.get_data_dtype()
+    volume_bytes = n_voxels * dtype.itemsize
+    volumes_per_chunk = max(1, int(max_chunk_bytes // volume_bytes))
+
+    # NIfTI stores volumes contiguously (Fortran order), so chunks of whole volumes
+    # are consecutive byte ranges after the header
+    total = np.zeros(n_voxels, dtype=np.float64)
+    with ImageOpener(fn_func) as fileobj:
+        fileobj.seek(img.dataobj.offset)
+        n_read = 0
+        while n_read < n_volumes:
+            n_chunk = min(volumes_per_chunk, n_volumes - n_read)
+            raw = fileobj.read(n_chunk * volume_bytes)
+            if len(raw) != n_chunk * volume_bytes:
+                raise ValueError(f"Unexpected end of data in {fn_func} after {n_read} volumes.")
+            total += np.frombuffer(raw, dtype=dtype).reshape(n_chunk, n_voxels).sum(axis=0, dtype=np.float64)
+            n_read += n_chunk
+
+    # Apply the NIfTI intensity scaling to the mean instead of to every volume
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    mean = (total / n_volumes) * slope + inter
+    mean = mean.reshape(shape[:3], order='F').astype(np.float32)
+
+    header = img.header.copy()
+    header.set_data_shape(shape[:3])
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    return nib.Nifti1Image(mean, img.affine, header)
+
+
+def mean_img_cached(fn_func, cache_dir, max_chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Returns the mean image of fn_func, computing it only if no cached copy exists.
+
+    Cached means are keyed by the identity of the source file (path, size, mtime), so an
+    updated source gets a new mean and the stale one is removed.
+
+    Args:
+        fn_func (str): Path to a 4D NIfTI file.
+        cache_dir (str): Directory holding the cached mean images.
+        max_chunk_bytes (int, optional): See compute_mean_img.
+
+    Returns:
+        Nifti1Image: The mean image.
+    """
+    import nibabel as nib
+
+    fn_root = _strip_nifti_ext(os.path.basename(fn_func))
+    path2mean = os.path.join(cache_dir, f"{fn_root}_mean_{_file_key(fn_func)[:16]}.nii.gz")
+    if os.path.exists(path2mean):
+        return nib.load(path2mean)
+
+    print(f"  Computing mean image of {os.path.basename(fn_func)}...")
+    mean_img = compute_mean_img(fn_func, max_chunk_bytes)
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(cache_dir, f"{glob.escape(fn_root)}_mean_*.nii.gz")):
+        os.remove(stale)
+    tmp_path = f"{path2mean[:-len('.nii.gz')]}.tmp.nii.gz"
+    mean_img.to_filename(tmp_path)
+    os.replace(tmp_path, path2mean)
+    return mean_img
+
+
+@profiled("mean_image")
+def subject_mean_img(fns_func, cache_dir, max_chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Mean over all volumes of all runs of one subject, built from the cached run means.
+
+    Args:
+        fns_func (list): Paths to the subject's 4D runs.
+        cache_dir (str): Directory holding the cached mean images.
+        max_chunk_bytes (int, optional): See compute_mean_img.
+
+    Returns:
+        Nifti1Image: The subject's mean functional image.
+    """
+    import nibabel as nib
+
+    run_means = [mean_img_cached(fn_func, cache_dir, max_chunk_bytes) for fn_func in fns_func]
+    if len(run_means) == 1:
+        return run_means[0]
+
+    # Weight every run by its number of volumes, so this equals the mean over all volumes
+    n_volumes = np.array([int(np.prod(nib.load(fn_func).shape[3:])) for fn_func in fns_func], dtype=float)
+    mean = sum(weight * np.asanyarray(run_mean.dataobj, dtype=np.float64)
+               for weight, run_mean in zip(n_volumes / n_volumes.sum(), run_means))
+    return nib.Nifti1Image(mean.astype(np.float32), run_means[0].affine, run_means[0].header)
+
+
+def subject_mean_imgs(fns_func, n_subjects, cache_dir, max_chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Splits the functional files returned by utils.load_BIDS_data (all runs of each
+    subject in turn) by subject and returns one mean image per subject.
+    """
+    if len(fns_func) % n_subjects:
+        raise ValueError(f"{len(fns_func)} functional files cannot be split evenly over {n_subjects} subjects.")
+    n_runs = len(fns_func) // n_subjects
+    return [subject_mean_img(fns_func[i * n_runs:(i + 1) * n_runs], cache_dir, max_chunk_bytes)
+            for i in range(n_subjects)]
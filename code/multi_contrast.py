@@ -0,0 +1,214 @@
+import numpy as np
+from scipy import stats as sps
+
+from create_contrast import compile_contrast_rules
+from profiling import profiled
+
+
+# Output types understood by compute_contrasts_batch, mirroring nilearn's compute_contrast
+OUTPUT_TYPES = ["z_score", "stat", "p_value", "effect_size", "effect_variance"]
+
+# Same numerical guards nilearn uses when turning contrasts into statistics
+_TINY = 1e-50
+_DOFMAX = 1e10
+
+
+def stack_contrast_weights(contrasts, contrast_names, design_columns):
+    """
+    Builds the C x P contrast matrix of several contrasts for an actual design matrix.
+
+    Contrasts named by a rule ('real > pseudo | audio') are compiled against the design
+    columns with create_contrast.compile_contrast_rules, so confounds, drifts and the
+    constant get 0 and every run of a condition is weighted. Other contrasts, and rules
+    that match no task regressor, use their stored weights, which must have exactly one
+    weight per design column.
+
+    Args:
+        contrasts (ContrastManager or dict): Source of the contrast definitions, e.g. a
+            ContrastManager or the output of create_contrast.generate_contrast_json_object.
+        contrast_names (list): Names of the contrasts to stack, in row order.
+        design_columns (list or pd.Index): Columns of the design matrix.
+
+    Returns:
+        np.ndarray: Contrast matrix of shape (len(contrast_names), len(design_columns)).
+    """
+    if hasattr(contrasts, 'get_contrast'):
+        get_contrast = contrasts.get_contrast
+    else:
+        get_contrast = contrasts.__getitem__
+
+    design_columns = list(design_columns)
+    contrast_rules = [name for name in contrast_names if '>' in name]
+    rule_weights, errors = compile_contrast_rules(contrast_rules, design_columns)
+    rule_rows = {rule: row for rule, row in zip(contrast_rules, rule_weights) if rule not in errors}
+
+    contrast_matrix = np.zeros((len(contrast_names), len(design_columns)))
+    for i, contrast_name in enumerate(contrast_names):
+        if contrast_name in rule_rows:
+            contrast_matrix[i] = rule_rows[contrast_name]
+            continue
+        weights = np.asarray(get_contrast(contrast_name)['weights'], dtype=float)
+        if weights.size != len(design_columns):
+            if contrast_name in errors:
+                raise ValueError(f"Contrast rule '{contrast_name}' does not compile against the design "
+                                 f"matrix: {errors[contrast_name]}")
+            raise ValueError(f"Contrast '{contrast_name}' has {weights.size} weights but the design "
+                             f"matrix has {len(design_columns)} columns. Name the contrast by a rule "
+                             f"('positive > negative | filter') to compile it against the design.")
+        contrast_matrix[i] = weights
+    return contrast_matrix
+
+
+def _z_score(p_value, one_minus_p_value):
+    """Converts p-values to z-scores the way nilearn does, using the cdf side for negative z."""
+    p_value = np.clip(p_value, 1.0e-300, 1.0 - 1.0e-16)
+    one_minus_p_value = np.clip(one_minus_p_value, 1.0e-300, 1.0 - 1.0e-16)
+    z_sf = sps.norm.isf(p_value)
+    z_cdf = sps.norm.ppf(one_minus_p_value)
+    return np.where(z_sf < 0, z_cdf, z_sf)
+
+
+def fixed_effects_contrasts(contrast_matrices, n_runs, run_contrasts, run_dofs):
+    """
+    Fixed-effects t-contrasts of all C contrasts from per-run contrast estimates. Every
+    GLM engine reduces its runs here and only supplies each run's effects and variances.
+
+    Like nilearn, a run whose weights are all zero for a contrast does not contribute to
+    it: the effects are averaged and the variances divided by the squared count over the
+    contributing runs only, and only their degrees of freedom are summed.
+
+    Args:
+        contrast_matrices (np.ndarray or list): A C x P matrix applied to every run, or one
+            C x P matrix per run.
+        n_runs (int): Number of runs.
+        run_contrasts (callable): (run index, C x P matrix) -> (effect, variance) of that
+            run, arrays of shape (C, n_voxels). Not called for runs with all-zero weights.
+        run_dofs (list): Residual degrees of freedom of every run.
+
+    Returns:
+        dict: Arrays of shape (C, n_voxels) for every entry of OUTPUT_TYPES.
+    """
+    if not isinstance(contrast_matrices, (list, tuple)):
+        contrast_matrices = [contrast_matrices] * n_runs
+    if len(contrast_matrices) != n_runs:
+        raise ValueError(f"Got {len(contrast_matrices)} contrast matrices for {n_runs} runs.")
+    contrast_matrices = [np.atleast_2d(np.asarray(con, dtype=float)) for con in contrast_matrices]
+
+    n_contrasts = contrast_matrices[0].shape[0]
+    effect, variance = 0.0, 0.0
+    dof = np.zeros(n_contrasts)
+    n_contributing_runs = np.zeros(n_contrasts)
+    for run_idx, con in enumerate(contrast_matrices):
+        active = np.any(con != 0, axis=1)
+        if not np.any(active):
+            continue
+        run_effect, run_variance = run_contrasts(run_idx, con)
+        effect = effect + run_effect * active[:, None]
+        variance = variance + run_variance * active[:, None]
+        dof += run_dofs[run_idx] * active
+        n_contributing_runs += active
+
+    if np.any(n_contributing_runs == 0):
+        empty = np.flatnonzero(n_contributing_runs == 0).tolist()
+        raise ValueError(f"Contrast rows {empty} are all zeros in every run.")
+
+    effect = effect / n_contributing_runs[:, None]
+    variance = variance / (n_contributing_runs ** 2)[:, None]
+    return contrast_statistics(effect, variance, dof)
+
+
+def compute_contrast_arrays(labels, results, contrast_matrices):
+    """
+    Computes fixed-effects t-contrasts for all C contrasts in one pass over the fitted runs.
+
+    Args:
+        labels (list): Per-run arrays of noise-model labels per voxel (FirstLevelModel.labels_).
+        results (list): Per-run dicts of label -> regression results (FirstLevelModel.results_).
+        contrast_matrices (np.ndarray or list): A C x P matrix applied to every run, or one
+            C x P matrix per run.
+
+    Returns:
+        dict: Arrays of shape (C, n_voxels) for every entry of OUTPUT_TYPES.
+    """
+    def run_contrasts(run_idx, con):
+        effect = np.zeros((con.shape[0], labels[run_idx].size))
+        variance = np.zeros_like(effect)
+        for label, result in results[run_idx].items():
+            voxels = labels[run_idx] == label
+            # effect = C theta and variance = diag(C cov C') * dispersion, for all contrasts at once
+            effect[:, voxels] = con @ result.theta
+            con_cov_con = np.einsum('ij,jk,ik->i', con, result.cov, con)
+            variance[:, voxels] = con_cov_con[:, None] * np.asarray(result.dispersion)
+        return effect, variance
+
+    run_dofs = [next(iter(run_results.values())).df_residuals for run_results in results]
+    return fixed_effects_contrasts(contrast_matrices, len(results), run_contrasts, run_dofs)
+
+
+def contrast_statistics(effect, variance, dof):
+    """
+    Turns fixed-effects contrast estimates into all nilearn output types.
+
+    Args:
+        effect (np.ndarray): Contrast effects, shape (C, n_voxels).
+        variance (np.ndarray): Contrast variances, shape (C, n_voxels).
+        dof (np.ndarray): Degrees of freedom per contrast, shape (C,).
+
+    Returns:
+        dict: Arrays of shape (C, n_voxels) for every entry of OUTPUT_TYPES.
+    """
+    stat = effect / np.sqrt(np.maximum(variance, _TINY))
+    dof_t = np.minimum(np.asarray(dof, dtype=float), _DOFMAX)[:, None]
+    p_value = sps.t.sf(stat, dof_t)
+    one_minus_p_value = sps.t.cdf(stat, dof_t)
+
+    return {
+        "z_score": _z_score(p_value, one_minus_p_value),
+        "stat": stat,
+        "p_value": p_value,
+        "effect_size": effect,
+        "effect_variance": variance,
+    }
+
+
+@profiled("contrasts")
+def compute_contrasts_batch(fmri_glm, contrast_matrix, contrast_names=None,
+                            output_type="z_score", as_4d=False):
+    """
+    Computes many contrasts of a fitted GLM at once and returns them as images.
+
+    Args:
+        fmri_glm: Fitted FirstLevelModel, or a glm_store.StoredGLM.
+        contrast_matrix (np.ndarray or list): C x P contrast weights, or one matrix per run.
+        contrast_names (list, optional): Names for the C rows. Defaults to their indices.
+        output_type (str, optional): One of OUTPUT_TYPES, or "all". Defaults to "z_score".
+        as_4d (bool, optional): If True, return one 4D image with a volume per contrast
+                                instead of a dict of 3D images. Defaults to False.
+
+    Returns:
+        dict or Nifti1Image: name -> image, a 4D image, or (for output_type="all")
+                             a dict of those keyed by output type.
+    """
+    if output_type != "all" and output_type not in OUTPUT_TYPES:
+        raise ValueError(f"output_type must be one of {OUTPUT_TYPES + ['all']}, got '{output_type}'.")
+
+    if hasattr(fmri_glm, 'compute_contrast_arrays'):
+        # Array-backed stores compute contrasts directly from their memory-mapped arrays
+        arrays = fmri_glm.compute_contrast_arrays(contrast_matrix)
+    else:
+        arrays = compute_contrast_arrays(fmri_glm.labels_, fmri_glm.results_, contrast_matrix)
+    n_contrasts = arrays["z_score"].shape[0]
+    if contrast_names is None:
+        contrast_names = [str(i) for i in range(n_contrasts)]
+    if len(contrast_names) != n_contrasts:
+        raise ValueError(f"Got {len(contrast_names)} names for {n_contrasts} contrasts.")
+
+    def to_images(values):
+        if as_4d:
+            return fmri_glm.masker_.inverse_transform(values)
+        return {name: fmri_glm.masker_.inverse_transform(row)
+                for name, row in zip(contrast_names, values)}
+
+    if output_type == "all":
+        return {key: to_images(values) for key, values in arrays.items()}
+    return to_images(arrays[output_type])
@@ -1,6 +1,9 @@
 import argparse
 import sys
 
+from confounds import STRATEGIES
+from rendering import FIGURE_KINDS
+
 def parse_arguments():
     """
     Parses command-line arguments and returns the parsed args object.
@@ -14,23 +17,56 @@ def parse_arguments():
     exp_args.add_argument("--session", type=int, default=1, help="Session number (e.g., 1)")
     exp_args.add_argument("--task", type=str, default='swp', help="Task name is required in BIDS, e.g., 'swp'")
     exp_args.add_argument("--num-runs", type=int, default=6, help="Number of runs to process (default: 1)")
+    exp_args.add_argument("--exclude-runs", type=int, nargs="+", default=[], help="Run numbers to leave out of the model, e.g. runs with bad motion; fastest with --glm-store runs (default: none)")
+    exp_args.add_argument("--confounds", type=str, default="motion6", choices=list(STRATEGIES), help="Confound strategy: motion parameters with optional derivatives, quadratic terms, framewise displacement and tissue signals (default: motion6)")
 
     # Contrast Arguments Group
     contrast_args = parser.add_argument_group("Contrast Arguments")
     contrast_args.add_argument("--contrast-file", type=str, default="contrasts.json", help="Path to the contrast file (default: contrasts.json)")
-    contrast_args.add_argument("--contrast-name", type=str, default="real > pseudo", help="Name of the contrast to analyze (default: vis_aud)")
+    contrast_args.add_argument("--contrast-name", type=str, default="real > pseudo", help="Name of the contrast to analyze, a glob pattern such as 'real > pseudo*', or 'all' to run every contrast in the contrast file (default: real > pseudo)")
+    contrast_args.add_argument("--list-contrasts", action="store_true", help="Print the contrasts of the contrast file (those matching --contrast-name if it is a glob pattern) and exit (default: False)")
+    contrast_args.add_argument("--contrasts-from", type=str, default=None, help="Path to a text file with one contrast name per line; all are run in a single process (default: None)")
 
     # Statistical Thresholding Arguments Group
     stat_args = parser.add_argument_group("Statistical Thresholding Arguments")
-    stat_args.add_argument("--threshold_z", type=float, default=2, help="Alpha level for statistical thresholding (default: 0.05)")
-    stat_args.add_argument("--alpha", type=float, default=0.05, help="Alpha level for statistical thresholding (default: 0.05)")
-    stat_args.add_argument("--cluster-threshold", type=int, default=1, help="Cluster size threshold for statistical maps (default: 10)")
+    stat_args.add_argument("--threshold_z", type=float, nargs="+", default=[2], help="One or more z thresholds; all share one z-map (default: 2)")
+    stat_args.add_argument("--alpha", type=float, nargs="+", default=None, help="One or more FDR alpha levels; all share one z-map. FDR maps are only made when given (default: None)")
+    stat_args.add_argument("--cluster-threshold", type=int, nargs="+", default=[1], help="One or more cluster size thresholds for statistical maps (default: 1)")
+
+    # Figure Arguments Group
+    figure_args = parser.add_argument_group("Figure Arguments")
+    figure_args.add_argument("--figure-kinds", type=str, nargs="+", default=None, choices=FIGURE_KINDS, help="Figure kinds to render (default: all)")
+    figure_args.add_argument("--render-jobs", type=int, default=1, help="Number of processes rendering figures in the background (default: 1, render inline)")
+    figure_args.add_argument("--compute-only", action="store_true", help="Save z-maps, thresholded maps and cluster tables without drawing any figure (default: False)")
+    figure_args.add_argument("--force-figures", action="store_true", help="Re-render figures even if they are newer than their stat maps (default: False)")
 
     # Path Arguments Group
     path_args = parser.add_argument_group("Path Arguments")
     path_args.add_argument("--path2root", type=str, default='..', help="Path to input data directory")
+    path_args.add_argument("--glm-cache-max-gb", type=float, default=None, help="Maximum size of the GLM model cache in GB; least recently used models are evicted (default: unlimited)")
+    path_args.add_argument("--bold-cache", action="store_true", help="Keep uncompressed copies of the BOLD runs in output/bold_cache so refits skip decompression (default: False)")
+    path_args.add_argument("--bold-cache-max-gb", type=float, default=None, help="Maximum size of the BOLD cache in GB; least recently used runs are evicted (default: unlimited)")
+    path_args.add_argument("--glm-store", type=str, default="pickle", choices=["pickle", "arrays", "runs"], help="How fitted GLMs are cached: a pickled FirstLevelModel, memory-mappable arrays, or per-run sufficient statistics from which any subset of runs is assembled without refitting (default: pickle)")
+    path_args.add_argument("--memory-budget", type=float, default=None, help="Fit the GLM in blocks of voxels using at most this many GB for the fit; the model is cached as arrays unless --glm-store is runs (default: fit all voxels at once with FirstLevelModel)")
+
+    # Profiling Arguments Group
+    profile_args = parser.add_argument_group("Profiling Arguments")
+    profile_args.add_argument("--profile", action="store_true", help="Record wall time, CPU time, peak RSS and bytes read of every stage and save a JSON summary and a Chrome trace (default: False)")
+    profile_args.add_argument("--profile-dir", type=str, default=None, help="Folder for the profile files (default: <path2root>/output/profiles)")
+    profile_args.add_argument("--cprofile", action="store_true", help="With --profile, also dump a cProfile .prof file per stage (default: False)")
 
     # GLM Parameters Group (for help message organization)
+    _add_glm_arguments(parser)
+    
+    args = parser.parse_args()
+    if args.cprofile and not args.profile:
+        parser.error("--cprofile requires --profile")
+    return args
+
+def _add_glm_arguments(parser):
+    """
+    Adds the GLM parameter group shared by the single-run and batch entry points.
+    """
     glm_args = parser.add_argument_group("GLM Parameters")
     glm_args.add_argument("--t-r", type=float, default=1.81, help="GLM parameter: Repetition time (default: 1.81)")
     glm_args.add_argument("--noise-model", type=str, default="ar1", help="GLM parameter: Noise model (default: ar1)")
@@ -38,8 +74,144 @@ def parse_arguments():
     glm_args.add_argument("--hrf-model", type=str, default="spm", help="GLM parameter: HRF model (default: spm)")
     glm_args.add_argument("--drift-model", type=str, default="cosine", help="GLM parameter: Drift model (default: cosine)")
     glm_args.add_argument("--high-pass", type=float, default=0.01, help="GLM parameter: High pass filter cutoff (default: 0.01)")
-    
-    return parser.parse_args()
+    glm_args.add_argument("--smoothing-fwhm", type=float, default=8.0, help="GLM parameter: Smoothing FWHM in mm (default: 8.0)")
+
+def parse_batch_arguments(argv=None):
+    """
+    Parses command-line arguments for batch_pipeline.py sweeps.
+    """
+    parser = argparse.ArgumentParser(description="Run a subjects x tasks x thresholds sweep as a dependency graph on a process pool.")
+
+    sweep_args = parser.add_argument_group("Sweep Arguments")
+    sweep_args.add_argument("--subjects", type=int, nargs="+", default=[1, 2, 3], help="Subject numbers (default: 1 2 3)")
+    sweep_args.add_argument("--session", type=int, default=1, help="Session number (default: 1)")
+    sweep_args.add_argument("--task-spec", type=str, action="append", default=None, help="'task,num_runs,contrast_name' (repeatable); contrast_name may be 'all' or a glob pattern (default: swp,6,all)")
+    sweep_args.add_argument("--alphas", type=float, nargs="+", default=[0.05], help="FDR alpha levels (default: 0.05)")
+    sweep_args.add_argument("--cluster-threshold", type=int, default=1, help="Cluster size threshold for statistical maps (default: 1)")
+    sweep_args.add_argument("--contrast-file", type=str, default="contrasts.json", help="Path to the contrast file (default: contrasts.json)")
+    sweep_args.add_argument("--make-events", action="store_true", help="Regenerate the event TSV files before loading data (default: False)")
+
+    figure_args = parser.add_argument_group("Figure Arguments")
+    figure_args.add_argument("--figure-kinds", type=str, nargs="+", default=None, choices=FIGURE_KINDS, help="Figure kinds to render; the sweep draws stat_map and glass_brain (default: all)")
+    figure_args.add_argument("--force-figures", action="store_true", help="Re-render figures even if they are newer than their stat maps (default: False)")
+
+    run_args = parser.add_argument_group("Execution Arguments")
+    run_args.add_argument("--n-jobs", type=int, default=1, help="Number of worker processes (default: 1)")
+    run_args.add_argument("--path2root", type=str, default='..', help="Path to input data directory")
+    run_args.add_argument("--restart", action="store_true", help="Ignore completed nodes from a previous run and recompute everything (default: False)")
+
+    _add_glm_arguments(parser)
+
+    return parser.parse_args(argv)
+
+def parse_group_arguments(argv=None):
+    """
+    Parses command-line arguments for group_analysis.py.
+    """
+    from group_analysis import GROUP_MODELS
+
+    parser = argparse.ArgumentParser(description="Fit first levels per subject in parallel, then a second-level model over their effect maps.")
+
+    group_args = parser.add_argument_group("Group Arguments")
+    group_args.add_argument("--subjects", type=int, nargs="+", default=[1, 2, 3], help="Subject numbers (default: 1 2 3)")
+    group_args.add_argument("--session", type=int, default=1, help="Session number (default: 1)")
+    group_args.add_argument("--task", type=str, default='swp', help="Task name (default: swp)")
+    group_args.add_argument("--num-runs", type=int, default=6, help="Number of runs per subject (default: 6)")
+    group_args.add_argument("--confounds", type=str, default="motion6", choices=list(STRATEGIES), help="Confound strategy of the first levels (default: motion6)")
+    group_args.add_argument("--contrast-file", type=str, default="contrasts.json", help="Path to the contrast file (default: contrasts.json)")
+    group_args.add_argument("--contrast-name", type=str, default="real > pseudo", help="Contrast to test, a glob pattern, or 'all' (default: real > pseudo)")
+    group_args.add_argument("--model", type=str, default="one-sample", choices=GROUP_MODELS, help="Second-level model (default: one-sample)")
+    group_args.add_argument("--paired-with", type=str, default=None, help="For --model paired: the contrast subtracted within each subject (default: None)")
+    group_args.add_argument("--mixed-effects", action="store_true", help="Weight subjects by their first-level variances (DerSimonian-Laird) instead of an ordinary t-test (default: False)")
+
+    perm_args = parser.add_argument_group("Permutation Arguments")
+    perm_args.add_argument("--n-permutations", type=int, default=0, help="Number of sign-flipping permutations for FWE-corrected p-maps; 0 skips permutation inference (default: 0)")
+    perm_args.add_argument("--cluster-forming-z", type=float, default=None, help="z threshold forming clusters for cluster-mass inference; requires --n-permutations (default: None, voxel-level only)")
+    perm_args.add_argument("--seed", type=int, default=0, help="Seed of the random sign flips (default: 0)")
+
+    run_args = parser.add_argument_group("Execution Arguments")
+    run_args.add_argument("--n-jobs", type=int, default=1, help="Number of subjects fitted, and permutation chunks run, in parallel (default: 1)")
+    run_args.add_argument("--path2root", type=str, default='..', help="Path to input data directory")
+    run_args.add_argument("--force", action="store_true", help="Recompute all first-level maps even if they are up to date (default: False)")
+
+    _add_glm_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.model == "paired" and args.paired_with is None:
+        parser.error("--model paired requires --paired-with")
+    if args.cluster_forming_z is not None and args.n_permutations <= 0:
+        parser.error("--cluster-forming-z requires --n-permutations")
+    return args
+
+def parse_reliability_arguments(argv=None):
+    """
+    Parses command-line arguments for reliability.py.
+    """
+    parser = argparse.ArgumentParser(description="Fit runs in parallel and map the split-half and leave-one-run-out reliability of contrasts.")
+
+    reliability_args = parser.add_argument_group("Reliability Arguments")
+    reliability_args.add_argument("--subjects", type=int, nargs="+", default=[1, 2, 3], help="Subject numbers (default: 1 2 3)")
+    reliability_args.add_argument("--session", type=int, default=1, help="Session number (default: 1)")
+    reliability_args.add_argument("--task", type=str, default='swp', help="Task name (default: swp)")
+    reliability_args.add_argument("--num-runs", type=int, default=6, help="Number of runs per subject (default: 6)")
+    reliability_args.add_argument("--exclude-runs", type=int, nargs="+", default=[], help="Run numbers left out of all splits (default: none)")
+    reliability_args.add_argument("--confounds", type=str, default="motion6", choices=list(STRATEGIES), help="Confound strategy (default: motion6)")
+    reliability_args.add_argument("--contrast-file", type=str, default="contrasts.json", help="Path to the contrast file (default: contrasts.json)")
+    reliability_args.add_argument("--contrast-name", type=str, default="all", help="Contrast to assess, a glob pattern, or 'all' (default: all)")
+    reliability_args.add_argument("--threshold-z", type=float, nargs="+", default=[3.1], help="z thresholds of the Dice overlaps (default: 3.1)")
+
+    run_args = parser.add_argument_group("Execution Arguments")
+    run_args.add_argument("--n-jobs", type=int, default=1, help="Number of runs fitted in parallel (default: 1)")
+    run_args.add_argument("--memory-budget", type=float, default=None, help="Memory budget in GB shared by the run fits (default: 1 GB)")
+    run_args.add_argument("--path2root", type=str, default='..', help="Path to input data directory")
+
+    _add_glm_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.num_runs - len(set(args.exclude_runs) & set(range(1, args.num_runs + 1))) < 2:
+        parser.error("reliability needs at least 2 runs")
+    return args
+
+def parse_benchmark_arguments(argv=None):
+    """
+    Parses command-line arguments for benchmarks/run_benchmarks.py.
+    """
+    from benchmarks.run_benchmarks import DEFAULT_BASELINE, SCALES, STAGES
+
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic SWP-shaped data and compare with a baseline.")
+
+    scale_args = parser.add_argument_group("Scale Arguments")
+    scale_args.add_argument("--scales", type=str, nargs="+", default=["small", "medium"], choices=list(SCALES), help="Dataset scales to benchmark (default: small medium)")
+    scale_args.add_argument("--resolution", type=int, default=None, help="Voxel size in mm of a custom scale, replacing --scales (default: None)")
+    scale_args.add_argument("--n-subjects", type=int, default=1, help="Subjects of a custom scale (default: 1)")
+    scale_args.add_argument("--n-runs", type=int, default=6, help="Runs per subject of a custom scale (default: 6)")
+    scale_args.add_argument("--n-volumes", type=int, default=None, help="Volumes per run of a custom scale (default: the length of the events)")
+    scale_args.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data (default: 0)")
+
+    run_args = parser.add_argument_group("Execution Arguments")
+    run_args.add_argument("--stages", type=str, nargs="+", default=None, choices=STAGES, help="Stages to time (default: all)")
+    run_args.add_argument("--repeats", type=int, default=3, help="Timed repeats per stage (default: 3)")
+    run_args.add_argument("--work-dir", type=str, default=None, help="Where synthetic datasets are kept (default: ../output/benchmarks)")
+    run_args.add_argument("--output", type=str, default=None, help="JSON file to save the results to (default: None)")
+    run_args.add_argument("--skip-equivalence", action="store_true", help="Do not compare the z-maps of the chunked, run-statistics and stored GLM engines with FirstLevelModel (default: False)")
+
+    baseline_args = parser.add_argument_group("Baseline Arguments")
+    baseline_args.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help="Baseline JSON to compare with (default: benchmarks/baseline.json)")
+    baseline_args.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline instead of comparing (default: False)")
+    baseline_args.add_argument("--tolerance", type=float, default=0.25, help="Relative slowdown or memory growth reported as a regression (default: 0.25)")
+
+    return parser.parse_args(argv)
+
+def parse_event_arguments(argv=None):
+    """
+    Parses command-line arguments for create_event_tsv_files.py.
+    """
+    parser = argparse.ArgumentParser(description="Create BIDS event files from the run CSVs, regenerating only those whose CSVs changed.")
+    parser.add_argument("--subjects", type=int, nargs="+", default=[1, 2, 3], help="Subject numbers (default: 1 2 3)")
+    parser.add_argument("--n-jobs", type=int, default=1, help="Number of subjects processed in parallel (default: 1)")
+    parser.add_argument("--force", action="store_true", help="Regenerate all event files even if their CSVs are unchanged (default: False)")
+
+    return parser.parse_args(argv)
 
 def get_arg_groups(args):
     """
@@ -52,13 +224,28 @@ def get_arg_groups(args):
         'num_runs': args.num_runs
     }
 
+    return exp_params, get_glm_params(args)
+
+def default_glm_params():
+    """
+    GLM parameters with their command-line defaults.
+    """
+    parser = argparse.ArgumentParser()
+    _add_glm_arguments(parser)
+    return get_glm_params(parser.parse_args([]))
+
+def get_glm_params(args):
+    """
+    Collects the GLM parameters (FirstLevelModel keyword arguments) from parsed arguments.
+    """
     glm_params = {
         't_r': args.t_r,
         'noise_model': args.noise_model,
         'standardize': args.standardize,
         'hrf_model': args.hrf_model,
         'drift_model': args.drift_model,
-        'high_pass': args.high_pass
+        'high_pass': args.high_pass,
+        'smoothing_fwhm': args.smoothing_fwhm
     }
     
-    return exp_params, glm_params
\ No newline at end of file
+    return glm_params
\ No newline at end of file
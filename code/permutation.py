@@ -0,0 +1,225 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from scipy import stats as sps
+
+
+# Permutations are drawn in fixed-size chunks with one seed each, so the null
+# distributions only depend on the seed and not on how many workers ran them
+CHUNK_SIZE = 256
+
+# Upper bound on the (batch x contrasts x voxels) float32 block of t-values held at once
+BATCH_BYTES = 256 * 1024**2
+
+# Voxels sharing a face are neighbours, as in nilearn's permuted_ols
+CLUSTER_STRUCTURE = ndimage.generate_binary_structure(3, 1)
+
+
+def sign_flips(n_subjects, n_permutations, seed=0):
+    """
+    Lists the sign-flip chunks of a permutation run as (seed, first index, size).
+
+    When 2^n_subjects <= n_permutations every sign pattern is enumerated once instead of
+    drawn at random (seed is then None), which makes the p-values exact.
+
+    Returns:
+        tuple: (list of chunks, total number of permutations, whether it is exhaustive)
+    """
+    exhaustive = 2 ** n_subjects <= n_permutations
+    if exhaustive:
+        n_permutations = 2 ** n_subjects
+    starts = range(0, n_permutations, CHUNK_SIZE)
+    if exhaustive:
+        seeds = [None] * len(starts)
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    chunks = [(chunk_seed, start, min(CHUNK_SIZE, n_permutations - start))
+              for chunk_seed, start in zip(seeds, starts)]
+    return chunks, n_permutations, exhaustive
+
+
+def _flip_matrix(n_subjects, chunk_seed, start, size):
+    """Builds the (size x n_subjects) matrix of +-1 signs of one chunk."""
+    if chunk_seed is None:
+        # Bit j of the permutation index flips subject j; index 0 is the unpermuted data
+        indices = np.arange(start, start + size)[:, None]
+        bits = (indices >> np.arange(n_subjects)[None, :]) & 1
+        return (1 - 2 * bits).astype(np.float32)
+    rng = np.random.default_rng(chunk_seed)
+    return rng.choice(np.array([-1, 1], dtype=np.float32), size=(size, n_subjects))
+
+
+def one_sample_t(signed_sums, sum_squares, n_subjects):
+    """
+    One-sample t-values from sums over subjects. Flipping signs changes the sum but not
+    the sum of squares, so every permutation only needs the product S @ Y.
+
+    Args:
+        signed_sums (np.ndarray): Sums of the sign-flipped subject maps, shape (..., V).
+        sum_squares (np.ndarray): Sums of squares over subjects, shape (V,).
+        n_subjects (int): Number of subjects.
+    """
+    mean = signed_sums / n_subjects
+    variance = (sum_squares - n_subjects * mean ** 2) / (n_subjects - 1)
+    return mean / np.sqrt(np.maximum(variance, 1e-30) / n_subjects)
+
+
+def cluster_masses(t_values, mask, threshold):
+    """
+    Sums |t| over the clusters of voxels above threshold, one sign at a time.
+
+    Args:
+        t_values (np.ndarray): In-mask t-values, shape (V,).
+        mask (np.ndarray): 3D boolean mask with V voxels.
+        threshold (float): Cluster-forming threshold on |t|.
+
+    Returns:
+        list: (labelled 3D volume, mass per label (index 0 unused)) for the positive and
+              the negative tail.
+    """
+    tails = []
+    volume = np.zeros(mask.shape, dtype=np.float32)
+    for sign in (1, -1):
+        volume[mask] = sign * t_values
+        labels, n_clusters = ndimage.label(volume > threshold, structure=CLUSTER_STRUCTURE)
+        masses = np.zeros(n_clusters + 1)
+        if n_clusters:
+            masses[1:] = ndimage.sum_labels(np.abs(volume), labels, np.arange(1, n_clusters + 1))
+        tails.append((labels, masses))
+    return tails
+
+
+def _max_cluster_mass(t_values, mask, threshold):
+    return max(masses.max(initial=0) for _, masses in cluster_masses(t_values, mask, threshold))
+
+
+def _batch_size(n_contrasts, n_voxels):
+    return max(1, min(CHUNK_SIZE, BATCH_BYTES // (4 * n_contrasts * n_voxels)))
+
+
+def _run_chunk(data_file, mask_file, chunk, t_threshold):
+    """
+    Computes the null maxima of one chunk of sign flips. Runs in a worker process (or
+    inline), reading the stacked subject maps memory-mapped from data_file.
+
+    Returns:
+        tuple: (max |t| per permutation and contrast, max cluster mass per permutation
+                and contrast, or None without a cluster-forming threshold)
+    """
+    data = np.load(data_file, mmap_mode='r')
+    n_subjects, n_contrasts, n_voxels = data.shape
+    flat = np.asarray(data, dtype=np.float32).reshape(n_subjects, -1)
+    sum_squares = np.einsum('ij,ij->j', flat, flat)
+    mask = np.load(mask_file) if t_threshold is not None else None
+
+    chunk_seed, start, size = chunk
+    flips = _flip_matrix(n_subjects, chunk_seed, start, size)
+    max_t = np.empty((size, n_contrasts))
+    max_mass = np.empty((size, n_contrasts)) if t_threshold is not None else None
+
+    batch = _batch_size(n_contrasts, n_voxels)
+    for first in range(0, size, batch):
+        # All voxels of all contrasts for a batch of permutations in one matrix product
+        t_values = one_sample_t(flips[first:first + batch] @ flat, sum_squares, n_subjects)
+        t_values = t_values.reshape(-1, n_contrasts, n_voxels)
+        max_t[first:first + batch] = np.abs(t_values).max(axis=2)
+        if t_threshold is not None:
+            for i, permuted in enumerate(t_values):
+                for c in range(n_contrasts):
+                    max_mass[first + i, c] = _max_cluster_mass(permuted[c], mask, t_threshold)
+    return max_t, max_mass
+
+
+def permutation_test(data, mask, n_permutations=10000, cluster_forming_z=None, seed=0, n_jobs=1,
+                     work_dir=None):
+    """
+    Sign-flipping permutation test of one-sample t-tests over subjects, for all contrasts
+    at once, with family-wise error control by the maximum statistic.
+
+    Every permutation flips the sign of whole subject maps; a batch of permutations is one
+    (batch x subjects) @ (subjects x contrasts*voxels) product. Chunks of permutations
+    are spread over worker processes, each with its own seed spawned from seed, so the
+    result does not depend on n_jobs.
+
+    Args:
+        data (np.ndarray): Subject maps, shape (n_subjects, n_contrasts, n_voxels).
+        mask (np.ndarray): 3D boolean mask of the n_voxels voxels (for clusters).
+        n_permutations (int, optional): Number of sign flips. Defaults to 10000.
+        cluster_forming_z (float, optional): If given, also computes cluster-mass inference
+                                             with clusters formed at this z. Defaults to None.
+        seed (int, optional): Seed of the random sign flips. Defaults to 0.
+        n_jobs (int, optional): Number of worker processes. Defaults to 1.
+        work_dir (str, optional): Where the stacked maps are written for the workers.
+                                  Defaults to a temporary directory.
+
+    Returns:
+        dict: 't' (C x V observed t-values), 'logp_max_t' (C x V, -log10 FWE p-values of
+              the voxels), 'logp_max_mass' (C x V, -log10 FWE p-values of the clusters, if
+              cluster_forming_z is given), 'n_permutations', 'exhaustive', 'seconds' and
+              'permutations_per_second'.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    n_subjects, n_contrasts, n_voxels = data.shape
+    if n_subjects < 2:
+        raise ValueError(f"A permutation test needs at least 2 subjects, got {n_subjects}.")
+    if mask.sum() != n_voxels:
+        raise ValueError(f"The mask has {mask.sum()} voxels but the maps have {n_voxels}.")
+
+    t_threshold = None
+    if cluster_forming_z is not None:
+        # Same tail probability as the z threshold, for the t distribution of the test
+        t_threshold = float(sps.t.isf(sps.norm.sf(cluster_forming_z), n_subjects - 1))
+
+    chunks, n_permutations, exhaustive = sign_flips(n_subjects, n_permutations, seed)
+
+    t_start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        data_file, mask_file = os.path.join(tmp_dir, "data.npy"), os.path.join(tmp_dir, "mask.npy")
+        np.save(data_file, data)
+        np.save(mask_file, mask)
+        args = (data_file, mask_file)
+        if n_jobs <= 1 or len(chunks) <= 1:
+            results = [_run_chunk(*args, chunk, t_threshold) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(chunks))) as pool:
+                futures = [pool.submit(_run_chunk, *args, chunk, t_threshold) for chunk in chunks]
+                results = [future.result() for future in futures]
+    seconds = time.perf_counter() - t_start
+
+    null_max_t = np.concatenate([max_t for max_t, _ in results])
+    flat = data.reshape(n_subjects, -1)
+    observed = one_sample_t(flat.sum(axis=0), np.einsum('ij,ij->j', flat, flat), n_subjects)
+    observed = observed.reshape(n_contrasts, n_voxels)
+
+    # FWE p-value: fraction of permutations whose maximum reaches the observed value.
+    # Exhaustive runs include the identity; random ones count the observed data once more.
+    n_null = n_permutations if exhaustive else n_permutations + 1
+    extra = 0 if exhaustive else 1
+    sorted_max_t = np.sort(null_max_t, axis=0)
+    logp_max_t = np.empty((n_contrasts, n_voxels))
+    for c in range(n_contrasts):
+        n_exceeding = n_permutations - np.searchsorted(sorted_max_t[:, c], np.abs(observed[c]), side='left')
+        logp_max_t[c] = -np.log10((n_exceeding + extra) / n_null)
+
+    outputs = {'t': observed, 'logp_max_t': logp_max_t}
+    if t_threshold is not None:
+        null_max_mass = np.concatenate([max_mass for _, max_mass in results])
+        logp_max_mass = np.zeros((n_contrasts, n_voxels))
+        for c in range(n_contrasts):
+            sorted_mass = np.sort(null_max_mass[:, c])
+            for labels, masses in cluster_masses(observed[c], mask, t_threshold):
+                n_exceeding = n_permutations - np.searchsorted(sorted_mass, masses, side='left')
+                logp_clusters = -np.log10((n_exceeding + extra) / n_null)
+                logp_clusters[0] = 0
+                logp_max_mass[c] = np.maximum(logp_max_mass[c], logp_clusters[labels[mask]])
+        outputs['logp_max_mass'] = logp_max_mass
+
+    outputs.update({'n_permutations': n_permutations,
+                    'exhaustive': exhaustive,
+                    'seconds': seconds,
+                    'permutations_per_second': n_permutations / max(seconds, 1e-9)})
+    return outputs
@@ -0,0 +1,267 @@
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import time
+
+
+# Profiler of the current run; stages are only measured while one is active
+_active = None
+
+_PROC_IO = "/proc/self/io"
+_PROC_STATUS = "/proc/self/status"
+_PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+def _bytes_read():
+    """Bytes this process has read so far (all read calls on Linux, block input elsewhere)."""
+    try:
+        with open(_PROC_IO, 'r') as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_inblock * 512
+
+
+def _reset_peak_rss():
+    """Resets the kernel's peak RSS of this process (Linux only); True if it worked."""
+    try:
+        with open(_PROC_CLEAR_REFS, 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """Peak RSS in MB since the last reset (Linux), or of the whole process elsewhere."""
+    try:
+        with open(_PROC_STATUS, 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+class _Measurement:
+    """Wall time, CPU time, peak RSS and bytes read of one stage."""
+    def __init__(self, name, args, parent=None, cprofile_file=None):
+        self.name = name
+        self.args = args
+        self.parent = parent
+        self.cprofile_file = cprofile_file
+        self.record = None
+        self._child_peak_mb = 0.0
+
+    def __enter__(self):
+        self._profile = None
+        if self.cprofile_file is not None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        # Peak RSS is reset per stage where the kernel allows it; an enclosing stage
+        # keeps the highest peak of the stages it contains
+        self._peak_before = _peak_rss_mb()
+        self._reset = _reset_peak_rss()
+        self._bytes_start = _bytes_read()
+        self._cpu_start = time.process_time()
+        self._start = time.time()
+        self._wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall_start
+        cpu = time.process_time() - self._cpu_start
+        bytes_read = _bytes_read() - self._bytes_start
+        peak_mb = max(_peak_rss_mb(), self._child_peak_mb)
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.cprofile_file)
+        if self.parent is not None:
+            self.parent._child_peak_mb = max(self.parent._child_peak_mb, peak_mb,
+                                             self._peak_before if self._reset else 0.0)
+        self.record = {'name': self.name, 'start': self._start, 'wall_seconds': wall,
+                       'cpu_seconds': cpu, 'peak_rss_mb': peak_mb, 'bytes_read': bytes_read,
+                       'pid': os.getpid(), 'depth': 0, 'args': self.args,
+                       'failed': exc_type is not None}
+        return False
+
+
+def measure(name, **args):
+    """
+    Measures one stage whether or not a Profiler is active, e.g. in a worker process;
+    the record is in .record after the block and can be handed to add_record.
+    """
+    return _Measurement(name, args)
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, peak RSS and bytes read of the pipeline stages of one run.
+
+    Stages are marked with stage() blocks or the profiled() decorator, which do nothing
+    unless a Profiler was started. write() saves a JSON summary and a Chrome trace
+    (chrome://tracing or https://ui.perfetto.dev). With cprofile=True every outermost
+    stage is also run under cProfile and dumped to a .prof file.
+    """
+    def __init__(self, output_dir, run_name, cprofile=False):
+        """
+        Parameters:
+        output_dir (str): Folder the profile files are written to.
+        run_name (str): Prefix of the files, e.g. sub-01_ses-1_task-swp.
+        cprofile (bool, optional): Dump a cProfile of every outermost stage.
+        """
+        self.output_dir = output_dir
+        self.run_name = run_name
+        self.cprofile = cprofile
+        self.records = []
+        self._stack = []
+        self._start = time.time()
+
+    def stage(self, name, **args):
+        parent = self._stack[-1] if self._stack else None
+        cprofile_file = None
+        if self.cprofile and parent is None:
+            n_same = sum(record['name'] == name for record in self.records)
+            cprofile_file = os.path.join(self.output_dir, f"{self.run_name}_{name}_{n_same}.prof")
+            os.makedirs(self.output_dir, exist_ok=True)
+        return _ProfilerStage(self, _Measurement(name, args, parent, cprofile_file))
+
+    def add_record(self, record):
+        """Adds a stage measured elsewhere (e.g. in a worker process with measure())."""
+        self.records.append({**record, 'depth': len(self._stack)})
+
+    def summary(self):
+        """Totals per stage name, in order of first appearance."""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['name'], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                       'peak_rss_mb': 0.0, 'bytes_read': 0})
+            total['calls'] += 1
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+            total['bytes_read'] += record['bytes_read']
+        return totals
+
+    def print_summary(self):
+        print("Stage profile (wall / CPU / peak RSS / read):")
+        for name, total in self.summary().items():
+            print(f"  {total['wall_seconds']:8.2f} s  {total['cpu_seconds']:8.2f} s  "
+                  f"{total['peak_rss_mb']:7.0f} MB  {total['bytes_read'] / 1024**2:8.1f} MB  "
+                  f"{name} ({total['calls']}x)")
+
+    def chrome_trace(self):
+        """The records as Chrome trace 'complete' events (times in microseconds)."""
+        events = []
+        for record in self.records:
+            events.append({'name': record['name'], 'ph': 'X', 'pid': record['pid'], 'tid': record['pid'],
+                           'ts': (record['start'] - self._start) * 1e6,
+                           'dur': record['wall_seconds'] * 1e6,
+                           'args': {**{key: str(value) for key, value in record['args'].items()},
+                                    'cpu_seconds': record['cpu_seconds'],
+                                    'peak_rss_mb': record['peak_rss_mb'],
+                                    'bytes_read': record['bytes_read']}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self):
+        """
+        Writes <run_name>_profile.json (records and per-stage totals) and
+        <run_name>_trace.json (Chrome trace) to output_dir.
+
+        Returns:
+            tuple: (summary path, trace path)
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary_file = os.path.join(self.output_dir, f"{self.run_name}_profile.json")
+        trace_file = os.path.join(self.output_dir, f"{self.run_name}_trace.json")
+        with open(summary_file, 'w') as f:
+            json.dump({'run': self.run_name, 'start': self._start, 'stages': self.summary(),
+                       'records': self.records}, f, indent=2, default=str)
+        with open(trace_file, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        print(f"Profile saved to {summary_file} and {trace_file}")
+        return summary_file, trace_file
+
+
+class _ProfilerStage:
+    """Context manager pushing a measurement on a Profiler's stack of open stages."""
+    def __init__(self, profiler, measurement):
+        self.profiler = profiler
+        self.measurement = measurement
+
+    def __enter__(self):
+        self.profiler._stack.append(self.measurement)
+        self.measurement.__enter__()
+        return self.measurement
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.measurement.__exit__(exc_type, exc_value, traceback)
+        self.profiler._stack.pop()
+        self.profiler.records.append({**self.measurement.record, 'depth': len(self.profiler._stack)})
+        return False
+
+
+class _NoStage:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def start(profiler):
+    """Makes profiler the active one, so stage() blocks are measured."""
+    global _active
+    _active = profiler
+    return profiler
+
+
+def stop():
+    """Deactivates and returns the active Profiler."""
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+def is_active():
+    return _active is not None
+
+
+def stage(name, **args):
+    """
+    Context manager marking a pipeline stage; measured only while a Profiler is active.
+
+    Example:
+        with profiling.stage("glm_fit", n_runs=6):
+            ...
+    """
+    if _active is None:
+        return _NO_STAGE
+    return _active.stage(name, **args)
+
+
+def add_record(record):
+    """Adds a record from measure() to the active Profiler, if any."""
+    if _active is not None:
+        _active.add_record(record)
+
+
+def profiled(name):
+    """Decorator running a function as a stage() of the given name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,278 @@
+import os
+import time
+
+import numpy as np
+
+from multi_contrast import contrast_statistics
+
+
+SPLIT_HALF = "split-half"
+
+# Columns of the per-split table; a dice_z<threshold> column is added per threshold
+SPLIT_TABLE_COLUMNS = ["contrast", "split", "runs_a", "runs_b", "r"]
+
+
+def reliability_splits(run_ids):
+    """
+    Run splits compared for reliability: odd vs even runs, and every run left out
+    against the others.
+
+    Args:
+        run_ids (list): Run numbers of the model, in the order of its runs.
+
+    Returns:
+        dict: split name -> (run indices of half A, run indices of half B)
+    """
+    if len(run_ids) < 2:
+        raise ValueError(f"Reliability needs at least 2 runs, got {len(run_ids)}.")
+    indices = np.arange(len(run_ids))
+    splits = {SPLIT_HALF: ([i for i in indices if run_ids[i] % 2 == 1],
+                           [i for i in indices if run_ids[i] % 2 == 0])}
+    if not splits[SPLIT_HALF][0] or not splits[SPLIT_HALF][1]:
+        # Only odd (or only even) run numbers: alternate by position instead
+        splits[SPLIT_HALF] = (list(indices[::2]), list(indices[1::2]))
+    for i in indices:
+        splits[f"loro-run-{run_ids[i]:02d}"] = ([j for j in indices if j != i], [i])
+    return splits
+
+
+def map_correlations(z_a, z_b):
+    """Pearson correlation of every row of z_a with the same row of z_b, shape (C,)."""
+    a = z_a - z_a.mean(axis=1, keepdims=True)
+    b = z_b - z_b.mean(axis=1, keepdims=True)
+    denominator = np.sqrt(np.einsum('cv,cv->c', a, a) * np.einsum('cv,cv->c', b, b))
+    return np.divide(np.einsum('cv,cv->c', a, b), denominator,
+                     out=np.full(denominator.shape, np.nan), where=denominator > 0)
+
+
+def dice_coefficients(z_a, z_b, threshold):
+    """
+    Dice overlap of the supra-threshold voxels of every row of z_a and z_b, shape (C,).
+    Voxels overlap when both exceed the threshold with the same sign; rows with no
+    supra-threshold voxel in either map are NaN.
+    """
+    positive_a, negative_a = z_a > threshold, z_a < -threshold
+    positive_b, negative_b = z_b > threshold, z_b < -threshold
+    overlap = (positive_a & positive_b).sum(axis=1) + (negative_a & negative_b).sum(axis=1)
+    total = (positive_a | negative_a).sum(axis=1) + (positive_b | negative_b).sum(axis=1)
+    return np.divide(2.0 * overlap, total, out=np.full(total.shape, np.nan), where=total > 0)
+
+
+def _icc_consistency(target_means, rater_means, sum_of_squares, n_targets):
+    """
+    ICC(3,1), the consistency of single raters (Shrout & Fleiss), of every voxel from the
+    sums of a two-way layout of n_targets x n_raters values per voxel.
+
+    Args:
+        target_means (np.ndarray): Mean over raters of every target, shape (n_targets, n_voxels).
+        rater_means (np.ndarray): Mean over targets of every rater, shape (n_raters, n_voxels).
+        sum_of_squares (np.ndarray): Sum of the squared values, shape (n_voxels,).
+        n_targets (int): Number of targets.
+
+    Returns:
+        np.ndarray: ICC per voxel; NaN where the values do not vary.
+    """
+    n_raters = rater_means.shape[0]
+    grand_mean = rater_means.mean(axis=0)
+    correction = n_targets * n_raters * grand_mean ** 2
+    ss_targets = n_raters * (target_means ** 2).sum(axis=0) - correction
+    ss_raters = n_targets * (rater_means ** 2).sum(axis=0) - correction
+    ss_error = np.maximum(sum_of_squares - correction - ss_targets - ss_raters, 0)
+    ms_targets = ss_targets / (n_targets - 1)
+    ms_error = ss_error / ((n_targets - 1) * (n_raters - 1))
+    denominator = ms_targets + (n_raters - 1) * ms_error
+    return np.divide(ms_targets - ms_error, denominator, out=np.full(denominator.shape, np.nan),
+                     where=denominator > 0)
+
+
+def compute_reliability(glm, contrast_matrix, run_ids, thresholds=(3.1,)):
+    """
+    Split-half and leave-one-run-out reliability of all C contrasts at once.
+
+    Every split is assembled from per-run contrast effects and variances by summation
+    (fixed effects, see run_stats.RunStatsGLM): the sums over all runs and over the odd
+    runs are accumulated in one pass, then each left-out run is subtracted from the total.
+    Each pair of halves is turned into z-maps for all contrasts and compared over the mask.
+
+    Args:
+        glm (run_stats.RunStatsGLM): Model of the runs.
+        contrast_matrix (np.ndarray): C x P contrast weights.
+        run_ids (list): Run numbers of the model's runs, in order.
+        thresholds (list, optional): z thresholds of the Dice overlaps. Defaults to (3.1,).
+
+    Returns:
+        dict: 'splits' (split name -> dict of 'runs_a', 'runs_b', 'r' (C,) and
+              'dice' {threshold: (C,)}), 'voxelwise_icc' (n_voxels ICC(3,1) of the per-run
+              z-maps, with the contrasts as targets and the runs as raters: how consistently
+              every run reproduces the voxel's profile over the contrasts; NaN with fewer
+              than 2 contrasts) and 'split_half_conjunction' (C x n_voxels signed minimum of
+              the odd and even |z| where their signs agree, else 0).
+    """
+    contrast_matrix = np.atleast_2d(np.asarray(contrast_matrix, dtype=float))
+    splits = reliability_splits(run_ids)
+    n_runs = len(run_ids)
+    dof = np.array([meta['df_residuals'] for meta in glm.runs_meta])
+
+    def z_score(effect_sum, variance_sum, run_indices):
+        n = len(run_indices)
+        statistics = contrast_statistics(effect_sum / n, variance_sum / n ** 2,
+                                         np.full(contrast_matrix.shape[0], dof[run_indices].sum()))
+        return statistics["z_score"]
+
+    # One pass over the runs: the sums of every half that is not a single run or its complement
+    odd = set(splits[SPLIT_HALF][0])
+    totals = {'all': [0.0, 0.0], 'odd': [0.0, 0.0]}
+    for run_idx in range(n_runs):
+        effect, variance = glm.run_contrasts(run_idx, contrast_matrix)
+        for name in ['all'] + (['odd'] if run_idx in odd else []):
+            totals[name][0] = totals[name][0] + effect
+            totals[name][1] = totals[name][1] + variance
+
+    results = {'splits': {}}
+
+    def compare(split, z_a, z_b):
+        runs_a, runs_b = splits[split]
+        results['splits'][split] = {
+            'runs_a': [run_ids[i] for i in runs_a],
+            'runs_b': [run_ids[i] for i in runs_b],
+            'r': map_correlations(z_a, z_b),
+            'dice': {threshold: dice_coefficients(z_a, z_b, threshold) for threshold in thresholds},
+        }
+
+    runs_odd, runs_even = splits[SPLIT_HALF]
+    z_odd = z_score(*totals['odd'], runs_odd)
+    z_even = z_score(totals['all'][0] - totals['odd'][0], totals['all'][1] - totals['odd'][1], runs_even)
+    compare(SPLIT_HALF, z_odd, z_even)
+    agree = np.sign(z_odd) == np.sign(z_even)
+    results['split_half_conjunction'] = np.where(agree, np.sign(z_odd) * np.minimum(np.abs(z_odd),
+                                                                                   np.abs(z_even)), 0.0)
+    del z_odd, z_even, agree
+
+    # Leave one run out: the run against the total minus the run. The per-run z-maps are
+    # also folded into the sums of the voxelwise ICC (see _icc_consistency).
+    n_contrasts = contrast_matrix.shape[0]
+    z_sum, z_squares, run_means = 0.0, 0.0, []
+    for run_idx in range(n_runs):
+        split = f"loro-run-{run_ids[run_idx]:02d}"
+        effect, variance = glm.run_contrasts(run_idx, contrast_matrix)
+        z_rest = z_score(totals['all'][0] - effect, totals['all'][1] - variance, splits[split][0])
+        z_run = z_score(effect, variance, [run_idx])
+        compare(split, z_rest, z_run)
+        z_sum = z_sum + z_run
+        z_squares = z_squares + (z_run ** 2).sum(axis=0)
+        run_means.append(z_run.mean(axis=0))
+
+    results['voxelwise_icc'] = _icc_consistency(z_sum / n_runs, np.array(run_means), z_squares, n_contrasts)
+    return results
+
+
+def reliability_tables(results, contrast_names, thresholds):
+    """
+    Returns:
+        tuple: (one row per contrast and split, one row per contrast summarizing the
+                split-half and mean leave-one-run-out values, most reliable first)
+    """
+    import pandas as pd
+
+    rows = []
+    for split, split_results in results['splits'].items():
+        for i, contrast_name in enumerate(contrast_names):
+            row = {"contrast": contrast_name, "split": split,
+                   "runs_a": " ".join(str(run) for run in split_results['runs_a']),
+                   "runs_b": " ".join(str(run) for run in split_results['runs_b']),
+                   "r": split_results['r'][i]}
+            for threshold in thresholds:
+                row[f"dice_z{threshold}"] = split_results['dice'][threshold][i]
+            rows.append(row)
+    split_table = pd.DataFrame(rows)
+
+    loro = split_table[split_table["split"] != SPLIT_HALF].groupby("contrast", sort=False)
+    half = split_table[split_table["split"] == SPLIT_HALF].set_index("contrast")
+    summary = pd.DataFrame({"contrast": contrast_names, "volume": np.arange(len(contrast_names))})
+    summary["split_half_r"] = half.loc[contrast_names, "r"].to_numpy()
+    summary["loro_r_mean"] = loro["r"].mean().loc[contrast_names].to_numpy()
+    summary["loro_r_min"] = loro["r"].min().loc[contrast_names].to_numpy()
+    for threshold in thresholds:
+        column = f"dice_z{threshold}"
+        summary[f"split_half_{column}"] = half.loc[contrast_names, column].to_numpy()
+        summary[f"loro_{column}_mean"] = loro[column].mean().loc[contrast_names].to_numpy()
+    summary = summary.sort_values("split_half_r", ascending=False, na_position='last').reset_index(drop=True)
+    return split_table, summary
+
+
+def run_reliability(subject_id, session, task, run_ids, path2root, glm_params, contrast_file,
+                    contrast_names, thresholds=(3.1,), confound_strategy="motion6", n_jobs=1,
+                    memory_budget=None):
+    """
+    Fits (or reuses) the runs of one subject as per-run models in parallel, then computes the
+    split-half and leave-one-run-out reliability of every contrast. Results are saved to
+    output/reliability/<subject/session/task>:
+      - reliability_splits.tsv: correlation and Dice of every contrast and split
+      - reliability_summary.tsv: one row per contrast, most reliable first
+      - voxelwise_icc.nii.gz: ICC(3,1) of the per-run z-maps over the contrasts
+      - voxelwise_split-half_conjunction_z.nii.gz: 4D map with one volume per contrast
+        (the 'volume' column of the summary)
+
+    Returns:
+        pd.DataFrame: The summary table.
+    """
+    from contrasts import ContrastManager
+    from run_stats import fit_run_stats_glm
+    from utils import get_subject_runs, load_BIDS_data
+
+    fn_base = f"sub-{subject_id:02d}_ses-{session}_task-{task}"
+    exp_args = {'subject': subject_id, 'session': session, 'task': task, 'num_runs': len(run_ids)}
+    dict_BIDS_data = load_BIDS_data(exp_args, run_ids, path2root, load_confounds=True,
+                                    confound_strategy=confound_strategy)
+
+    t_start = time.perf_counter()
+    glm = fit_run_stats_glm(fn_base, dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                            dict_BIDS_data['dfs_confounds'], glm_params,
+                            os.path.join(path2root, "output", "glm_runs"),
+                            memory_budget=memory_budget, n_jobs=n_jobs,
+                            mask_runs=get_subject_runs(exp_args, path2root))
+    print(f"Per-run models of {len(run_ids)} runs ready in {time.perf_counter() - t_start:.1f} s.")
+
+    manager = ContrastManager(contrast_file)
+    contrast_matrix = manager.get_matrix(contrast_names, glm.design_matrices_[0].columns)
+    t_start = time.perf_counter()
+    results = compute_reliability(glm, contrast_matrix, run_ids, thresholds)
+    print(f"Reliability of {len(contrast_names)} contrasts over {len(results['splits'])} splits "
+          f"in {time.perf_counter() - t_start:.1f} s.")
+
+    folder = os.path.join(path2root, "output", "reliability", fn_base)
+    os.makedirs(folder, exist_ok=True)
+    split_table, summary = reliability_tables(results, contrast_names, thresholds)
+    split_table.to_csv(os.path.join(folder, "reliability_splits.tsv"), sep="\t", index=False, float_format="%.4f")
+    summary.to_csv(os.path.join(folder, "reliability_summary.tsv"), sep="\t", index=False, float_format="%.4f")
+    glm.masker_.inverse_transform(results['voxelwise_icc']).to_filename(
+        os.path.join(folder, "voxelwise_icc.nii.gz"))
+    glm.masker_.inverse_transform(results['split_half_conjunction']).to_filename(
+        os.path.join(folder, f"voxelwise_{SPLIT_HALF}_conjunction_z.nii.gz"))
+
+    print(f"Reliability saved to {folder}. Most reliable contrasts (split-half r):")
+    for _, row in summary.head(10).iterrows():
+        print(f"  {row['split_half_r']:6.3f}  {row['contrast']}")
+    return summary
+
+
+def main(argv=None):
+    from contrasts import ContrastManager
+    from parser import parse_reliability_arguments, get_glm_params
+
+    args = parse_reliability_arguments(argv)
+    contrast_names = ContrastManager(args.contrast_file).resolve(args.contrast_name)
+
+    run_ids = [run_id for run_id in range(1, args.num_runs + 1) if run_id not in args.exclude_runs]
+    memory_budget = None if args.memory_budget is None else int(args.memory_budget * 1024**3)
+    for subject_id in args.subjects:
+        run_reliability(subject_id, args.session, args.task, run_ids, os.path.abspath(args.path2root),
+                        get_glm_params(args), os.path.abspath(args.contrast_file), contrast_names,
+                        thresholds=args.threshold_z, confound_strategy=args.confounds,
+                        n_jobs=args.n_jobs, memory_budget=memory_budget)
+    return 0
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    raise SystemExit(main())
@@ -0,0 +1,280 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
+from utils import as_list
+
+
+# Figure kinds produced by analyses.plot_contrast
+FIGURE_KINDS = ["contrast_matrix", "stat_map", "glass_brain", "surf_png", "surf_html"]
+
+
+_headless = False
+
+
+def use_headless_backend():
+    """
+    Switches matplotlib to the Agg backend, once per process, before pyplot is first used.
+    Every plotting entry point calls it (and pools use it as worker initializer), so
+    figures render the same on headless nodes and matplotlib is only imported to plot.
+    """
+    global _headless
+    if _headless:
+        return
+    import matplotlib
+    matplotlib.use("Agg")
+    _headless = True
+
+
+def _render_job(kind, input_file, output_file, plot_kwargs):
+    """Renders one figure. Runs in a worker process (or inline when n_jobs <= 1)."""
+    use_headless_backend()
+    import matplotlib.pyplot as plt
+
+    plot_kwargs = dict(plot_kwargs)
+    # Write to a temporary file first, so an interrupted render never looks up to date
+    root, ext = os.path.splitext(output_file)
+    tmp_file = f"{root}.tmp{ext}"
+
+    if kind == "contrast_matrix":
+        from nilearn.plotting import plot_contrast_matrix
+        plot_contrast_matrix(plot_kwargs.pop("contrast_vector"), plot_kwargs.pop("design_matrix"),
+                             output_file=tmp_file, **plot_kwargs)
+    elif kind == "stat_map":
+        from nilearn.plotting import plot_stat_map
+        figsize = plot_kwargs.pop("figsize", (10, 4))
+        plot_stat_map(input_file, figure=plt.figure(figsize=figsize), output_file=tmp_file, **plot_kwargs)
+    elif kind == "glass_brain":
+        from nilearn.plotting import plot_glass_brain
+        figsize = plot_kwargs.pop("figsize", None)
+        if figsize is not None:
+            plot_kwargs["figure"] = plt.figure(figsize=figsize)
+        plot_glass_brain(input_file, output_file=tmp_file, **plot_kwargs)
+    elif kind == "surf_png":
+        _plot_img_on_surf(input_file, output_file=tmp_file, **plot_kwargs)
+    elif kind == "surf_html":
+        _view_img_on_surf(input_file, **plot_kwargs).save_as_html(tmp_file)
+    else:
+        raise ValueError(f"Unknown figure kind '{kind}'. Choose from {FIGURE_KINDS}.")
+
+    plt.close('all')
+    os.replace(tmp_file, output_file)
+    return output_file
+
+
+def _render_job_measured(kind, input_file, output_file, plot_kwargs):
+    """Renders one figure in a worker process and returns its profiling.measure record."""
+    with profiling.measure(f"figure:{kind}", output_file=output_file) as measurement:
+        _render_job(kind, input_file, output_file, plot_kwargs)
+    return measurement.record
+
+
+def _plot_img_on_surf(stat_map, output_file, surf_mesh="fsaverage5", projection_dir=None,
+                      hemispheres=None, views=None, inflate=False, vmin=None, vmax=None,
+                      symmetric_cbar="auto", cbar_tick_format="%i", **kwargs):
+    """
+    Same figure as nilearn's plot_img_on_surf, but the volume is projected with a cached
+    operator (surface_projection) instead of being resampled onto the meshes every time.
+    Falls back to plot_img_on_surf itself if nilearn's plotting internals moved.
+    """
+    from nilearn.image import get_data, load_img
+    try:
+        from nilearn.plotting._utils import get_colorbar_and_data_ranges
+        from nilearn.plotting.surface._utils import (DEFAULT_ENGINE, check_hemispheres,
+                                                     check_views, get_surface_backend)
+    except ImportError:
+        from nilearn.plotting import plot_img_on_surf
+        plot_img_on_surf(stat_map, surf_mesh=surf_mesh, hemispheres=hemispheres, views=views,
+                         inflate=inflate, vmin=vmin, vmax=vmax, symmetric_cbar=symmetric_cbar,
+                         cbar_tick_format=cbar_tick_format, output_file=output_file, **kwargs)
+        return
+    from surface_projection import load_fsaverage, project_to_fsaverage
+
+    if hemispheres in (None, "both", ["both"]):
+        hemispheres = ["left", "right"]
+    views = ["lateral", "medial"] if views is None else views
+    stat_map = load_img(stat_map)
+    fsaverage = load_fsaverage(surf_mesh)
+    mesh_prefix = "infl" if inflate else "pial"
+    surf = {hemi: fsaverage[f"{mesh_prefix}_{hemi}"] for hemi in ("left", "right")}
+    texture = project_to_fsaverage(stat_map, surf_mesh, cache_dir=projection_dir)
+
+    _, _, vmin, vmax = get_colorbar_and_data_ranges(get_data(stat_map), vmin=vmin, vmax=vmax,
+                                                    symmetric_cbar=symmetric_cbar)
+    get_surface_backend(DEFAULT_ENGINE)._plot_img_on_surf(
+        surf, surf_mesh=fsaverage, texture=texture, hemis=check_hemispheres(as_list(hemispheres)),
+        modes=check_views(views), inflate=inflate, output_file=output_file, vmin=vmin, vmax=vmax,
+        symmetric_cbar=symmetric_cbar, cbar_tick_format=cbar_tick_format, **kwargs)
+
+
+def _view_img_on_surf(stat_map, surf_mesh="fsaverage5", projection_dir=None, threshold=None,
+                      cmap="RdBu_r", black_bg=False, vmax=None, vmin=None, symmetric_cmap=True,
+                      bg_on_data=False, colorbar=True, colorbar_height=0.5, colorbar_fontsize=25,
+                      title=None, title_fontsize=25, view="left"):
+    """
+    Same page as nilearn's view_img_on_surf (pial to white matter sampling), built from
+    textures projected with a cached operator (surface_projection). Falls back to
+    view_img_on_surf itself if nilearn's plotting internals moved.
+    """
+    import numpy as np
+    from nilearn.image import load_img
+    from nilearn.plotting.surface import html_surface
+    from surface_projection import load_fsaverage, project_to_fsaverage
+
+    internals = ("_fill_html_template", "_get_combined_curvature_map", "PolyMesh", "colorscale",
+                 "mesh_to_plotly", "combine_hemispheres_meshes", "get_surface_backend", "DEFAULT_ENGINE")
+    if not all(hasattr(html_surface, name) for name in internals) or not hasattr(
+            html_surface.get_surface_backend(html_surface.DEFAULT_ENGINE), "_get_vertexcolor"):
+        from nilearn.plotting import view_img_on_surf
+        return view_img_on_surf(stat_map, surf_mesh=surf_mesh, threshold=threshold, cmap=cmap,
+                                black_bg=black_bg, vmax=vmax, vmin=vmin, symmetric_cmap=symmetric_cmap,
+                                bg_on_data=bg_on_data, colorbar=colorbar, colorbar_height=colorbar_height,
+                                colorbar_fontsize=colorbar_fontsize, title=title,
+                                title_fontsize=title_fontsize, view=view)
+
+    fsaverage = load_fsaverage(surf_mesh)
+    textures = project_to_fsaverage(load_img(stat_map), surf_mesh, inner=True, cache_dir=projection_dir)
+    colors = html_surface.colorscale(cmap, np.concatenate([textures["left"], textures["right"]]),
+                                     threshold, symmetric_cmap=symmetric_cmap, vmax=vmax, vmin=vmin)
+    backend = html_surface.get_surface_backend(html_surface.DEFAULT_ENGINE)
+
+    info = {}
+    for hemi, texture in textures.items():
+        info[f"pial_{hemi}"] = html_surface.mesh_to_plotly(fsaverage[f"pial_{hemi}"])
+        info[f"inflated_{hemi}"] = html_surface.mesh_to_plotly(fsaverage[f"infl_{hemi}"])
+        info[f"vertexcolor_{hemi}"] = backend._get_vertexcolor(
+            texture, colors["cmap"], colors["norm"], absolute_threshold=colors["abs_threshold"],
+            bg_map=np.sign(fsaverage[f"curv_{hemi}"]), bg_on_data=bg_on_data)
+    for mesh_prefix, info_prefix in [("infl", "inflated"), ("pial", "pial")]:
+        both = html_surface.PolyMesh(left=fsaverage[f"{mesh_prefix}_left"],
+                                     right=fsaverage[f"{mesh_prefix}_right"])
+        info[f"{info_prefix}_both"] = html_surface.mesh_to_plotly(html_surface.combine_hemispheres_meshes(both))
+    info["vertexcolor_both"] = backend._get_vertexcolor(
+        np.concatenate([textures["left"], textures["right"]]), colors["cmap"], colors["norm"],
+        absolute_threshold=colors["abs_threshold"],
+        bg_map=html_surface._get_combined_curvature_map(fsaverage["curv_left"], fsaverage["curv_right"]),
+        bg_on_data=bg_on_data)
+    info.update({"cmin": float(colors["vmin"]), "cmax": float(colors["vmax"]), "black_bg": black_bg,
+                 "full_brain_mesh": True, "colorscale": colors["colors"], "colorbar": colorbar,
+                 "cbar_height": colorbar_height, "cbar_fontsize": colorbar_fontsize, "title": title,
+                 "title_fontsize": title_fontsize, "view": view})
+    return html_surface._fill_html_template(info)
+
+
+def is_up_to_date(output_file, input_file):
+    """True if output_file exists and is newer than input_file (or input_file is None)."""
+    if not os.path.exists(output_file):
+        return False
+    if input_file is None:
+        return True
+    return os.path.getmtime(output_file) >= os.path.getmtime(input_file)
+
+
+def save_img_if_changed(img, filepath):
+    """
+    Saves a NIfTI image unless an identical one already exists at filepath.
+    Keeping the old file keeps its mtime, so figures rendered from it stay up to date.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    data = np.asanyarray(img.dataobj)
+    if os.path.exists(filepath):
+        existing = nib.load(filepath)
+        if existing.shape == img.shape and np.allclose(existing.affine, img.affine) \
+                and np.array_equal(np.asanyarray(existing.dataobj), data):
+            return filepath
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    if filepath.endswith(".nii.gz"):
+        root, ext = filepath[:-len(".nii.gz")], ".nii.gz"
+    else:
+        root, ext = os.path.splitext(filepath)
+    tmp_file = f"{root}.tmp{ext}"
+    nib.Nifti1Image(data, img.affine, img.header).to_filename(tmp_file)
+    os.replace(tmp_file, filepath)
+    return filepath
+
+
+class FigureRenderer:
+    """
+    Runs figure jobs on a process pool with the Agg backend, so statistics do not wait on matplotlib.
+
+    Only the selected figure kinds are rendered, and figures already newer than the
+    stat map they are drawn from are skipped. Use as a context manager, or call close().
+    """
+    def __init__(self, n_jobs=1, figure_kinds=None, skip_up_to_date=True):
+        """
+        Parameters:
+        n_jobs (int, optional): Number of worker processes; 1 renders inline.
+        figure_kinds (list, optional): Subset of FIGURE_KINDS to render. Defaults to all.
+        skip_up_to_date (bool, optional): Skip figures newer than their input stat map.
+        """
+        self.figure_kinds = list(FIGURE_KINDS if figure_kinds is None else figure_kinds)
+        unknown = [kind for kind in self.figure_kinds if kind not in FIGURE_KINDS]
+        if unknown:
+            raise ValueError(f"Unknown figure kinds {unknown}. Choose from {FIGURE_KINDS}.")
+        self.skip_up_to_date = skip_up_to_date
+        self.n_jobs = n_jobs
+        self._pool = None
+        if n_jobs > 1:
+            self._pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=use_headless_backend)
+        elif self.figure_kinds:
+            use_headless_backend()
+        self._futures = []
+        self.n_skipped = 0
+        self.n_rendered = 0
+        self.failures = []
+
+    def wants(self, kind):
+        return kind in self.figure_kinds
+
+    def submit(self, kind, input_file, output_file, **plot_kwargs):
+        """
+        Queues one figure. input_file is the stat map it is drawn from (None if there is none).
+        """
+        if not self.wants(kind):
+            return
+        if self.skip_up_to_date and is_up_to_date(output_file, input_file):
+            self.n_skipped += 1
+            return
+        if self._pool is None:
+            try:
+                with profiling.stage(f"figure:{kind}", output_file=output_file):
+                    _render_job(kind, input_file, output_file, plot_kwargs)
+                self.n_rendered += 1
+                print(f"  {kind} saved to {output_file}")
+            except Exception as e:
+                print(f"ERROR: Rendering {output_file} failed: {e}")
+                self.failures.append((output_file, e))
+            return
+        # Workers measure their own figures when the run is profiled
+        job = _render_job_measured if profiling.is_active() else _render_job
+        future = self._pool.submit(job, kind, input_file, output_file, plot_kwargs)
+        self._futures.append((output_file, future))
+
+    def wait(self):
+        """Waits for all queued figures and reports what was rendered."""
+        for output_file, future in self._futures:
+            try:
+                result = future.result()
+                if isinstance(result, dict):
+                    profiling.add_record(result)
+                self.n_rendered += 1
+            except Exception as e:
+                print(f"ERROR: Rendering {output_file} failed: {e}")
+                self.failures.append((output_file, e))
+        self._futures = []
+        print(f"  Figures: {self.n_rendered} rendered, {self.n_skipped} up to date, "
+              f"{len(self.failures)} failed.")
+
+    def close(self):
+        self.wait()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -54,15 +54,13 @@ contrasts=(
     "high > low | real | visual | write"
 )
 
-# Loop through the array and run the analysis for each contrast
-for contrast_name in "${contrasts[@]}"; do
-    echo "Running analysis for contrast: $contrast_name"
-    
-    # Execute the Python script with the --contrast-name argument
-    python3 main_fMRI_analysis.py --contrast-name "$contrast_name"
-    
-    # Add a separator for clarity in the output
-    echo "----------------------------------------"
-done
+# Write the contrast list to a file and run every contrast in a single process,
+# so the data, the GLM and the contrast file are only loaded once
+contrast_list_file=$(mktemp)
+printf '%s\n' "${contrasts[@]}" > "$contrast_list_file"
+
+echo "Running analysis for ${#contrasts[@]} contrasts"
+python3 main_fMRI_analysis.py --contrasts-from "$contrast_list_file"
+rm -f "$contrast_list_file"
 
 echo "✅ All analyses complete."
@@ -0,0 +1,322 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bold_cache import _fn_root
+from chunked_glm import (_DesignSolver, _model_params, _run_shape, compute_mask,
+                         fit_run_blocks, make_design_matrix)
+from glm_cache import GLMCache, compute_glm_key, file_identity
+from glm_store import StoredGLM
+from profiling import profiled
+
+
+RUN_STATS_VERSION = 2
+RUN_META_FILENAME = "run.json"
+
+# Working memory of a run fit when no memory budget is given
+DEFAULT_MEMORY_BUDGET = 1024**3
+
+
+def fit_run_stats(fn_func, events, confounds, params, mask, path2entry, memory_budget, work_dir=None):
+    """
+    Fits one run block by block (see chunked_glm) and saves its sufficient statistics.
+
+    The entry holds, per AR(1) coefficient (label) of the run, the Gram matrix X'X of the
+    whitened design and the normalized covariance X^+ X^+' of its pseudo-inverse (as
+    _DesignSolver computes it, so rank-deficient designs are solved like nilearn does), and
+    per voxel the whitened X'y, the residual sum of squares and the label. Betas, their covariance and the residual variance follow from these, so fits of
+    any set of runs are assembled from their entries without reading the BOLD data.
+
+    Args:
+        fn_func (str): Path to the 4D run.
+        events (pd.DataFrame): Events of the run.
+        confounds (pd.DataFrame): Confounds of the run (or None).
+        params (dict): FirstLevelModel parameters (see chunked_glm._model_params).
+        mask (np.ndarray): Boolean brain mask on the grid of the run.
+        path2entry (str): Directory to write the entry to. Replaced if it exists.
+        memory_budget (int): Bytes the block working arrays may use.
+        work_dir (str, optional): Folder for the staging array. Defaults to next to path2entry.
+    """
+    shape, n_volumes, affine = _run_shape(fn_func)
+    if shape != mask.shape:
+        raise ValueError(f"Run {fn_func} has shape {shape}, the mask {mask.shape}.")
+    design_matrix = make_design_matrix(params, n_volumes, events, confounds)
+    solver = _DesignSolver(design_matrix.to_numpy(dtype=np.float64))
+    n_voxels, n_regressors = int(mask.sum()), solver.n_regressors
+
+    tmp_path = f"{path2entry}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    staging_dir = tempfile.mkdtemp(prefix="glm_staging_",
+                                   dir=work_dir or os.path.dirname(os.path.abspath(path2entry)))
+    try:
+        outputs = {
+            'xty': ((n_regressors, n_voxels), np.float64),
+            'rss': ((n_voxels,), np.float64),
+            'label_codes': ((n_voxels,), np.int32),
+        }
+        for name, (out_shape, dtype) in outputs.items():
+            np.lib.format.open_memmap(os.path.join(tmp_path, f"{name}.npy"), mode='w+',
+                                      dtype=dtype, shape=out_shape).flush()
+
+        grams, covs = {}, {}
+        blocks = fit_run_blocks(fn_func, mask, affine, solver, params, memory_budget,
+                                os.path.join(staging_dir, "staged.npy"))
+        for start, stop, theta, dispersion, rho in blocks:
+            xty = np.empty_like(theta)
+            codes = np.empty(rho.size, dtype=np.int32)
+            for value in np.unique(rho):
+                voxels = rho == value
+                if float(value) not in grams:
+                    whitened_design, _, cov = solver.whitened(float(value))
+                    grams[float(value)] = whitened_design.T @ whitened_design
+                    covs[float(value)] = cov
+                # X'y of the whitened data, recovered from the betas: X'X beta = X'y
+                xty[:, voxels] = grams[float(value)] @ theta[:, voxels]
+                codes[voxels] = list(grams).index(float(value))
+            rss = dispersion * (n_volumes - n_regressors)
+
+            for name, values in (('xty', xty), ('rss', rss), ('label_codes', codes)):
+                out = np.load(os.path.join(tmp_path, f"{name}.npy"), mmap_mode='r+')
+                out[..., start:stop] = values
+                out.flush()
+                del out
+
+        np.save(os.path.join(tmp_path, "gram.npy"), np.stack(list(grams.values())))
+        np.save(os.path.join(tmp_path, "cov.npy"), np.stack(list(covs.values())))
+        np.savez(os.path.join(tmp_path, "design.npz"),
+                 values=design_matrix.to_numpy(dtype=np.float32),
+                 frame_times=design_matrix.index.to_numpy(dtype=float))
+        meta = {
+            'format_version': RUN_STATS_VERSION,
+            'source': os.path.abspath(fn_func),
+            'columns': [str(col) for col in design_matrix.columns],
+            'n_volumes': n_volumes,
+            'n_regressors': n_regressors,
+            'n_voxels': n_voxels,
+            'df_residuals': float(solver.df_residuals),
+            'ar1': list(grams),
+        }
+        with open(os.path.join(tmp_path, RUN_META_FILENAME), 'w') as f:
+            json.dump(meta, f, indent=2)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    shutil.rmtree(path2entry, ignore_errors=True)
+    os.replace(tmp_path, path2entry)
+
+
+class RunStatsCache(GLMCache):
+    """
+    Per-run GLM fits stored as sufficient statistics (see fit_run_stats), plus the brain
+    mask they share per subject/session/task.
+
+    The mask is computed once from all runs of the subject (see fit_run_stats_glm) and
+    reused by every fit whose runs are among them, so any subset of runs (fewer runs,
+    excluded runs, leave-one-out, and back) is assembled from cached runs on the same
+    voxels. Only a fit with a run the mask was not computed from (e.g. a run added to the
+    dataset) recomputes the mask and drops the run entries of the old mask.
+    """
+    entry_kind = "run fit"
+
+    @staticmethod
+    def mask_key(fn_base):
+        return f"mask|{fn_base}"
+
+    def get_mask(self, fn_base, fns_func, mask_runs=None, mask_img=None):
+        """
+        Args:
+            fn_base (str): Subject/session/task of the runs.
+            fns_func (list): Runs of the fit.
+            mask_runs (list, optional): Runs to compute a new mask from. Runs of fns_func
+                missing from it are added. Defaults to fns_func.
+            mask_img (str, optional): Mask given by the user instead of a computed one.
+
+        Returns:
+            tuple: (path of the mask, hash of the mask)
+        """
+        key = self.mask_key(fn_base)
+        identities = [file_identity(fn_func) for fn_func in fns_func]
+        with self._locked():
+            self.index = self._read_index()
+            entry = self.index.get(key)
+        if entry is not None and set(identities) <= set(entry['description']['sources']) \
+                and entry['description']['mask_img'] == str(mask_img):
+            path2mask = self.lookup(key)
+            if path2mask is not None:
+                return path2mask, entry['description']['mask_hash']
+
+        if entry is not None:
+            old_hash = entry['description']['mask_hash']
+            for run_key in [k for k, e in self.index.items() if e['description'].get('mask') == old_hash]:
+                self.remove(run_key)
+        sources = {file_identity(fn_func): fn_func for fn_func in mask_runs or []}
+        for identity, fn_func in zip(identities, fns_func):
+            sources.setdefault(identity, fn_func)
+        mask_identities, mask_runs = list(sources), list(sources.values())
+        print(f"  Computing the brain mask of {len(mask_runs)} run(s) from streamed mean images...")
+        mask = compute_mask(mask_runs, mask_img)
+        mask_hash = hashlib.sha256(np.packbits(np.asanyarray(mask.dataobj) != 0).tobytes()).hexdigest()
+        filename = f"mask_{fn_base}.nii.gz"
+        tmp_path = self.entry_path(f"{filename}.tmp.nii.gz")
+        mask.to_filename(tmp_path)
+        os.replace(tmp_path, self.entry_path(filename))
+        self.add(key, filename, description={'sources': mask_identities, 'mask_img': str(mask_img),
+                                             'mask_hash': mask_hash})
+        return self.entry_path(filename), mask_hash
+
+
+class RunStatsGLM(StoredGLM):
+    """
+    Fixed-effects GLM of a set of runs assembled from their sufficient statistics.
+
+    Answers compute_contrast and compute_contrast_arrays like StoredGLM, from its own
+    run_contrasts: per run, the contrast effect is C X^+ X^+' X'y and its variance
+    C X^+ X^+' C' rss / (n - p) for the AR(1) label of each voxel, and the runs are
+    averaged by multi_contrast.fixed_effects_contrasts. subset() selects runs without
+    reading anything from disk.
+    """
+    def __init__(self, mask_path, run_paths, mmap_mode='r'):
+        """
+        Parameters:
+        mask_path (str): Brain mask shared by the runs.
+        run_paths (list): Entries written by fit_run_stats, one per run.
+        mmap_mode (str, optional): Memory-map mode passed to np.load (None loads into memory).
+        """
+        self.mask_path = mask_path
+        self.run_paths = list(run_paths)
+        self.mmap_mode = mmap_mode
+        self.n_runs = len(self.run_paths)
+        self.runs_meta = []
+        for run_path in self.run_paths:
+            with open(os.path.join(run_path, RUN_META_FILENAME), 'r') as f:
+                self.runs_meta.append(json.load(f))
+        if any(meta['format_version'] != RUN_STATS_VERSION for meta in self.runs_meta):
+            raise ValueError(f"Unsupported run statistics version in {self.run_paths}")
+        self._masker = None
+        self._design_matrices = None
+
+    def _load(self, run_idx, name):
+        return np.load(os.path.join(self.run_paths[run_idx], f"{name}.npy"), mmap_mode=self.mmap_mode)
+
+    def subset(self, run_indices):
+        """The fixed-effects model of the runs at run_indices."""
+        subset = RunStatsGLM(self.mask_path, [], self.mmap_mode)
+        subset.run_paths = [self.run_paths[i] for i in run_indices]
+        subset.runs_meta = [self.runs_meta[i] for i in run_indices]
+        subset.n_runs = len(subset.run_paths)
+        subset._masker = self._masker
+        return subset
+
+    @property
+    def design_matrices_(self):
+        if self._design_matrices is None:
+            import pandas as pd
+
+            self._design_matrices = []
+            for run_path, run_meta in zip(self.run_paths, self.runs_meta):
+                with np.load(os.path.join(run_path, "design.npz")) as design:
+                    self._design_matrices.append(pd.DataFrame(design['values'],
+                                                              index=design['frame_times'],
+                                                              columns=run_meta['columns']))
+        return self._design_matrices
+
+    def run_contrasts(self, run_idx, contrast_matrix):
+        """
+        Contrast effects and variances of one run.
+
+        Returns:
+            tuple: (effect, variance), arrays of shape (C, n_voxels)
+        """
+        meta = self.runs_meta[run_idx]
+        covs = self._load(run_idx, "cov")
+        label_codes = self._load(run_idx, "label_codes")
+        xty = self._load(run_idx, "xty")
+
+        # C X^+ X^+' per label, then applied to the X'y of the voxels with that label
+        con_cov = np.einsum('ij,ljk->lik', contrast_matrix, covs)
+        effect = np.empty((contrast_matrix.shape[0], meta['n_voxels']))
+        for code in range(len(covs)):
+            voxels = label_codes == code
+            effect[:, voxels] = con_cov[code] @ xty[:, voxels]
+        con_cov_con = np.einsum('lik,ik->il', con_cov, contrast_matrix)
+        dispersion = self._load(run_idx, "rss") / (meta['n_volumes'] - meta['n_regressors'])
+        return effect, con_cov_con[:, label_codes] * dispersion
+
+
+@profiled("glm_fit_runs")
+def fit_run_stats_glm(fn_base, fns_func, dfs_events, dfs_confounds, glm_params, cache_dir,
+                      memory_budget=None, cache_max_bytes=None, n_jobs=1, mask_runs=None):
+    """
+    Fixed-effects GLM of the given runs from per-run sufficient statistics, fitting only
+    the runs that are not cached yet. Changing which runs go into the model (fewer runs,
+    an excluded run, leave-one-run-out) therefore reuses every run fitted before.
+    Runs are independent fits, so with n_jobs > 1 they are fitted in worker processes,
+    sharing the memory budget. The runs share the brain mask of mask_runs, normally every
+    run of the subject (utils.get_subject_runs), so adding runs back to a model reuses
+    them too.
+
+    Args:
+        fn_base (str): Subject/session/task the runs belong to, e.g. sub-01_ses-1_task-swp.
+        fns_func (list): Paths to the 4D runs.
+        dfs_events (list): Events DataFrame of each run.
+        dfs_confounds (list): Confounds DataFrame of each run (or None).
+        glm_params (dict): FirstLevelModel keyword arguments.
+        cache_dir (str): Folder of the run statistics cache.
+        memory_budget (int, optional): Bytes a run fit may use. Defaults to DEFAULT_MEMORY_BUDGET.
+        cache_max_bytes (int, optional): Evict least recently used entries above this size.
+        n_jobs (int, optional): Number of runs fitted in parallel. Defaults to 1.
+        mask_runs (list, optional): Runs the brain mask is computed from. Defaults to fns_func.
+
+    Returns:
+        RunStatsGLM: The model of the runs, in the order given.
+    """
+    import nibabel as nib
+
+    params = _model_params(glm_params)
+    if dfs_confounds is None:
+        dfs_confounds = [None] * len(fns_func)
+    run_cache = RunStatsCache(cache_dir, max_bytes=cache_max_bytes)
+    mask_path, mask_hash = run_cache.get_mask(fn_base, fns_func, mask_runs, params['mask_img'])
+    mask = np.asanyarray(nib.load(mask_path).dataobj) != 0
+
+    run_paths, run_keys, todo = [], [], []
+    for fn_func, events, confounds in zip(fns_func, dfs_events, dfs_confounds):
+        run_key = compute_glm_key([fn_func], [events], [confounds], glm_params)
+        run_key = hashlib.sha256(f"{run_key}|{mask_hash}|{RUN_STATS_VERSION}".encode()).hexdigest()
+        path2entry = run_cache.lookup(run_key)
+        if path2entry is None:
+            filename = f"run_{_fn_root(fn_func)}_{run_key[:16]}"
+            path2entry = run_cache.entry_path(filename)
+            todo.append((run_key, filename, (fn_func, events, confounds, params, mask, path2entry)))
+        run_paths.append(path2entry)
+        run_keys.append(run_key)
+
+    # Workers only write their entries; they are registered in the index here, one at a time
+    n_workers = max(1, min(n_jobs, len(todo)))
+    run_budget = (memory_budget or DEFAULT_MEMORY_BUDGET) // n_workers
+    if n_workers == 1:
+        for _, _, args in todo:
+            fit_run_stats(*args, run_budget)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(fit_run_stats, *args, run_budget) for _, _, args in todo]
+            for future in futures:
+                future.result()
+    # The mask and every run of this model stay while new runs make room in the cache
+    keep = {run_cache.mask_key(fn_base), *run_keys}
+    for run_key, filename, (fn_func, *_) in todo:
+        run_cache.add(run_key, filename, description={'fn_base': fn_base,
+                                                      'run': os.path.basename(fn_func),
+                                                      'mask': mask_hash},
+                      keep=keep)
+    print(f"  {len(todo)} run(s) fitted, {len(run_paths) - len(todo)} reused from {cache_dir}")
+    return RunStatsGLM(mask_path, run_paths)
@@ -27,36 +27,24 @@ tasks_info=(
 # For example: "task_name,num_runs,contrast_name"
 
 
+# Number of worker processes for the batch pipeline
+n_jobs=4
+
+
 # ==============================================================================
-# Loop over each parameter
+# Run the whole sweep in one batch: each subject/task is loaded and fitted once,
+# every alpha reuses the same z-maps, and independent nodes run in parallel.
+# Completed nodes are recorded, so re-running after a crash resumes the sweep.
 # ==============================================================================
-# Loop over each subject
-for subject in "${subjects[@]}"; do
-
-    # Loop over each task and its parameters
-    for task_info in "${tasks_info[@]}"; do
-        # Use Zsh's built-in string splitting to parse the task_info string
-        # This splits the string at the comma and puts the parts into an array
-        IFS=',' read -r task_name num_runs contrast_name <<< "$task_info"
-
-        # Loop over each alpha value
-        for alpha_val in "${alpha_values[@]}"; do
-            echo "----------------------------------------------------"
-            echo "Running analysis for Subject: $subject, Task: $task_name, Alpha: $alpha_val"
-            echo "----------------------------------------------------"
-
-
-            # The command to run the python script with all the variables
-            python3 main_fMRI_analysis.py \
-                --subject "$subject" \
-                --task "$task_name" \
-                --num-runs "$num_runs" \
-                --contrast-name "$contrast_name" \
-                --alpha "$alpha_val"
-
-            echo "" # Add an empty line for better readability
-        done
-    done
+task_spec_args=()
+for task_info in "${tasks_info[@]}"; do
+    task_spec_args+=(--task-spec "$task_info")
 done
 
+python3 batch_pipeline.py \
+    --subjects "${subjects[@]}" \
+    "${task_spec_args[@]}" \
+    --alphas "${alpha_values[@]}" \
+    --n-jobs "$n_jobs"
+
 echo "All analysis runs completed."
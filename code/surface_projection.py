@@ -0,0 +1,220 @@
+import hashlib
+import os
+from functools import lru_cache
+from itertools import product
+
+import numpy as np
+from scipy import sparse
+
+
+HEMISPHERES = ["left", "right"]
+
+# Projection operators already loaded in this process, keyed by projection_key
+_OPERATORS = {}
+
+
+@lru_cache(maxsize=None)
+def load_fsaverage(mesh_name="fsaverage5"):
+    """
+    Loads an fsaverage mesh set into memory once per process.
+
+    Args:
+        mesh_name (str): Any fsaverage resolution nilearn knows, e.g. 'fsaverage5' or 'fsaverage'.
+
+    Returns:
+        dict: Same keys as nilearn's fsaverage dict (pial_left, infl_left, sulc_left, ...),
+              with meshes and maps loaded instead of file names.
+    """
+    from nilearn.surface import load_surf_data, load_surf_mesh
+
+    try:
+        from nilearn.surface.surface import check_mesh_is_fsaverage
+        fsaverage = check_mesh_is_fsaverage(mesh_name)
+    except ImportError:
+        from nilearn.datasets import fetch_surf_fsaverage
+        fsaverage = fetch_surf_fsaverage(mesh_name)
+    loaded = {}
+    for key, value in fsaverage.items():
+        if key == "description":
+            loaded[key] = value
+        elif key.split("_")[0] in ("pial", "white", "infl", "sphere", "flat"):
+            loaded[key] = load_surf_mesh(value)
+        else:
+            loaded[key] = load_surf_data(value)
+    return loaded
+
+
+def _sampling_internals():
+    """
+    nilearn's private vol_to_surf sampling helpers, or None if this nilearn version does
+    not have them (requirements.txt pins the tested range; outside it the public
+    vol_to_surf is used instead of cached operators).
+    """
+    try:
+        from nilearn.surface.surface import _masked_indices, _sample_locations
+    except ImportError:
+        return None
+    return _sample_locations, _masked_indices
+
+
+def projection_key(affine, shape, mesh, inner_mesh=None, radius=3.0, n_points=None):
+    """Content hash of everything a projection operator depends on."""
+    import nilearn
+
+    hasher = hashlib.sha256()
+    hasher.update(f"nilearn={nilearn.__version__}|radius={radius}|n_points={n_points}".encode())
+    hasher.update(np.round(np.asarray(affine, dtype=float), 6).tobytes())
+    hasher.update(np.asarray(shape[:3], dtype=np.int64).tobytes())
+    for surface in (mesh, inner_mesh):
+        if surface is None:
+            hasher.update(b"none")
+            continue
+        hasher.update(np.ascontiguousarray(surface.coordinates, dtype=np.float64).tobytes())
+        hasher.update(np.ascontiguousarray(surface.faces, dtype=np.int64).tobytes())
+    return hasher.hexdigest()
+
+
+def build_projection_operator(affine, shape, mesh, inner_mesh=None, radius=3.0, n_points=None):
+    """
+    Builds the sparse matrix that maps a volume on a grid to values on a mesh.
+
+    Reproduces nilearn's vol_to_surf with linear interpolation: samples along the vertex
+    normal ('line'), or between mesh and inner_mesh ('depth') if an inner mesh is given,
+    trilinear weights per sample, and the mean over the samples that fall inside the grid.
+
+    Args:
+        affine (np.ndarray): 4 x 4 affine of the volume grid.
+        shape (tuple): Shape of the volume grid.
+        mesh: Loaded surface mesh (e.g. load_fsaverage()['pial_left']).
+        inner_mesh (optional): Loaded inner mesh (e.g. the white matter surface).
+        radius (float, optional): Half width of the sampling segment in mm. Defaults to 3.0.
+        n_points (int, optional): Samples per vertex. Defaults to nilearn's default.
+
+    Returns:
+        scipy.sparse.csr_matrix: Operator of shape (n_vertices, prod(shape)), applied to
+                                 the C-ordered volume data. Rows without any sample are empty.
+    """
+    internals = _sampling_internals()
+    if internals is None:
+        raise ImportError("This nilearn version has no vol_to_surf sampling helpers to build operators from.")
+    _sample_locations, _masked_indices = internals
+
+    shape = tuple(int(size) for size in shape[:3])
+    kind = "line" if inner_mesh is None else "depth"
+    sample_locations = _sample_locations(mesh, affine, kind=kind, radius=radius,
+                                         n_points=n_points, inner_mesh=inner_mesh)
+    n_vertices, n_samples, _ = sample_locations.shape
+
+    locations = sample_locations.reshape(-1, 3)
+    kept = ~_masked_indices(locations, shape)
+    vertices = np.repeat(np.arange(n_vertices), n_samples)[kept]
+    locations = locations[kept]
+    n_kept = np.bincount(vertices, minlength=n_vertices)
+
+    # Same cell choice as scipy's RegularGridInterpolator: the last cell is used
+    # (and extrapolated) for samples between the last voxel centre and the grid edge
+    lower = np.clip(np.floor(locations).astype(np.int64), 0, np.maximum(np.asarray(shape) - 2, 0))
+    fraction = locations - lower
+    sample_weight = 1.0 / n_kept[vertices]
+
+    rows, cols, weights = [], [], []
+    for corner in product((0, 1), repeat=3):
+        corner = np.asarray(corner)
+        corner_index = np.minimum(lower + corner, np.asarray(shape) - 1)
+        rows.append(vertices)
+        cols.append(np.ravel_multi_index(corner_index.T, shape))
+        weights.append(np.prod(np.where(corner, fraction, 1 - fraction), axis=1) * sample_weight)
+
+    # Duplicate (vertex, voxel) pairs are summed when converting to CSR
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n_vertices, int(np.prod(shape))))
+
+
+def get_projection_operator(affine, shape, mesh, inner_mesh=None, cache_dir=None,
+                            label="surface", radius=3.0, n_points=None):
+    """
+    Returns the projection operator for a grid/mesh pair, building it only once.
+
+    Operators are kept in memory for the lifetime of the process and, if cache_dir is
+    given, saved there as sparse .npz files so later runs and worker processes reuse them.
+
+    Args:
+        affine, shape, mesh, inner_mesh, radius, n_points: See build_projection_operator.
+        cache_dir (str, optional): Directory to store operators in. None keeps them in memory only.
+        label (str, optional): Readable prefix for the file name, e.g. 'fsaverage5_pial_left'.
+
+    Returns:
+        scipy.sparse.csr_matrix: The projection operator.
+    """
+    key = projection_key(affine, shape, mesh, inner_mesh, radius, n_points)
+    if key in _OPERATORS:
+        return _OPERATORS[key]
+
+    operator = None
+    if cache_dir is not None:
+        path2operator = os.path.join(cache_dir, f"{label}_{key[:16]}.npz")
+        if os.path.exists(path2operator):
+            try:
+                operator = sparse.load_npz(path2operator).tocsr()
+            except (OSError, ValueError) as e:
+                print(f"WARNING: Could not read projection operator {path2operator} ({e}). Rebuilding it.")
+
+    if operator is None:
+        operator = build_projection_operator(affine, shape, mesh, inner_mesh, radius, n_points)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # save_npz appends .npz, so the temporary name has to end with it too
+            tmp_path = f"{path2operator[:-len('.npz')]}.tmp.npz"
+            sparse.save_npz(tmp_path, operator)
+            os.replace(tmp_path, path2operator)
+
+    _OPERATORS[key] = operator
+    return operator
+
+
+def apply_projection(operator, data):
+    """
+    Projects volume data with an operator: one sparse mat-vec (or mat-mat for 4D data).
+
+    Vertices without any sample inside the grid are NaN, as in vol_to_surf.
+    """
+    data = np.asarray(data, dtype=float)
+    n_voxels = operator.shape[1]
+    values = data.reshape(n_voxels, -1) if data.ndim > 3 else data.reshape(n_voxels)
+    texture = operator @ values
+    texture[np.diff(operator.indptr) == 0] = np.nan
+    return texture
+
+
+def project_to_fsaverage(img, mesh_name="fsaverage5", inner=False, cache_dir=None):
+    """
+    Projects a volume onto both hemispheres of an fsaverage mesh.
+
+    Args:
+        img (Nifti1Image or str): 3D (or 4D) volume.
+        mesh_name (str, optional): fsaverage resolution. Defaults to 'fsaverage5'.
+        inner (bool, optional): Sample between the pial and white matter surfaces
+            (like view_img_on_surf) instead of along the pial normals (like plot_img_on_surf).
+        cache_dir (str, optional): Where projection operators are stored.
+
+    Returns:
+        dict: hemisphere -> texture array.
+    """
+    from nilearn.image import load_img
+
+    img = load_img(img)
+    fsaverage = load_fsaverage(mesh_name)
+    data = np.asanyarray(img.dataobj)
+    textures = {}
+    for hemi in HEMISPHERES:
+        inner_mesh = fsaverage[f"white_{hemi}"] if inner else None
+        if _sampling_internals() is None:
+            from nilearn.surface import vol_to_surf
+            textures[hemi] = vol_to_surf(img, fsaverage[f"pial_{hemi}"], inner_mesh=inner_mesh,
+                                         radius=3.0, interpolation="linear")
+            continue
+        label = f"{mesh_name}_{'depth' if inner else 'pial'}_{hemi}"
+        operator = get_projection_operator(img.affine, img.shape, fsaverage[f"pial_{hemi}"],
+                                           inner_mesh=inner_mesh, cache_dir=cache_dir, label=label)
+        textures[hemi] = apply_projection(operator, data)
+    return textures
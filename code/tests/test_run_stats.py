@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("nilearn")
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    from benchmarks.synthetic import make_synthetic_dataset
+    from utils import load_BIDS_data
+
+    path2root = str(tmp_path_factory.mktemp("synthetic"))
+    description = make_synthetic_dataset(path2root, n_runs=2, resolution=8, n_volumes=60)
+    exp_args = {'subject': 1, 'session': description['session'], 'task': description['task']}
+    dict_BIDS_data = load_BIDS_data(exp_args, [1, 2], path2root, load_confounds=True)
+    return path2root, dict_BIDS_data
+
+
+def test_rank_deficient_design_matches_first_level_model(dataset):
+    from nilearn.glm.first_level import FirstLevelModel
+
+    from benchmarks.equivalence import Z_TOLERANCE_MAX, Z_TOLERANCE_P999
+    from multi_contrast import compute_contrasts_batch
+    from parser import default_glm_params
+    from run_stats import fit_run_stats_glm
+
+    path2root, dict_BIDS_data = dataset
+    # A copy of a confound makes the design of every run collinear
+    dfs_confounds = [df.assign(duplicate=df.iloc[:, 0]) for df in dict_BIDS_data['dfs_confounds']]
+    glm_params = default_glm_params()
+
+    reference_glm = FirstLevelModel(**glm_params).fit(dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                                                      dfs_confounds)
+    design = reference_glm.design_matrices_[0].to_numpy()
+    assert np.linalg.matrix_rank(design) < design.shape[1]
+
+    run_glm = fit_run_stats_glm("sub-01_ses-1_task-swp", dict_BIDS_data['fns_func'], dict_BIDS_data['dfs_events'],
+                                dfs_confounds, glm_params, f"{path2root}/output/glm_runs")
+    contrast_matrix = np.eye(design.shape[1])[:5]
+    contrast_names = [f"column {i}" for i in range(len(contrast_matrix))]
+    reference = np.stack([reference_glm.masker_.transform(
+        reference_glm.compute_contrast(contrast, output_type="z_score")).ravel() for contrast in contrast_matrix])
+    z_maps = compute_contrasts_batch(run_glm, contrast_matrix, contrast_names, as_4d=True)
+
+    abs_dz = np.abs(reference_glm.masker_.transform(z_maps) - reference)
+    assert np.percentile(abs_dz, 99.9) <= Z_TOLERANCE_P999
+    assert abs_dz.max() <= Z_TOLERANCE_MAX
+
+
+def test_adding_runs_reuses_cached_runs(dataset, capsys):
+    from parser import default_glm_params
+    from run_stats import fit_run_stats_glm
+    from utils import get_subject_runs
+
+    path2root, dict_BIDS_data = dataset
+    mask_runs = get_subject_runs({'subject': 1, 'session': 1, 'task': "swp"}, path2root)
+    assert len(mask_runs) == 2
+    for n_runs in (1, 2):
+        fit_run_stats_glm("sub-01_ses-1_task-swp", dict_BIDS_data['fns_func'][:n_runs],
+                          dict_BIDS_data['dfs_events'][:n_runs], dict_BIDS_data['dfs_confounds'][:n_runs],
+                          default_glm_params(), f"{path2root}/output/glm_runs_subsets", mask_runs=mask_runs)
+    assert "1 run(s) fitted, 1 reused" in capsys.readouterr().out
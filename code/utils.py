@@ -1,5 +1,15 @@
 import os
-import pandas as pd
+
+import confounds
+from bids_layout import get_layout
+from profiling import profiled
+
+
+def as_list(value):
+    """ Wraps a single value in a list; lists and tuples are returned as lists. """
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
 
 
 def load_confound_data(subject_id,
@@ -7,8 +17,13 @@ def load_confound_data(subject_id,
                        task,
                         run_ids,
                           path2subjectdata,
-                           confound_columns = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']):
-    """ Loads confound data for a subject across multiple runs. """
+                           confound_columns = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'],
+                           cache_dir=None):
+    """
+    Loads confound data for a subject across multiple runs.
+    confound_columns is a list of columns or a strategy name from confounds.STRATEGIES
+    (e.g. 'motion24'). Only those columns are read, and parsed files are cached in cache_dir.
+    """
     
     confound_files_list = []
     if run_ids:
@@ -33,29 +48,85 @@ def load_confound_data(subject_id,
         confound_files_list.append(current_confound_file)
         #print(f"  Loaded confound file: {current_confound_file}")
         
-    
-    compound_dataframes = []
-    for confound_file in confound_files_list:
-        # Load the confound data
-        confound_df = pd.read_table(confound_file)
-        
-        # Check if required columns are present
-        missing_columns = [col for col in confound_columns if col not in confound_df.columns]
-        if missing_columns:
-            print(f"ERROR: Missing confound columns {missing_columns} in file {confound_file}.")
-            return None
-        
-        # Select only the motion confounds
-        confound_df = confound_df[confound_columns]
-        compound_dataframes.append(confound_df)
-        
-        # Save or process the confound data as needed
-        #print(f"  Loaded confounds for run {run_id}: {confound_file}")
+    # Return a list of confound DataFrames, one per run
+    try:
+        return confounds.load_confounds(confound_files_list, confound_columns, cache_dir=cache_dir)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return None
+
+def get_BIDS_paths(subject_id, session, task, run_ids, path2root):
+    """
+    Builds the expected anat, func, events and confounds paths of one subject.
+
+    Returns:
+        dict: 'anat' (str) and per-run lists 'func', 'events' and 'confounds'.
+    """
+    fn_base = f"sub-{subject_id:02d}_ses-{session}_task-{task}"
+    path2subject_data = os.path.join(path2root, "data", "derivatives", f"sub-{subject_id:02d}", "ses-1")
+    path2func = os.path.join(path2subject_data, "func")
+
+    # Anatomical data file
+    fn_anat = f"{fn_base.split('_task-')[0]}_space-MNI152NLin2009cAsym_desc-preproc_T1w.nii.gz"
+    paths = {"anat": os.path.join(path2subject_data, "anat", fn_anat),
+             "func": [], "events": [], "confounds": []}
+
+    # Functional, event and confound data; without run IDs there is a single, unnumbered run
+    run_entities = [f"_run-{run_id:02d}" for run_id in run_ids] if run_ids else [""]
+    for run in run_entities:
+        paths["func"].append(os.path.join(path2func, f"{fn_base}_dir-pa{run}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"))
+        paths["events"].append(os.path.join(path2func, f"{fn_base}{run}_events.tsv"))
+        paths["confounds"].append(os.path.join(path2func, f"{fn_base}_dir-pa{run}_desc-confounds_timeseries.tsv"))
+    return paths
 
-        # Return a list of confound DataFrames
-    return compound_dataframes  # Return list of confound file paths
 
-def load_BIDS_data(exp_args, run_ids=None, path2root="", load_confounds=False):
+def get_subject_runs(exp_args, path2root="", layout=None):
+    """
+    Lists every preprocessed BOLD run of the subject(s), session and task in the layout
+    index, whichever runs an analysis selects.
+
+    Returns:
+        list: Paths of the runs, per subject in run order.
+    """
+    if layout is None:
+        layout = get_layout(path2root)
+    fns_func = []
+    for subject_id in as_list(exp_args['subject']):
+        fns_func.extend(sorted(layout.get(subject_id, ses=exp_args['session'], task=exp_args['task'],
+                                          space="MNI152NLin2009cAsym", desc="preproc", suffix="bold",
+                                          extension=".nii.gz")))
+    return fns_func
+
+
+def check_BIDS_data(exp_args, run_ids=None, path2root="", load_confounds=False, layout=None):
+    """
+    Lists the expected BIDS files that do not exist, using the cached layout index
+    instead of probing the file system file by file.
+
+    Args:
+        exp_args (dict): Dictionary with subject(s), session, and task.
+        run_ids (list, optional): List of run IDs. Defaults to None.
+        path2root (str, optional): Path to the BIDS root directory. Defaults to "".
+        load_confounds (bool, optional): If True, confound files are checked too. Defaults to False.
+        layout (BIDSLayout, optional): Layout to check against. Defaults to bids_layout.get_layout(path2root).
+
+    Returns:
+        list: Paths of missing files (empty if everything is there).
+    """
+    if layout is None:
+        layout = get_layout(path2root)
+    keys = ["anat", "func", "events"] + (["confounds"] if load_confounds else [])
+
+    missing = []
+    for subject_id in as_list(exp_args['subject']):
+        paths = get_BIDS_paths(subject_id, exp_args['session'], exp_args['task'], run_ids, path2root)
+        for key in keys:
+            missing.extend(path for path in as_list(paths[key]) if not layout.exists(path))
+    return missing
+
+@profiled("load")
+def load_BIDS_data(exp_args, run_ids=None, path2root="", load_confounds=False, bold_cache=None,
+                   confound_strategy="motion6"):
     """
     Loads BIDS-formatted data for one or more subjects.
 
@@ -65,55 +136,52 @@ def load_BIDS_data(exp_args, run_ids=None, path2root="", load_confounds=False):
         run_ids (list, optional): List of run IDs. Defaults to None.
         path2root (str, optional): Path to the BIDS root directory. Defaults to "".
         load_confounds (bool, optional): If True, loads confound data. Defaults to False.
+        bold_cache (BoldCache, optional): If given, functional runs are returned as uncompressed,
+                                          memory-mappable copies from this cache. Defaults to None.
+        confound_strategy (str or list, optional): Confound columns or a strategy name from
+                                                   confounds.STRATEGIES. Defaults to "motion6".
 
     Returns:
         dict: A dictionary containing anatomical file paths, a list of functional 
               file paths, and concatenated dataframes for events and confounds.
     """
+    import pandas as pd
+
     subject_ids, session, task = exp_args['subject'], exp_args['session'], exp_args['task']
     if not isinstance(subject_ids, list):
         subject_ids = [subject_ids]
 
+    # Check every file against the layout index before reading anything
+    missing = check_BIDS_data(exp_args, run_ids, path2root, load_confounds)
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} BIDS file(s) not found, e.g.: {missing[:5]}")
+
     all_fn_anat = []
     all_fns_func, all_fns_events = [], []
     all_dfs_events, all_dfs_confounds = [], []
 
     for subject_id in subject_ids:
-        fn_base = f"sub-{subject_id:02d}_ses-{session}_task-{task}"
-        path2subject_data = os.path.join(path2root, "data", "derivatives", f"sub-{subject_id:02d}", "ses-1")
-        
-        # Anatomical data file
-        fn_anat = f"{fn_base.split('_task-')[0]}_space-MNI152NLin2009cAsym_desc-preproc_T1w.nii.gz"
-        fn_anat = os.path.join(path2subject_data, "anat", fn_anat)
-        all_fn_anat.append(fn_anat)
-    
-        # Functional and event data
-        if run_ids:
-            for run_id in run_ids:
-                fn_func = f"{fn_base}_dir-pa_run-{run_id:02d}_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
-                fn_func = os.path.join(path2subject_data, "func", fn_func)                                              
-                all_fns_func.append(fn_func)
-                
-                current_events_file = os.path.join(path2subject_data, "func", f"{fn_base}_run-{run_id:02d}_events.tsv")
-                all_fns_events.append(current_events_file)
-                df_events = pd.read_table(current_events_file)
-                df_events['subject_id'] = subject_id # Add subject ID to dataframe
-                all_dfs_events.append(df_events)
-        else:
-            fn_func = f"{fn_base}_dir-pa_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
-            fn_func = os.path.join(path2subject_data, "func", fn_func)                                              
-            all_fns_func.append(fn_func)
-            
-            current_events_file = os.path.join(path2subject_data,"func", f"{fn_base}_events.tsv")
+        paths = get_BIDS_paths(subject_id, session, task, run_ids, path2root)
+        all_fn_anat.append(paths["anat"])
+        all_fns_func.extend(paths["func"])
+
+        # Event data
+        for current_events_file in paths["events"]:
             all_fns_events.append(current_events_file)
             df_events = pd.read_table(current_events_file)
             df_events['subject_id'] = subject_id # Add subject ID to dataframe
             all_dfs_events.append(df_events)
 
         if load_confounds:
-            confound_dfs_list = load_confound_data(subject_id, session, task, run_ids, path2subject_data)
+            path2subject_data = os.path.dirname(os.path.dirname(paths["anat"]))
+            confound_dfs_list = load_confound_data(subject_id, session, task, run_ids, path2subject_data,
+                                                   confound_strategy,
+                                                   cache_dir=os.path.join(path2root, "output", "confounds"))
             all_dfs_confounds.extend(confound_dfs_list)
 
+    if bold_cache is not None:
+        all_fns_func = bold_cache.get_niftis(all_fns_func)
+
     return {
         "fn_anat": all_fn_anat,
         "fns_func": all_fns_func,
@@ -123,6 +191,8 @@ def load_BIDS_data(exp_args, run_ids=None, path2root="", load_confounds=False):
     }
 
 def load_BIDS_data_temp(exp_args, run_ids, path2root, load_confounds=False):
+    import pandas as pd
+
     subject_id, session, task = exp_args['subject'], exp_args['session'], exp_args['task']
     fn_base = f"sub-{subject_id:02d}_ses-{session}_task-{task}"
     # BIDS-like paths for derivatives
@@ -1,15 +1,33 @@
 import os
-import matplotlib.pyplot as plt
-from nilearn.plotting import plot_design_matrix as nilearn_plot_design_matrix
-from nilearn.plotting import plot_design_matrix_correlation
-from nilearn.plotting import plot_contrast_matrix as nilearn_plot_contrast_matrix
-from nilearn.plotting import plot_anat, plot_img, plot_stat_map
-from nilearn.glm import threshold_stats_img
-from nilearn.plotting import plot_glass_brain
-from nilearn.image import mean_img
-
+from itertools import product
+from pathlib import Path
+# matplotlib and nilearn.plotting are imported inside the plotting functions, after
+# rendering.use_headless_backend(), so importing viz costs nothing until something is drawn
+from rendering import FigureRenderer, save_img_if_changed, use_headless_backend
+from clusters import ClusterSweep, fdr_thresholds, save_cluster_table
+from profiling import profiled
+
+# Plotting configuration of the FDR/cluster-thresholded figures, shared with batch_pipeline
+FDR_STAT_MAP_CONFIG = {"display_mode": "z",
+                       "cut_coords": 3,
+                       "black_bg": True,
+                       "figsize": (10, 4)}
+FDR_GLASS_BRAIN_CONFIG = {"display_mode": "ortho",
+                          "cut_coords": (0, 0, 0),
+                          "colorbar": True,
+                          "annotate": True,
+                          "draw_cross": False,
+                          "black_bg": False,
+                          "figsize": (10, 8)}
+
+@profiled("design_matrix_plot")
 def plot_design_matrix_to_file(fmri_glm, exp_args, path2root):
     """Plots the design matrix and saves it to a file."""
+    use_headless_backend()
+    import matplotlib.pyplot as plt
+    from nilearn.plotting import plot_design_matrix as nilearn_plot_design_matrix
+    from nilearn.plotting import plot_design_matrix_correlation
+
     subject_id, session, task = exp_args['subject'], exp_args['session'], exp_args['task']
 
     # Check if subject_id is a list and format accordingly
@@ -37,14 +55,22 @@ def plot_design_matrix_to_file(fmri_glm, exp_args, path2root):
 
 def plot_contrast_matrix_to_file(contrast_vector, design_matrix, output_filepath):
     """Plots the contrast matrix and saves it to a file."""
+    use_headless_backend()
+    import matplotlib.pyplot as plt
+    from nilearn.plotting import plot_contrast_matrix as nilearn_plot_contrast_matrix
+
     print(f"Plotting contrast matrix to {output_filepath}...")
     nilearn_plot_contrast_matrix(contrast_vector, design_matrix, output_file=output_filepath)
     plt.close()
     print("  Contrast matrix plot saved.")
 
 
+@profiled("diagnostic_plot")
 def plot_diagnostic_images_to_file(exp_args, mean_func_img, anat_file, path2root):
     """Plots and saves mean functional and anatomical images for one or more subjects."""
+    use_headless_backend()
+    import matplotlib.pyplot as plt
+    from nilearn.plotting import plot_anat, plot_img
 
     # Ensure subject_id is a list for consistent iteration
     subject_ids = exp_args['subject']
@@ -92,6 +118,10 @@ def plot_diagnostic_images_to_file(exp_args, mean_func_img, anat_file, path2root
     
 def plot_diagnostic_images_to_file_temp(exp_args, mean_func_img, anat_file, path2root):
     """Plots and saves mean functional and anatomical images."""
+    use_headless_backend()
+    import matplotlib.pyplot as plt
+    from nilearn.plotting import plot_anat, plot_img
+
     # Build file and folder names based on experiment arguments
     subject_id, session, task = exp_args['subject'], exp_args['session'], exp_args['task']
     fn_base = f"sub-{subject_id:02d}_ses-{session}_task-{task}"
@@ -114,52 +144,72 @@ def plot_diagnostic_images_to_file_temp(exp_args, mean_func_img, anat_file, path
     print("  Mean functional and anatomical images saved.")
 
 
-def compute_threshold_plot_stat_maps_to_file(fmri_glm, contrast_vector, original_contrast_name, contrast_name_safe, mean_func_img, current_alpha, cluster_threshold, base_output_filepath_prefix):
-    """Computes statistical maps, thresholds them, and plots/saves them."""
+def submit_thresholded_figures(renderer, map_file, threshold, title, mean_func_img,
+                               stat_map_filepath, glass_brain_filepath):
+    """
+    Hands the stat map and glass brain of one thresholded map to renderer (a
+    rendering.FigureRenderer), drawn with FDR_STAT_MAP_CONFIG and FDR_GLASS_BRAIN_CONFIG.
+
+    Returns:
+        list: Paths of the figures of the kinds the renderer draws.
+    """
+    figures = []
+    for kind, filepath, config in [("stat_map", stat_map_filepath, dict(FDR_STAT_MAP_CONFIG, bg_img=mean_func_img)),
+                                   ("glass_brain", glass_brain_filepath, FDR_GLASS_BRAIN_CONFIG)]:
+        renderer.submit(kind, map_file, str(filepath), threshold=threshold, title=title, **config)
+        if renderer.wants(kind):
+            figures.append(str(filepath))
+    return figures
+
+
+def compute_threshold_plot_stat_maps_to_file(fmri_glm, contrast_vector, original_contrast_name, contrast_name_safe, mean_func_img, current_alpha, cluster_threshold, base_output_filepath_prefix, z_map=None, renderer=None, folder_maps=None):
+    """
+    Computes statistical maps, thresholds them, and plots/saves them.
+    current_alpha and cluster_threshold may be lists: the z-map is computed once (or taken
+    from z_map) and FDR/cluster thresholding is run for every combination.
+    Thresholded maps are saved to folder_maps (default: next to the figures) and the
+    figures are handed to renderer (a rendering.FigureRenderer, rendering inline if None).
+    The FDR thresholds of all alphas are labelled in one cluster sweep, and a cluster
+    table is saved as TSV next to every figure.
+    """
     print("Computing and plotting statistical maps...")
     # Compute z-map
-    z_map = fmri_glm.compute_contrast(contrast_vector, output_type="z_score")
-    print(f"  Z-map computed for contrast: {contrast_name_safe}")
-
-    # Threshold the z-map
-    print(f"  Thresholding z-map with alpha={current_alpha}, cluster_threshold={cluster_threshold}...")
-    clean_map, threshold = threshold_stats_img(
-        z_map, 
-        alpha=current_alpha, 
-        height_control="fdr",
-        cluster_threshold=cluster_threshold, 
-        two_sided=True,
-    )
-    print(f"  Thresholded map generated. Threshold value: {threshold:.3f}")
-
-    # Plot stat map
-    stat_map_plotting_config = {"bg_img": mean_func_img, 
-                                "display_mode": "z", 
-                                "cut_coords": 3, 
-                                "black_bg": True}
-    title_stat_map = (f"{original_contrast_name} (p<{current_alpha:.3f} FDR; thresh: {threshold:.3f}; clusters > {cluster_threshold} voxels)")
-    
-    stat_map_filepath = base_output_filepath_prefix.with_suffix(f".stat_map_alpha{current_alpha}.png")
-    plot_stat_map(clean_map, threshold=threshold, 
-                  title=title_stat_map,
-                  figure=plt.figure(figsize=(10, 4)), 
-                  output_file=stat_map_filepath,
-                  **stat_map_plotting_config)
-    print(f"  Statistical map saved to {stat_map_filepath}")
-
-    # Plot glass brain
-    glass_brain_plotting_config = {"display_mode": "ortho", 
-                                   "cut_coords": (0,0,0), 
-                                   "colorbar": True, 
-                                   "annotate": True, 
-                                   "draw_cross": False, 
-                                   "black_bg": False}
-    
-    glass_brain_filepath = base_output_filepath_prefix.with_suffix(f".glass_brain_alpha{current_alpha}.png")
-    plot_glass_brain(clean_map, threshold=threshold, 
-                     title=title_stat_map, 
-                     figure=plt.figure(figsize=(10, 8)), 
-                     output_file=glass_brain_filepath,
-                     **glass_brain_plotting_config)
-    print(f"  Glass brain plot saved to {glass_brain_filepath}")
-    plt.close('all')
\ No newline at end of file
+    if z_map is None:
+        z_map = fmri_glm.compute_contrast(contrast_vector, output_type="z_score")
+        print(f"  Z-map computed for contrast: {contrast_name_safe}")
+
+    own_renderer = renderer is None
+    if own_renderer:
+        renderer = FigureRenderer(n_jobs=1)
+    if folder_maps is None:
+        folder_maps = os.path.dirname(str(base_output_filepath_prefix))
+
+    alphas = current_alpha if isinstance(current_alpha, (list, tuple)) else [current_alpha]
+    cluster_thresholds = cluster_threshold if isinstance(cluster_threshold, (list, tuple)) else [cluster_threshold]
+    # Only add the cluster size to file names when several are being compared
+    tag_cluster = len(cluster_thresholds) > 1
+
+    # FDR thresholds of all alphas first, so one sweep labels the clusters at all of them
+    thresholds = fdr_thresholds(z_map, alphas)
+    cluster_sweep = ClusterSweep(z_map, list(thresholds.values()))
+
+    for alpha, cluster_size in product(alphas, cluster_thresholds):
+        # Threshold the z-map
+        print(f"  Thresholding z-map with alpha={alpha}, cluster_threshold={cluster_size}...")
+        threshold = thresholds[alpha]
+        clean_map = cluster_sweep.thresholded_img(threshold, cluster_size)
+        print(f"  Thresholded map generated. Threshold value: {threshold:.3f}")
+        tag = f"alpha{alpha}_cluster{cluster_size}" if tag_cluster else f"alpha{alpha}"
+        clean_map_file = save_img_if_changed(
+            clean_map, os.path.join(folder_maps, f"{Path(base_output_filepath_prefix).name}.map_{tag}.nii.gz"))
+        save_cluster_table(cluster_sweep.cluster_table(threshold, cluster_size),
+                           str(base_output_filepath_prefix.with_suffix(f".clusters_{tag}.tsv")))
+
+        # Plot stat map and glass brain
+        title_stat_map = (f"{original_contrast_name} (p<{alpha:.3f} FDR; thresh: {threshold:.3f}; clusters > {cluster_size} voxels)")
+        submit_thresholded_figures(renderer, clean_map_file, threshold, title_stat_map, mean_func_img,
+                                   base_output_filepath_prefix.with_suffix(f".stat_map_{tag}.png"),
+                                   base_output_filepath_prefix.with_suffix(f".glass_brain_{tag}.png"))
+
+    if own_renderer:
+        renderer.close()